@@ -0,0 +1,289 @@
+# *****************************
+# *** BEHAVIORAL LOG PARSER ***
+# *****************************
+
+# Streaming parser for the behavioral .log files written by the Glare Illusion
+# Perception Task (Glare_Illusion_Paradigm_v8.py and earlier versions). The log
+# is read once, each line is matched against one precompiled pattern, and the
+# trials are returned as a typed (columnar) NumPy table with one row per main
+# and brightness phase trial:
+#
+#   from log_parser import load_trial_table
+#   trials = load_trial_table('Subject_Session_1_..._v8.log')
+#   glare_right = trials[(trials['stim_type'] == 0) & (trials['side'] == 1)]
+#
+# Parsed tables are cached on disk by the file content hash, so unchanged logs
+# are loaded from the cache instead of being parsed again.
+#
+#   python log_parser.py <log files>
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Parser version
+# Note: Part of the cache key, so cached tables are rebuilt when the parser changes
+parser_version = 1
+
+# Default cache folder
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'glare_illusion', 'trial_tables')
+
+# Trial table fields
+# phase: 0 = main; 1 = brightness (same codes as the task event file)
+# stim_type: main (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor plus; 5 = distractor cross),
+#            brightness (0 = glare vs nonglare; 1 = glare vs iso; 2 = nonglare vs iso)
+# side: 0 = left; 1 = right (-1 = unknown)
+# onset/offset: log time of the stimulus onset/offset (in seconds, NaN = not logged)
+# perceived: distractor perceived (main phase)
+# response: first response key after stimulus onset (0 = none); rt: reaction time (in seconds)
+trial_dtype = np.dtype([('phase', '<i4'), ('block', '<i4'), ('trial', '<i4'), ('stim_type', '<i4'), ('side', '<i4'),
+                        ('pre_isi', '<i4'), ('post_isi', '<i4'), ('onset', '<f8'), ('offset', '<f8'),
+                        ('perceived', '<i4'), ('response', '<i4'), ('rt', '<f8'), ('fixation_break', '<i4')])
+
+# Stimulus types by "Draw ... Stimulus" name
+# Note: "Distractor" is the single distractor type of task version v7
+main_stim_types = {'Glare': 0, 'Nonglare': 1, 'Iso': 2, 'White': 3, 'Distractor Plus': 4, 'Distractor Cross': 5, 'Distractor': 4}
+brightness_stim_types = {'Glare vs Nonglare': 0, 'Glare vs Iso': 1, 'Nonglare vs Iso': 2}
+
+# Response keys of each phase
+response_keys = {0: ('1', '2'), 1: ('1', '2', '3')}
+
+# Stimulus types by location array name (main phase)
+# Note: The brightness phase logs its three location arrays as Glare/Nonglare/Iso (types 0/1/2)
+location_array_types = {'Glare': 0, 'Nonglare': 1, 'Non Glare': 1, 'Iso': 2, 'White': 3, 'Distractor Plus': 4, 'Distractor Cross': 5, 'Distractor': 4}
+
+# Log line: "<time> \t<level> \t<message>"
+# Note: Lines without a time stamp continue the previous message (wrapped NumPy arrays)
+line_pattern = re.compile(r'(\d+\.\d+)\s+(\w+)\s+(.*)')
+
+# Task messages (one alternative per message type)
+message_pattern = re.compile(
+    r'(?P<trial>Starting Trial #(?P<trial_num>\d+))'
+    r'|(?P<pre_isi>Trial Pre-Stimulus Time: (?P<pre_isi_value>\d+))'
+    r'|(?P<post_isi>Trial Post-Stimulus Time: (?P<post_isi_value>\d+))'
+    r'|(?P<draw>Draw (?P<draw_name>.+) Stimulus)'
+    r'|(?P<offset>Post-stimulus interval)'
+    r'|(?P<keypress>Keypress: (?P<key>\w+))'
+    r'|(?P<perceived>Perceived Distractor)'
+    r'|(?P<response_rt>Response RT: (?P<rt_key>\w+) (?P<rt_value>[\d.]+))'
+    r'|(?P<fixation_break>Fixation break)'
+    r'|(?P<block>Block #(?P<block_num>\d+)$)'
+    r'|(?P<block_end>Block duration|Block \d+ Duration)'
+    r'|(?P<type_array>All Stimuli Type Array)'
+    r'|(?P<location_array>(?P<location_name>.+) Stimuli Location Array)'
+    r'|(?P<main_phase>Starting Glare Illusion Main Phase)'
+    r'|(?P<brightness_phase>Starting Glare Illusion Perception Phase)'
+)
+
+# **************
+# *** PARSER ***
+# **************
+
+def read_log_messages(lines):
+    '''Yield (time, level, message) for each log entry, joining wrapped lines'''
+
+    entry = None
+
+    for line in lines:
+
+        match = line_pattern.match(line)
+
+        # Continuation of the previous message
+        if match is None:
+            if entry is not None:
+                entry[2] += ' ' + line.strip()
+            continue
+
+        if entry is not None:
+            yield entry
+        entry = [float(match.group(1)), match.group(2), match.group(3).rstrip()]
+
+    if entry is not None:
+        yield entry
+
+def parse_array(message: str) -> np.ndarray:
+    '''Values between the brackets of a logged NumPy array'''
+
+    return np.array(message[message.index('[')+1:message.rindex(']')].split(), dtype=float)
+
+def parse_log(lines) -> np.ndarray:
+    '''Parse log lines (an open file or list of strings) into a trial table (see trial_dtype)'''
+
+    rows = []
+    phase = None
+    block = 0
+    location_arrays = {}
+    type_counts = {}
+    trial = None
+
+    for t, level, message in read_log_messages(lines):
+
+        match = message_pattern.match(message)
+        if match is None:
+            continue
+
+        # Message type
+        # Note: The outer group closes last, so lastgroup is the message type, not a value group
+        kind = match.lastgroup
+
+        # Task phase
+        if kind == 'main_phase':
+            phase = 0
+        elif kind == 'brightness_phase':
+            phase = 1
+
+        # New block
+        elif kind == 'block':
+            block = int(match.group('block_num'))
+            location_arrays = {}
+            type_counts = {}
+
+        # End of block (later key presses are block break answers)
+        elif kind == 'block_end':
+            trial = None
+
+        # Block location arrays
+        elif kind == 'location_array':
+            location_name = match.group('location_name')
+            if location_name in location_array_types:
+                location_arrays[location_array_types[location_name]] = parse_array(message)
+
+        elif phase is None:
+            continue
+
+        # New trial
+        elif kind == 'trial':
+            trial = {'phase': phase, 'block': block, 'trial': int(match.group('trial_num')), 'stim_type': -1, 'side': -1,
+                     'pre_isi': -1, 'post_isi': -1, 'onset': np.nan, 'offset': np.nan, 'perceived': 0, 'response': 0,
+                     'rt': np.nan, 'fixation_break': 0}
+            rows.append(trial)
+            hardware_rt = False
+
+        elif trial is None:
+            continue
+
+        elif kind == 'pre_isi':
+            trial['pre_isi'] = int(match.group('pre_isi_value'))
+
+        elif kind == 'post_isi':
+            trial['post_isi'] = int(match.group('post_isi_value'))
+
+        # Stimulus onset: type and location
+        elif kind == 'draw':
+            stim_types = main_stim_types if phase == 0 else brightness_stim_types
+            stim_type = stim_types.get(match.group('draw_name'), -1)
+            trial['stim_type'] = stim_type
+            trial['onset'] = t
+
+            # Location: next entry of the stimulus type location array
+            count = type_counts.get(stim_type, 0)
+            type_counts[stim_type] = count + 1
+            if stim_type in location_arrays and count < len(location_arrays[stim_type]):
+                trial['side'] = int(location_arrays[stim_type][count])
+
+        # Stimulus offset
+        elif kind == 'offset':
+            trial['offset'] = t
+
+        # First response after stimulus onset
+        elif kind == 'keypress':
+            key = match.group('key')
+            if key in response_keys[phase] and not trial['response'] and not np.isnan(trial['onset']):
+                trial['response'] = int(key)
+                trial['rt'] = t - trial['onset']
+
+        elif kind == 'perceived':
+            trial['perceived'] = 1
+
+        # Keyboard reaction time (task version v8 and later)
+        # Note: Replaces the reaction time from the log time of the first response
+        elif kind == 'response_rt':
+            if int(match.group('rt_key')) == trial['response'] and not hardware_rt:
+                trial['rt'] = float(match.group('rt_value'))
+                hardware_rt = True
+
+        elif kind == 'fixation_break':
+            trial['fixation_break'] = 1
+
+    # Trial table
+    trial_table = np.zeros(len(rows), dtype=trial_dtype)
+    for field in trial_dtype.names:
+        trial_table[field] = [row[field] for row in rows]
+
+    return trial_table
+
+# *************
+# *** CACHE ***
+# *************
+
+def content_hash(content: bytes) -> str:
+    '''Cache key of a log file (content and parser version)'''
+
+    return hashlib.sha256(content + b'\0parser_version=%d' % parser_version).hexdigest()
+
+def load_trial_table(log_filename: str, cache_dir: str = default_cache_dir) -> np.ndarray:
+    '''Trial table of a log file, from the cache if the file content is unchanged
+    cache_dir: cache folder (None = no cache)'''
+
+    # Read the file once (for the hash and the parser)
+    with open(log_filename, 'rb') as log_file:
+        content = log_file.read()
+
+    if cache_dir is None:
+        return parse_log(content.decode('utf-8', errors='replace').splitlines())
+
+    # Cached table
+    cache_filename = os.path.join(cache_dir, content_hash(content) + '.npy')
+    if os.path.isfile(cache_filename):
+        return np.load(cache_filename)
+
+    # Parse and cache
+    trial_table = parse_log(content.decode('utf-8', errors='replace').splitlines())
+
+    # Note: Written to a temporary file and renamed, so a parallel reader never sees a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_filename = cache_filename + '.%d.tmp' % os.getpid()
+    with open(temp_filename, 'wb') as cache_file:
+        np.save(cache_file, trial_table)
+    os.replace(temp_filename, cache_filename)
+
+    return trial_table
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Parse Glare Illusion Perception Task logs into trial tables')
+    parser.add_argument('log_files', nargs='+', help='behavioral .log files')
+    parser.add_argument('--cache-dir', default=default_cache_dir, help='trial table cache folder')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the log files')
+    options = parser.parse_args()
+
+    for log_filename in options.log_files:
+
+        start = time.perf_counter()
+        trial_table = load_trial_table(log_filename, None if options.no_cache else options.cache_dir)
+        duration = time.perf_counter() - start
+
+        # Summary
+        main_trials = trial_table[trial_table['phase'] == 0]
+        print('%s: %d main and %d brightness trials, %d blocks (%.1f ms)' % (os.path.basename(log_filename), len(main_trials),
+              np.sum(trial_table['phase'] == 1), len(np.unique(main_trials['block'])), duration*1000))
+
+if __name__ == '__main__':
+    sys.exit(main())
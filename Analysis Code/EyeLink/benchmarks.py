@@ -0,0 +1,264 @@
+# ***************************
+# *** ANALYSIS BENCHMARKS ***
+# ***************************
+
+# End-to-end benchmarks of the analysis stages on synthetic cohorts (see
+# synthetic_sessions.py) of increasing size: 1x, 10x, and 100x a base cohort. Each
+# stage is timed and its peak memory measured (NumPy and Python allocations of the
+# benchmark process, with tracemalloc):
+#
+#   log_parse      behavioral log parsing (log_parser.py, no cache)
+#   blinks         blink removal and pupil smoothing (pipeline blinks stage)
+#   microsaccades  saccade and microsaccade detection (pipeline saccades stage)
+#   epochs         epoching of every event type and signal (pipeline epochs stage)
+#   permutation    cluster-based permutation test of glare vs. nonglare pupil timecourses
+#   decoding       stacked SVM decoding (distractor vs. ISI)
+#
+# Synthetic cohorts and their pipeline outputs are kept in the benchmark folder and
+# reused. Results are compared with stored baselines: a stage that is slower or uses
+# more memory than its baseline (beyond the tolerance) is reported as a regression,
+# and the exit status is 1.
+#
+#   python benchmarks.py --output-dir <folder> --scales 1 10 100 --save-baseline
+#   python benchmarks.py --output-dir <folder> --scales 1 10 100
+#
+# Note: Stages run in a single process, so results are comparable between runs;
+# baselines only apply to the machine they were saved on.
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import decoding
+import log_parser
+import pipeline
+from permutation import permutest
+from synthetic_sessions import write_cohort
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Base (1x) cohort: subjects and main phase blocks per session
+base_subjects = 4
+base_blocks = 4
+
+# Cohort sizes (multiples of the base cohort)
+default_scales = (1, 10, 100)
+
+# Benchmarked stages (in order)
+stage_names = ('log_parse', 'blinks', 'microsaccades', 'epochs', 'permutation', 'decoding')
+
+# Permutation test: conditions, interval (samples from the event), and permutations
+permutation_conditions = ('glare_left', 'nonglare_left')
+permutation_interval = (-1000, 4000)
+permutation_count = 1000
+
+# Decoding comparison
+decoding_comparison = 'Distractor_vs_ISI_Distractor'
+
+# Regression tolerance (fraction of the baseline) and the smallest differences reported
+default_tolerance = 0.25
+min_seconds = 0.5
+min_megabytes = 10
+
+# Default baseline file
+default_baseline_filename = 'benchmark_baselines.json'
+
+# **************
+# *** STAGES ***
+# **************
+
+def session_inputs(cohort: dict, work_dir: str) -> list:
+    '''Session configurations and pipeline task folders of a cohort ((session id, config, {stage: folder}))'''
+
+    sessions = []
+    for subject in cohort['subjects']:
+        for session in subject['sessions']:
+            owner = pipeline.session_id(subject, session)
+            config = dict(session, eye=session.get('eye', subject.get('eye', 'left')))
+            sessions.append((owner, config, {stage: os.path.join(work_dir, owner, stage) for stage in pipeline.session_stages}))
+
+    return sessions
+
+def run_stage(stage: str, cohort: dict, work_dir: str, scratch_dir: str, parameters: dict):
+    '''Run one benchmarked stage on every session (or the whole cohort), writing into scratch_dir'''
+
+    if stage in ('log_parse', 'blinks', 'microsaccades', 'epochs'):
+        stage_function = {'blinks': pipeline.run_blinks, 'microsaccades': pipeline.run_saccades,
+                          'epochs': pipeline.run_epochs}.get(stage)
+        for owner, config, inputs in session_inputs(cohort, work_dir):
+            if stage == 'log_parse':
+                log_parser.load_trial_table(config['log'], cache_dir=None)
+                continue
+            output_dir = os.path.join(scratch_dir, owner)
+            os.makedirs(output_dir, exist_ok=True)
+            stage_function(config, parameters, inputs, output_dir)
+
+    elif stage == 'permutation':
+        means = np.load(os.path.join(work_dir, 'cohort', 'group', 'subject_means.npz'))
+        group_1, group_2 = (means['%s_pupil' % condition] for condition in permutation_conditions)
+        event_sample = (group_1.shape[1] - 1) // 2
+        interval = slice(event_sample + permutation_interval[0], event_sample + permutation_interval[1])
+        keep = ~np.any(np.isnan(group_1[:, interval]) | np.isnan(group_2[:, interval]), axis=1)
+        permutest(group_1[keep, interval], group_2[keep, interval], True, num_permutations=permutation_count,
+                  two_sided=True, seed=0)
+
+    elif stage == 'decoding':
+        decoding.decode_cohort(cohort, work_dir, scratch_dir, [decoding_comparison], log=lambda message: None)
+
+def measure(stage: str, cohort: dict, work_dir: str, scratch_dir: str, parameters: dict) -> dict:
+    '''Duration (s) and peak memory (MB) of a stage'''
+
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir)
+    gc.collect()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        run_stage(stage, cohort, work_dir, scratch_dir, parameters)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return {'seconds': round(seconds, 3), 'peak_mb': round(peak / 1024**2, 1)}
+
+# *************
+# *** SETUP ***
+# *************
+
+def prepare_cohort(output_dir: str, scale: int, subjects: int, blocks: int, seed: int, workers: int) -> tuple:
+    '''Synthetic cohort and pipeline outputs of a cohort size (created if needed); returns (cohort, work folder)'''
+
+    cohort_dir = os.path.join(output_dir, 'cohort_%dx' % scale)
+    cohort_filename = os.path.join(cohort_dir, 'cohort.json')
+    settings = {'subjects': subjects * scale, 'blocks': blocks, 'seed': seed}
+    settings_filename = os.path.join(cohort_dir, 'settings.json')
+
+    # Note: A cohort written with other settings (or partly written) is replaced
+    try:
+        with open(settings_filename) as settings_file:
+            current = json.load(settings_file) == settings
+    except (OSError, ValueError):
+        current = False
+    if not current:
+        shutil.rmtree(cohort_dir, ignore_errors=True)
+        print('Writing the %dx cohort (%d subjects)' % (scale, settings['subjects']))
+        write_cohort(cohort_dir, settings['subjects'], blocks, seed, workers, log=lambda message: None)
+        with open(settings_filename, 'w') as settings_file:
+            json.dump(settings, settings_file)
+
+    with open(cohort_filename) as cohort_file:
+        cohort = json.load(cohort_file)
+    for subject in cohort['subjects']:
+        for session in subject['sessions']:
+            for field in ('eyelink', 'log'):
+                session[field] = os.path.join(cohort_dir, session[field])
+
+    # Pipeline outputs (inputs of the benchmarked stages; up-to-date tasks are skipped)
+    work_dir = os.path.join(cohort_dir, 'pipeline')
+    report = pipeline.Pipeline(cohort, work_dir, workers=workers).run(log=lambda message: None)
+    failed = [name for name, result in report.items() if str(result).startswith('failed')]
+    if failed:
+        raise RuntimeError('Pipeline tasks failed: %s' % failed)
+
+    return cohort, work_dir
+
+# ***************
+# *** RESULTS ***
+# ***************
+
+def regressions(results: dict, baselines: dict, tolerance: float) -> list:
+    '''Stages slower or larger than their baseline ((scale, stage, measure, value, baseline))'''
+
+    found = []
+    for scale, stage_results in results.items():
+        for stage, result in stage_results.items():
+            baseline = baselines.get(scale, {}).get(stage)
+            if baseline is None:
+                continue
+            for name, floor in (('seconds', min_seconds), ('peak_mb', min_megabytes)):
+                if result[name] > baseline[name] * (1 + tolerance) and result[name] - baseline[name] > floor:
+                    found.append((scale, stage, name, result[name], baseline[name]))
+
+    return found
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the analysis stages on synthetic cohorts')
+    parser.add_argument('--output-dir', default='benchmarks', help='synthetic cohorts and results folder')
+    parser.add_argument('--scales', nargs='+', type=int, default=list(default_scales), help='cohort sizes (x base cohort)')
+    parser.add_argument('--stages', nargs='+', choices=stage_names, default=list(stage_names))
+    parser.add_argument('--subjects', type=int, default=base_subjects, help='subjects of the base cohort')
+    parser.add_argument('--blocks', type=int, default=base_blocks, help='main phase blocks per session')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes for the cohort setup')
+    parser.add_argument('--baseline', help='baseline file (default: %s in the output folder)' % default_baseline_filename)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance, help='allowed slowdown/growth (fraction)')
+    options = parser.parse_args()
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    baseline_filename = options.baseline or os.path.join(options.output_dir, default_baseline_filename)
+    settings = {'subjects': options.subjects, 'blocks': options.blocks, 'seed': options.seed}
+
+    baselines = {}
+    if os.path.isfile(baseline_filename):
+        with open(baseline_filename) as baseline_file:
+            stored = json.load(baseline_file)
+        if stored.get('settings') == settings:
+            baselines = stored['results']
+        else:
+            print('Baselines were measured on other cohort settings (%s) and are not compared' % stored.get('settings'))
+
+    results = {}
+    for scale in options.scales:
+        cohort, work_dir = prepare_cohort(options.output_dir, scale, options.subjects, options.blocks, options.seed,
+                                          options.workers)
+        parameters = dict(pipeline.default_parameters, **cohort.get('parameters', {}))
+        scale_name = '%dx' % scale
+        results[scale_name] = {}
+        for stage in options.stages:
+            result = measure(stage, cohort, work_dir, os.path.join(options.output_dir, 'scratch'), parameters)
+            results[scale_name][stage] = result
+            baseline = baselines.get(scale_name, {}).get(stage)
+            print('%5s %-14s %9.2f s %9.1f MB%s' % (scale_name, stage, result['seconds'], result['peak_mb'],
+                  '   (baseline %.2f s, %.1f MB)' % (baseline['seconds'], baseline['peak_mb']) if baseline else ''))
+
+    with open(os.path.join(options.output_dir, 'benchmark_results.json'), 'w') as results_file:
+        json.dump({'settings': settings, 'results': results}, results_file, indent=1)
+
+    found = regressions(results, baselines, options.tolerance)
+    for scale_name, stage, name, value, baseline in found:
+        print('REGRESSION %s %s: %s %.2f (baseline %.2f)' % (scale_name, stage, name, value, baseline))
+
+    if options.save_baseline:
+        # Note: Stages and scales that were not run keep their previous baseline
+        for scale_name, stage_results in results.items():
+            baselines.setdefault(scale_name, {}).update(stage_results)
+        with open(baseline_filename, 'w') as baseline_file:
+            json.dump({'settings': settings, 'results': baselines}, baseline_file, indent=1)
+        print('Baseline saved: %s' % baseline_filename)
+
+    return 1 if found and not options.save_baseline else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
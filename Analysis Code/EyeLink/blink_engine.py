@@ -0,0 +1,383 @@
+# ********************
+# *** BLINK ENGINE ***
+# ********************
+
+# Batched NumPy version of the Stublinks60.m/stublinks.m blink removal (pupil
+# blink detection and linear interpolation, Siegle et al., 2003). Recordings or
+# trials are processed as rows of a batch: the detection rules and resampling
+# are array operations over all rows, and only the per-blink bookkeeping
+# (merging close blinks and interpolation) loops over the detected blinks.
+#
+# Unlike Stublinks60.m, a failing row does not stop or silently blank the batch:
+# its output is set to the Stublinks60.m failure output (NaN pupil, all blinks)
+# and the failure reason is returned for that row.
+#
+#   from blink_engine import stublinks60
+#   pupil, blinks, errors = stublinks60(pupil_data/1000, 1000)
+#
+# See blink_validation.py for the validation and benchmark harness.
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import numpy as np
+from scipy import sparse
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Stublinks sampling rate (Hz)
+stublinks_rate = 60
+
+# Pupil value below which samples are blinks (see stublinks.m lowthresh)
+low_threshold = 0.1
+
+# Minimum number of samples at the stublinks rate
+# Note: stublinks.m indexes the first 100 and last 101 samples
+min_stublinks_samples = 101
+
+class StublinksError(ValueError):
+    '''Row that stublinks cannot process (stublinks.m would crash)'''
+
+# ******************
+# *** RESAMPLING ***
+# ******************
+
+def cubic(x: np.ndarray) -> np.ndarray:
+    '''Bicubic interpolation kernel (MATLAB imresize)'''
+
+    absx = np.abs(x)
+    absx2 = absx**2
+    absx3 = absx**3
+
+    return ((1.5*absx3 - 2.5*absx2 + 1) * (absx <= 1) +
+            (-0.5*absx3 + 2.5*absx2 - 4*absx + 2) * ((1 < absx) & (absx <= 2)))
+
+def resize_matrix(in_length: int, out_length: int, scale: float) -> sparse.csr_matrix:
+    '''Sparse (out_length x in_length) bicubic resampling matrix with antialiasing
+    Note: Same weights and symmetric boundary handling as MATLAB imresize (contributions)
+    Note: Not cached across calls: the matrices of a 1 hour recording take hundreds of MB, and each session has its own length'''
+
+    # Kernel (widened when downsampling)
+    kernel_width = 4.0
+    if scale < 1:
+        kernel = lambda x: scale * cubic(scale * x)
+        kernel_width = kernel_width / scale
+    else:
+        kernel = cubic
+
+    # Input coordinates of the output samples (1-based as in MATLAB)
+    x = np.arange(1, out_length+1, dtype=np.float64)[:, None]
+    u = x/scale + 0.5 * (1 - 1/scale)
+    left = np.floor(u - kernel_width/2)
+    indices = left + np.arange(int(np.ceil(kernel_width)) + 2)
+
+    # Normalized weights
+    weights = kernel(u - indices)
+    weights = weights / np.sum(weights, axis=1, keepdims=True)
+
+    # Symmetric padding at the edges
+    aux = np.concatenate([np.arange(in_length), np.arange(in_length)[::-1]])
+    indices = aux[np.mod(indices.astype(np.int64) - 1, aux.size)]
+
+    rows = np.broadcast_to(np.arange(out_length)[:, None], indices.shape)
+    return sparse.csr_matrix((weights.ravel(), (rows.ravel(), indices.ravel())), shape=(out_length, in_length))
+
+def imresize(data: np.ndarray, out_length: float, matrix: sparse.csr_matrix = None) -> np.ndarray:
+    '''Resize each row to out_length samples (MATLAB imresize(row, [1 out_length]), bicubic)
+    matrix: resize_matrix of the row length and out_length, to reuse it (computed if not given)
+    Note: The scale is taken from the requested length; fractional lengths are rounded up'''
+
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    if matrix is None:
+        in_length = data.shape[1]
+        matrix = resize_matrix(in_length, int(np.ceil(out_length)), out_length/in_length)
+
+    return np.asarray((matrix @ data.T).T)
+
+def imresize_logical(data: np.ndarray, out_length: float, matrix: sparse.csr_matrix = None) -> np.ndarray:
+    '''Resize logical rows (MATLAB imresize of a logical array: resized as uint8 0/255, then > 128)'''
+
+    resized = imresize(np.asarray(data, dtype=np.float64) * 255, out_length, matrix)
+    return np.round(np.clip(resized, 0, 255)) > 128
+
+# *****************
+# *** DETECTION ***
+# *****************
+
+def forward_mean(data: np.ndarray, length: int) -> np.ndarray:
+    '''Mean of each sample and the next length-1 samples (zeros after the end)
+    Note: Equals the last samples of conv(ones(1,length)./length, data) in stublinks.m'''
+
+    cumsum = np.zeros((data.shape[0], data.shape[1] + length))
+    np.cumsum(data, axis=1, out=cumsum[:, 1:data.shape[1]+1])
+    cumsum[:, data.shape[1]+1:] = cumsum[:, data.shape[1], None]
+
+    return (cumsum[:, length:length+data.shape[1]] - cumsum[:, :data.shape[1]]) / length
+
+def forward_count(blinks: np.ndarray, length: int) -> np.ndarray:
+    '''Number of blink samples in each sample and the next length-1 samples (exact)'''
+
+    cumsum = np.zeros((blinks.shape[0], blinks.shape[1] + length), dtype=np.int64)
+    np.cumsum(blinks, axis=1, out=cumsum[:, 1:blinks.shape[1]+1])
+    cumsum[:, blinks.shape[1]+1:] = cumsum[:, blinks.shape[1], None]
+
+    return cumsum[:, length:length+blinks.shape[1]] - cumsum[:, :blinks.shape[1]]
+
+def detect_blinks(data: np.ndarray, lowthresh: float = low_threshold) -> np.ndarray:
+    '''Blink samples of each row (stublinks.m detection rules for tasks without a light reflex)'''
+
+    num_rows, num_points = data.shape
+
+    # Changes greater than .5 in consecutive samples
+    blinks = np.zeros(data.shape, dtype=bool)
+    blinks[:, :-1] = np.abs(data[:, 1:] - data[:, :-1]) > .5
+
+    # Samples more than 1 from the 30 sample smoothed data, where the smoothing does not average in a blink
+    smooth_blinks = forward_count(blinks, 30)
+    smooth_blinks[:, :100] = blinks[:, :100]
+    smooth_blinks[:, -101:] = blinks[:, -101:]
+    smooth_data = forward_mean(data, 30)
+    smooth_data[:, :100] = data[:, :100]
+    smooth_data[:, -101:] = data[:, -101:]
+    blinks |= (np.abs(smooth_data - data) > 1) & (smooth_blinks == 0)
+
+    # Samples below the low threshold
+    blinks |= data < lowthresh
+
+    # Samples within .1 of the lowest value (rows with blinks)
+    any_blinks = np.any(blinks, axis=1, keepdims=True)
+    blinks |= any_blinks & (data < np.min(data, axis=1, keepdims=True) + .1)
+
+    # Samples more than 4 from the median
+    blinks |= np.abs(data - np.median(data, axis=1, keepdims=True)) > 4
+
+    # Outliers from the Tukey hinges (MATLAB prctile = Hazen percentiles)
+    quartiles = np.percentile(data, [25, 75], axis=1, method='hazen', keepdims=True)
+    iqr = quartiles[1] - quartiles[0]
+    blinks |= data < quartiles[0] - 1.5*iqr
+    blinks |= data > quartiles[1] + 2.0*iqr
+
+    # Samples more than 1.5 from the 500 sample smoothed data, where the smoothing does not average in a blink
+    kernel_length = min(500, num_points-1)
+    smooth_data = forward_mean(data, kernel_length)
+    smooth_data[:, :kernel_length] = data[:, :kernel_length]
+    smooth_data[:, -kernel_length-1:] = data[:, -kernel_length-1:]
+    smooth_blinks = forward_count(blinks, kernel_length)
+    smooth_blinks[:, :kernel_length] = blinks[:, :kernel_length]
+    smooth_blinks[:, -kernel_length-1:] = blinks[:, -kernel_length-1:]
+    blinks |= (np.abs(smooth_data - data) > 1.5) & (smooth_blinks == 0)
+
+    # Changes greater than .4 over 4 samples between non-blink samples (all 5 samples are blinks)
+    # Note: Tested on the blinks before this rule, as in stublinks.m
+    start = ~blinks[:, :-5] & ~blinks[:, 4:-1] & (np.abs(data[:, 4:-1] - data[:, :-5]) > .4)
+    new_blinks = blinks.copy()
+    for offset in range(5):
+        new_blinks[:, offset:offset+start.shape[1]] |= start
+
+    return new_blinks
+
+def fill_blink_gaps(blinks: np.ndarray):
+    '''Fill the gaps between close blinks of a row (in place)
+    Note: Same result as the sequential stublinks.m loop, where a blink sample at t
+    fills up to t+10 (or t+4) if that sample is an original blink sample. Fills
+    always end on an original blink sample, so whole gaps are filled or kept.'''
+
+    num_points = blinks.size
+    last_start = num_points - 11
+
+    # Original blink samples (prefix counts) and blink runs
+    counts = np.concatenate([[0], np.cumsum(blinks)])
+    edges = np.diff(np.concatenate([[False], blinks, [False]]).astype(np.int8))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1) - 1
+
+    # Gaps between consecutive runs (left to right)
+    merged_start = run_starts[0] if run_starts.size else 0
+    for run_end, next_start in zip(run_ends[:-1], run_starts[1:]):
+
+        # Blink samples that can fill this gap: merged_start..run_end (up to last_start)
+        fill = False
+        last = min(run_end, last_start)
+        for reach in (10, 4):
+            low = max(merged_start + reach, next_start)
+            high = last + reach
+            if high >= low and counts[high+1] - counts[low] > 0:
+                fill = True
+                break
+
+        if fill:
+            blinks[run_end+1:next_start] = True
+        else:
+            merged_start = next_start
+
+# *********************
+# *** INTERPOLATION ***
+# *********************
+
+def smooth3(data: np.ndarray) -> np.ndarray:
+    '''3 sample smoothed data of stublinks.m (avgdata)'''
+
+    padded = np.pad(data, ((0, 0), (1, 1)))
+    smooth = (padded[:, :-2] + padded[:, 1:-1] + padded[:, 2:]) / 3
+    smooth[:, :10] = data[:, :10]
+    smooth[:, -11:] = data[:, -11:]
+
+    return smooth
+
+def interpolate_row(data: np.ndarray, smooth: np.ndarray, blinks: np.ndarray) -> np.ndarray:
+    '''Merge close blinks and interpolate the blinks of a row (blinks updated in place)
+    Returns the interpolated (unsmoothed) data'''
+
+    num_points = data.size
+
+    # Blink ends (last blink sample) and starts (last sample before the blink)
+    blink_ends = list(np.flatnonzero(blinks[:-1] & ~blinks[1:]))
+    blink_starts = list(np.flatnonzero(~blinks[:-1] & blinks[1:]))
+    if blinks[0]:
+        blink_starts.insert(0, 0)
+    if len(blink_ends) > len(blink_starts):
+        blink_ends = blink_ends[1:]
+    if len(blink_ends) < len(blink_starts):
+        blink_ends.append(num_points-1)
+
+    # Merge close blinks with big opposite slopes (3 rounds)
+    for _ in range(3):
+        for ct in range(len(blink_starts)-1):
+            if (blink_starts[ct+1] - blink_ends[ct] < 30 and data[blink_ends[ct]] - data[blink_starts[ct]] > .4 and
+                    data[blink_ends[ct+1]] - data[blink_starts[ct+1]] < .2):
+                blink_ends[ct] = blink_starts[ct]
+                blink_starts[ct+1] = blink_ends[ct]
+                blinks[blink_starts[ct]:blink_ends[ct+1]+1] = True
+
+    # Linear interpolation from 4 samples before to 9 samples after each blink
+    no_blinks = smooth.copy()
+    no_blinks_unsmoothed = data.copy()
+    for blink_start, blink_end in zip(blink_starts, blink_ends):
+        first = max(0, blink_start-4)
+        last = min(num_points-1, blink_end+9)
+        if last >= first:
+            values = np.linspace(smooth[first], smooth[last], last-first+1)
+            no_blinks[first:last+1] = values
+            no_blinks_unsmoothed[first:last+1] = values
+
+    # Blinks at the beginning: hold the first non-blink value
+    if np.any(blinks[:10]):
+        good = np.flatnonzero(~blinks)
+        first_good = good[0] if good.size else num_points-1
+        no_blinks[:first_good] = no_blinks[first_good]
+        no_blinks_unsmoothed[:first_good] = no_blinks[first_good]
+
+    # Blinks at the end: hold the last non-blink value
+    if np.any(blinks[-11:]):
+        blinks[-11:] = True
+        good = np.flatnonzero(~blinks)
+        if good.size == 0:
+            raise StublinksError('no samples without blinks')
+        last_good = good[-1]
+        no_blinks[last_good+1:] = no_blinks[last_good]
+        no_blinks_unsmoothed[last_good+1:] = no_blinks[last_good]
+
+    return no_blinks_unsmoothed
+
+# *****************
+# *** STUBLINKS ***
+# *****************
+
+def stublinks(data: np.ndarray, lowthresh: float = low_threshold) -> tuple:
+    '''Detect and interpolate blinks of each row (stublinks.m, lrtask = 0)
+    data: rows x samples pupil data (millimeter scale)
+    Returns (NoBlinksUnsmoothed, BlinkTimes, errors): errors is None or the failure reason of each row'''
+
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    num_rows, num_points = data.shape
+
+    no_blinks = np.full(data.shape, np.nan)
+    blinks = np.ones(data.shape, dtype=bool)
+    errors = [None] * num_rows
+
+    if num_points < min_stublinks_samples:
+        return no_blinks, blinks, ['too few samples (%d)' % num_points] * num_rows
+
+    # Rows with missing values
+    finite = np.all(np.isfinite(data), axis=1)
+    for row in np.flatnonzero(~finite):
+        errors[row] = 'non-finite samples'
+
+    # Detection (all rows at once)
+    rows = np.flatnonzero(finite)
+    row_blinks = detect_blinks(data[rows], lowthresh)
+    row_smooth = smooth3(data[rows])
+
+    # Gap filling and interpolation (each row)
+    for i, row in enumerate(rows):
+        try:
+            fill_blink_gaps(row_blinks[i])
+            no_blinks[row] = interpolate_row(data[row], row_smooth[i], row_blinks[i])
+            blinks[row] = row_blinks[i]
+        except StublinksError as error:
+            errors[row] = str(error)
+
+    return no_blinks, blinks, errors
+
+def stublinks60(data, sample_rate: int = 1000) -> tuple:
+    '''Stublinks60.m for a batch: downsample each row to 60 Hz, run stublinks, and upsample
+    data: rows x samples array or list of 1D recordings (any lengths; pupil scaled to stublinks units)
+    Returns (Stublinked, BlinkTimes, errors) as arrays (or lists for list input)'''
+
+    # Recordings of different lengths: batch by length
+    if isinstance(data, (list, tuple)):
+        outputs = [None] * len(data)
+        lengths = [len(recording) for recording in data]
+        for length in set(lengths):
+            index = [i for i, recording_length in enumerate(lengths) if recording_length == length]
+            stublinked, blink_times, errors = stublinks60(np.stack([data[i] for i in index]), sample_rate)
+            for j, i in enumerate(index):
+                outputs[i] = (stublinked[j], blink_times[j], errors[j])
+        return [output[0] for output in outputs], [output[1] for output in outputs], [output[2] for output in outputs]
+
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    num_samples = data.shape[1]
+    duration = num_samples / sample_rate
+
+    # Downsample to 60 Hz
+    downsampled = imresize(data, duration*stublinks_rate)
+
+    no_blinks, blinks, errors = stublinks(downsampled)
+
+    # Upsample (one resampling matrix for the pupil and the blinks)
+    upsample = resize_matrix(no_blinks.shape[1], int(np.ceil(duration*sample_rate)), duration*sample_rate/no_blinks.shape[1])
+    stublinked = imresize(no_blinks, duration*sample_rate, upsample)
+    blink_times = imresize_logical(blinks, duration*sample_rate, upsample)
+
+    # Failed rows (Stublinks60.m failure output)
+    for row, error in enumerate(errors):
+        if error is not None:
+            stublinked[row] = np.nan
+            blink_times[row] = True
+
+    return stublinked, blink_times, errors
+
+def deblink_recording(pupil: np.ndarray, sample_rate: int = 1000, segments=None) -> tuple:
+    '''Stublinks60 of a recording, optionally in separate segments (e.g., the recording blocks)
+    segments: (start, stop) sample ranges (default: the whole recording, as EyeLink_Subject_Analysis_v5.m)
+    Returns (Stublinked, BlinkTimes, failures): failures lists (start, stop, reason) of failed segments'''
+
+    pupil = np.asarray(pupil, dtype=np.float64)
+    if segments is None:
+        segments = [(0, pupil.size)]
+
+    stublinked = np.full(pupil.size, np.nan)
+    blink_times = np.ones(pupil.size, dtype=bool)
+    failures = []
+
+    segment_stublinked, segment_blinks, errors = stublinks60([pupil[start:stop] for start, stop in segments], sample_rate)
+    for (start, stop), values, blinks, error in zip(segments, segment_stublinked, segment_blinks, errors):
+        stublinked[start:stop] = values
+        blink_times[start:stop] = blinks
+        if error is not None:
+            failures.append((start, stop, error))
+
+    return stublinked, blink_times, failures
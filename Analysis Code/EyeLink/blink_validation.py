@@ -0,0 +1,343 @@
+# ***************************************
+# *** BLINK ENGINE VALIDATION HARNESS ***
+# ***************************************
+
+# Validates and benchmarks blink_engine.py against reference outputs:
+#
+# (1) A line-by-line Python translation of stublinks.m/Stublinks60.m (sample
+#     loops and conv as in MATLAB, and its own translation of imresize.m) on
+#     synthetic pupil recordings
+# (2) Optional MATLAB reference files, saved after running Stublinks60.m:
+#
+#     [Stublinked, BlinkTimes] = Stublinks60(pupil_data, 1000);
+#     save('reference_1.mat', 'pupil_data', 'Stublinked', 'BlinkTimes')
+#
+#   python blink_validation.py --recordings 10 --duration 600
+#   python blink_validation.py --reference reference_1.mat reference_2.mat
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from blink_engine import StublinksError, stublinks60, stublinks_rate
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Pupil tolerance (stublinks units) and blink sample agreement
+pupil_tolerance = 1e-6
+blink_agreement = 0.999
+
+# **************************
+# *** REFERENCE IMRESIZE ***
+# **************************
+
+# Note: Translated from MATLAB imresize.m independently of blink_engine.py (no shared code)
+
+def reference_cubic(x: np.ndarray) -> np.ndarray:
+    '''cubic kernel of imresize.m'''
+
+    absx = np.abs(x)
+    absx2 = absx**2
+    absx3 = absx**3
+
+    return (1.5*absx3 - 2.5*absx2 + 1) * (absx <= 1) + \
+        (-0.5*absx3 + 2.5*absx2 - 4*absx + 2) * ((1 < absx) & (absx <= 2))
+
+def reference_contributions(in_length: int, out_length: int, scale: float) -> tuple:
+    '''contributions of imresize.m (bicubic, antialiasing); returns (weights, 1-based indices)'''
+
+    kernel_width = 4
+    if scale < 1:
+        h = lambda x: scale * reference_cubic(scale * x)
+        kernel_width = kernel_width / scale
+    else:
+        h = reference_cubic
+
+    x = np.arange(1, out_length+1).reshape(-1, 1)
+    u = x/scale + 0.5 * (1 - 1/scale)
+    left = np.floor(u - kernel_width/2)
+    P = int(np.ceil(kernel_width)) + 2
+    indices = left + np.arange(P)
+    weights = h(u - indices)
+    weights = weights / np.sum(weights, axis=1, keepdims=True)
+    aux = np.concatenate([np.arange(1, in_length+1), np.arange(in_length, 0, -1)])
+    indices = aux[np.mod(indices.astype(np.int64) - 1, len(aux))]
+    kill = ~np.any(weights, axis=0)
+    if np.any(kill):
+        weights = weights[:, ~kill]
+        indices = indices[:, ~kill]
+
+    return weights, indices
+
+def reference_imresize(row: np.ndarray, out_length: float) -> np.ndarray:
+    '''imresize(row, [1 out_length]) of one row vector (resizeAlongDim of the columns)'''
+
+    row = np.asarray(row, dtype=np.float64)
+    weights, indices = reference_contributions(len(row), int(np.ceil(out_length)), out_length / len(row))
+
+    return np.sum(weights * row[indices - 1], axis=1)
+
+def reference_imresize_logical(row: np.ndarray, out_length: float) -> np.ndarray:
+    '''imresize of a logical row vector (uint8 0/255, rounded and saturated, then > 128)'''
+
+    resized = reference_imresize(255 * np.asarray(row, dtype=np.float64), out_length)
+    return np.round(np.clip(resized, 0, 255)) > 128
+
+# ***************************
+# *** REFERENCE STUBLINKS ***
+# ***************************
+
+def conv_tail(kernel_length: int, values: np.ndarray) -> np.ndarray:
+    '''Last samples of conv(ones(1,kernel_length)./kernel_length, values) (stublinks.m)'''
+
+    smooth = np.convolve(np.ones(kernel_length)/kernel_length, values)
+    return smooth[len(smooth)-len(values):]
+
+def reference_stublinks(data: np.ndarray, lowthresh: float = .1) -> tuple:
+    '''Line-by-line translation of stublinks.m (lrtask = 0); returns (NoBlinksUnsmoothed, BlinkTimes)'''
+
+    data = np.array(data, dtype=np.float64)
+    numpts = len(data)
+
+    # Smoothing
+    avgdata = np.convolve(np.ones(3)/3, data)[1:numpts+1]
+    avgdata[:10] = data[:10]
+    avgdata[numpts-11:] = data[numpts-11:]
+
+    # Changes greater than .5 in consecutive samples
+    blink_times = np.abs(np.append(data[1:], data[-1]) - data) > .5
+
+    # Data very different from the 30 sample smoothed data
+    smoothblinks = conv_tail(30, blink_times.astype(float))
+    smoothblinks[:100] = blink_times[:100]
+    smoothblinks[numpts-101:] = blink_times[numpts-101:]
+    smoothdata = conv_tail(30, data)
+    smoothdata[:100] = data[:100]
+    smoothdata[numpts-101:] = data[numpts-101:]
+    blink_times = blink_times | ((np.abs(smoothdata-data) > 1) & (smoothblinks == 0))
+
+    blink_times = blink_times | (data < lowthresh)
+    if np.max(blink_times) > 0:
+        blink_times = blink_times | (data < np.min(data) + .1)
+    blink_times = blink_times | (np.abs(data - np.median(data)) > 4)
+
+    quartiles = np.percentile(data, [25, 75], method='hazen')
+    iqr = quartiles[1] - quartiles[0]
+    blink_times = blink_times | (data < quartiles[0] - 1.5*iqr)
+    blink_times = blink_times | (data > quartiles[1] + 2.0*iqr)
+
+    # Data very different from the 500 sample smoothed data
+    kernallen = min(500, numpts-1)
+    smoothdata = conv_tail(kernallen, data)
+    smoothdata[:kernallen] = data[:kernallen]
+    smoothdata[numpts-kernallen-1:] = data[numpts-kernallen-1:]
+    smoothblinks = conv_tail(kernallen, blink_times.astype(float))
+    smoothblinks[:kernallen] = blink_times[:kernallen]
+    smoothblinks[numpts-kernallen-1:] = blink_times[numpts-kernallen-1:]
+    blink_times = blink_times | ((np.abs(smoothdata-data) > 1.5) & (smoothblinks == 0))
+
+    # .4 changes over 4 samples
+    newblinks = blink_times.copy()
+    for ct in range(numpts-5):
+        if not blink_times[ct] and not blink_times[ct+4] and abs(data[ct+4]-data[ct]) > .4:
+            newblinks[ct:ct+5] = True
+    blink_times = newblinks
+
+    # Gaps between close blinks
+    for ct in range(numpts-10):
+        if blink_times[ct] and blink_times[ct+10]:
+            blink_times[ct:ct+11] = True
+        if blink_times[ct] and blink_times[ct+4]:
+            blink_times[ct:ct+5] = True
+
+    no_blinks = avgdata.copy()
+    no_blinks_unsmoothed = data.copy()
+
+    # Blink starts and ends
+    blinkends = list(np.flatnonzero(blink_times[:-1] & ~blink_times[1:]))
+    blinkstarts = list(np.flatnonzero(blink_times[1:] & ~blink_times[:-1]))
+    if blink_times[0]:
+        blinkstarts = [0] + blinkstarts
+    if len(blinkends) > len(blinkstarts):
+        blinkends = blinkends[1:]
+    if len(blinkends) < len(blinkstarts):
+        blinkends.append(numpts-1)
+
+    # Merge close blinks
+    for roundnum in range(3):
+        for ct in range(len(blinkstarts)-1):
+            if ((blinkstarts[ct+1]-blinkends[ct]) < 30) and ((data[blinkends[ct]] - data[blinkstarts[ct]]) > .4) and \
+                    ((data[blinkends[ct+1]] - data[blinkstarts[ct+1]]) < .2):
+                blinkends[ct] = blinkstarts[ct]
+                blinkstarts[ct+1] = blinkends[ct]
+                blink_times[blinkstarts[ct]:blinkends[ct+1]+1] = True
+
+    # Interpolation
+    for ct in range(len(blinkstarts)):
+        firstindex = max(0, blinkstarts[ct]-4)
+        lastindex = min(numpts-1, blinkends[ct]+9)
+        interpdata = np.linspace(avgdata[firstindex], avgdata[lastindex], max(1, lastindex-firstindex+1))
+        if lastindex >= firstindex:
+            no_blinks[firstindex:lastindex+1] = interpdata
+            no_blinks_unsmoothed[firstindex:lastindex+1] = interpdata
+
+    # Blinks at the beginning
+    if np.max(blink_times[:10]):
+        goodct = np.arange(1, numpts+1) + 10000000*blink_times
+        mingood = min(np.min(goodct), numpts)
+        no_blinks[:mingood-1] = no_blinks[mingood-1]
+        no_blinks_unsmoothed[:mingood-1] = no_blinks[mingood-1]
+
+    # Blinks at the end
+    if np.max(blink_times[numpts-11:]):
+        blink_times[numpts-11:] = True
+        goodct = np.arange(1, numpts+1) - 9999999*blink_times
+        maxgood = np.max(goodct)
+        if maxgood < 1:
+            raise StublinksError('no samples without blinks')
+        no_blinks[maxgood:] = no_blinks[maxgood-1]
+        no_blinks_unsmoothed[maxgood:] = no_blinks[maxgood-1]
+
+    return no_blinks_unsmoothed, blink_times
+
+def reference_stublinks60(data: np.ndarray, sample_rate: int = 1000) -> tuple:
+    '''Translation of Stublinks60.m for one recording; returns (Stublinked, BlinkTimes)'''
+
+    duration = len(data) / sample_rate
+    current_trial = reference_imresize(data, duration*stublinks_rate)
+
+    try:
+        no_blinks, blink_times = reference_stublinks(current_trial)
+        return (reference_imresize(no_blinks, duration*sample_rate),
+                reference_imresize_logical(blink_times, duration*sample_rate))
+    except (StublinksError, IndexError, ValueError):
+        return np.full(round(duration*sample_rate), np.nan), np.ones(round(duration*sample_rate), dtype=bool)
+
+# ****************************
+# *** SYNTHETIC RECORDINGS ***
+# ****************************
+
+def synthetic_pupil(rng: np.random.Generator, duration: float, sample_rate: int = 1000) -> np.ndarray:
+    '''Synthetic pupil area recording (EyeLink units / 1000) with blinks, tracking loss, and noise'''
+
+    num_samples = int(duration * sample_rate)
+    t = np.arange(num_samples) / sample_rate
+
+    # Slow drift, task-related dilations, and noise
+    pupil = 3 + 0.3*np.sin(2*np.pi*t/97) + 0.2*np.sin(2*np.pi*t/11 + rng.uniform(0, 2*np.pi))
+    pupil += np.cumsum(rng.normal(0, 0.002, num_samples))
+    pupil += rng.normal(0, 0.01, num_samples)
+
+    # Blinks (about every 4 s, 100-400 ms, with closing and opening ramps)
+    blink_times = np.cumsum(rng.exponential(4, int(duration/2) + 1))
+    for blink_time in blink_times[blink_times < duration]:
+        start = int(blink_time * sample_rate)
+        length = int(rng.uniform(0.1, 0.4) * sample_rate)
+        ramp = int(0.03 * sample_rate)
+        pupil[start:start+length] = 0
+        pupil[max(0, start-ramp):start] *= np.linspace(1, 0.3, len(pupil[max(0, start-ramp):start]))
+
+    # Occasional tracking artifacts
+    for artifact_time in rng.uniform(0, duration, int(duration/120)):
+        start = int(artifact_time * sample_rate)
+        pupil[start:start+20] += rng.choice([-1, 1]) * 2
+
+    return pupil
+
+# ******************
+# *** VALIDATION ***
+# ******************
+
+def compare(stublinked: np.ndarray, blink_times: np.ndarray, reference: tuple) -> tuple:
+    '''Max pupil difference and blink sample agreement with a reference output'''
+
+    reference_stublinked, reference_blinks = reference
+    both_nan = np.isnan(stublinked) & np.isnan(reference_stublinked)
+    difference = np.abs(stublinked - reference_stublinked)
+    max_difference = np.max(np.where(both_nan, 0, difference), initial=0)
+    agreement = np.mean(np.asarray(blink_times, dtype=bool) == np.asarray(reference_blinks, dtype=bool))
+
+    return max_difference, agreement
+
+def validate_synthetic(num_recordings: int, duration: float, seed: int) -> bool:
+    '''Validate and benchmark the engine against the Python reference on synthetic recordings'''
+
+    rng = np.random.default_rng(seed)
+    recordings = np.stack([synthetic_pupil(rng, duration) for _ in range(num_recordings)])
+
+    # Reference (one recording at a time)
+    start = time.perf_counter()
+    references = [reference_stublinks60(recording) for recording in recordings]
+    reference_duration = time.perf_counter() - start
+
+    # Engine (batch)
+    start = time.perf_counter()
+    stublinked, blink_times, errors = stublinks60(recordings)
+    engine_duration = time.perf_counter() - start
+
+    passed = True
+    for i, reference in enumerate(references):
+        max_difference, agreement = compare(stublinked[i], blink_times[i], reference)
+        ok = max_difference <= pupil_tolerance and agreement >= blink_agreement
+        passed &= ok
+        print('Recording %d: max pupil difference %.2e, blink agreement %.5f, %.1f%% blinks%s%s' %
+              (i+1, max_difference, agreement, np.mean(blink_times[i])*100,
+               '' if errors[i] is None else ' (failed: %s)' % errors[i], '' if ok else ' MISMATCH'))
+
+    print('%d x %.0f s recordings: reference %.2f s, engine %.2f s (%.1fx faster)' %
+          (num_recordings, duration, reference_duration, engine_duration, reference_duration/engine_duration))
+
+    return passed
+
+def validate_reference_files(filenames: list) -> bool:
+    '''Validate the engine against MATLAB Stublinks60.m outputs'''
+
+    from scipy.io import loadmat
+
+    passed = True
+    for filename in filenames:
+
+        reference = loadmat(filename, squeeze_me=True)
+        pupil_data = np.asarray(reference['pupil_data'], dtype=np.float64)
+
+        start = time.perf_counter()
+        stublinked, blink_times, errors = stublinks60(pupil_data)
+        engine_duration = time.perf_counter() - start
+
+        max_difference, agreement = compare(stublinked[0], blink_times[0], (reference['Stublinked'], reference['BlinkTimes']))
+        ok = max_difference <= pupil_tolerance and agreement >= blink_agreement
+        passed &= ok
+        print('%s: max pupil difference %.2e, blink agreement %.5f (%.2f s)%s' %
+              (filename, max_difference, agreement, engine_duration, '' if ok else ' MISMATCH'))
+
+    return passed
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Validate and benchmark the blink engine')
+    parser.add_argument('--recordings', type=int, default=10, help='number of synthetic recordings')
+    parser.add_argument('--duration', type=float, default=600, help='synthetic recording duration (s)')
+    parser.add_argument('--seed', type=int, default=0, help='synthetic recording random seed')
+    parser.add_argument('--reference', nargs='*', default=[], help='MATLAB Stublinks60 reference .mat files')
+    options = parser.parse_args()
+
+    passed = validate_synthetic(options.recordings, options.duration, options.seed)
+    if options.reference:
+        passed &= validate_reference_files(options.reference)
+
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+# ******************************
+# *** HIERARCHICAL BOOTSTRAP ***
+# ******************************
+
+# Bootstrap confidence bands of group mean timecourses (pupil, blink, microsaccade),
+# resampling subjects and then the trials of each drawn subject (two-stage bootstrap).
+# The group mean is the mean of the subject means, as in EyeLink_Group_Analysis_v2.m.
+#
+# Each block of bootstrap replicates is drawn as resample counts (replicates x trials)
+# and the replicate means are a single matrix product of the counts with the trials.
+# The timecourse is split into time chunks processed on several processes (the same
+# resample counts in every chunk), so the memory is bounded by the chunk size, not by
+# the number of replicates times the epoch length. Pointwise (percentile) and
+# simultaneous (studentized maximum) bands are returned.
+#
+#   from bootstrap import hierarchical_bootstrap
+#   bands = hierarchical_bootstrap([subject_1_epochs, subject_2_epochs, ...], workers=8)
+#   bands['pointwise_lower'], bands['simultaneous_upper']
+#
+# On the pipeline epoch stores (one band per visual field category):
+#
+#   python bootstrap.py cohort.json --work-dir <pipeline folder> --events glare --signal pupil --output glare_pupil.npz
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import json
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pipeline import field_category, load_epochs, movmean, session_id
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Bootstrap replicates and confidence level
+num_replicates = 2000
+confidence = 0.95
+
+# Replicates drawn per block (block counts are replicates x trials)
+block_size = 200
+
+# Memory of the replicate timecourses of one time chunk (bytes per process)
+max_chunk_bytes = 256 * 1024**2
+
+# Smoothing of blink/saccade/microsaccade timecourses (as the group analysis)
+blink_saccade_smoothing_span = 100
+
+# Stimulus sides
+side_types = ('left', 'right')
+
+# ******************
+# *** RESAMPLING ***
+# ******************
+
+def resample_counts(rng: np.random.Generator, trial_counts: list, num_blocks: int) -> np.ndarray:
+    '''Two-stage resample weights of a block of replicates (replicates x trials of all subjects)
+    Subjects are drawn with replacement; each draw of a subject draws its trials with replacement. The weight
+    of a trial is its draw count divided by the subject trial count, so weights @ trials = sum of subject means'''
+
+    num_subjects = len(trial_counts)
+    subject_draws = rng.multinomial(num_subjects, np.full(num_subjects, 1 / num_subjects), size=num_blocks)
+
+    # Note: A subject drawn k times has k independent trial resamples, i.e., k * n trial draws
+    weights = [rng.multinomial(subject_draws[:, subject] * count, np.full(count, 1 / count)) / count
+               for subject, count in enumerate(trial_counts)]
+
+    return np.concatenate(weights, axis=1)
+
+def replicate_means(weights: np.ndarray, trials: np.ndarray, valid: np.ndarray = None,
+                    subject_index: np.ndarray = None, num_subjects: int = None) -> np.ndarray:
+    '''Group means of a block of replicates (replicates x time points)
+    trials: trials of all subjects x time points (NaN replaced with 0 if valid is given)
+    valid: non-NaN trial samples (only needed if some trials have NaN samples)'''
+
+    if valid is None:
+        return (weights @ trials) / num_subjects
+
+    # Note: With NaN samples, each subject mean is the weighted mean of its valid samples
+    group_sum = np.zeros((weights.shape[0], trials.shape[1]))
+    subject_count = np.zeros_like(group_sum)
+    for subject in range(num_subjects):
+        members = subject_index == subject
+        draws = weights[:, members].sum(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            subject_mean = (weights[:, members] @ trials[members]) / (weights[:, members] @ valid[members])
+        drawn = np.isfinite(subject_mean) & (draws > 0)
+        group_sum += np.where(drawn, subject_mean * draws, 0)
+        subject_count += np.where(drawn, draws, 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return group_sum / subject_count
+
+def _bootstrap_chunk(task: tuple) -> tuple:
+    '''Bootstrap statistics of one time chunk
+    Returns the pointwise percentiles, bootstrap standard errors, and each replicate's largest studentized
+    deviation within the chunk'''
+
+    trials, trial_counts, estimate, trim, options = task
+    num_subjects = len(trial_counts)
+    subject_index = np.repeat(np.arange(num_subjects), trial_counts)
+
+    valid = None
+    if np.isnan(trials).any():
+        valid = (~np.isnan(trials)).astype(np.float64)
+        trials = np.nan_to_num(trials)
+
+    # Replicate blocks (seeded by block, so every chunk uses the same resamples)
+    replicates = []
+    for block, start in enumerate(range(0, options['num_replicates'], options['block_size'])):
+        rng = np.random.default_rng([options['seed'], block])
+        weights = resample_counts(rng, trial_counts, min(options['block_size'], options['num_replicates'] - start))
+        means = replicate_means(weights, trials, valid, subject_index, num_subjects)
+        if options['smoothing_span']:
+            means = movmean(means, options['smoothing_span'])
+        replicates.append(means[:, trim[0]:means.shape[1] - trim[1]])
+    replicates = np.concatenate(replicates)
+
+    # Pointwise percentile band and bootstrap standard error
+    alpha = 1 - options['confidence']
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        lower, upper = np.nanpercentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        standard_error = np.nanstd(replicates, axis=0, ddof=1)
+
+    # Largest studentized deviation of each replicate (time points without variability are skipped)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation = np.abs(replicates - estimate) / standard_error
+    deviation[:, ~(standard_error > 0)] = 0
+    max_deviation = np.max(np.nan_to_num(deviation, nan=0.0), axis=1, initial=0)
+
+    return lower, upper, standard_error, max_deviation
+
+# *****************
+# *** BOOTSTRAP ***
+# *****************
+
+def hierarchical_bootstrap(subject_trials: list, replicates: int = num_replicates, level: float = confidence,
+                           smoothing_span: int = None, workers: int = 1, seed=None,
+                           chunk_bytes: int = max_chunk_bytes) -> dict:
+    '''Subject -> trial bootstrap bands of the group mean timecourse
+    subject_trials: one trials x time points array per subject (NaN trials are removed)
+    smoothing_span: moving mean span of the subject means (None = no smoothing)
+    Returns the estimate, SEM across subjects, bootstrap standard error, pointwise and simultaneous bands'''
+
+    # Trials of all subjects (removed epochs dropped)
+    subject_trials = [np.asarray(trials, dtype=np.float64) for trials in subject_trials]
+    subject_trials = [trials[~np.all(np.isnan(trials), axis=1)] for trials in subject_trials]
+    subject_trials = [trials for trials in subject_trials if len(trials)]
+    if not subject_trials:
+        raise ValueError('No subject has trials')
+    trial_counts = [len(trials) for trials in subject_trials]
+    trials = np.concatenate(subject_trials)
+    num_points = trials.shape[1]
+
+    # Estimate: mean of the subject means (smoothed), and SEM across subjects (as the group analysis)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        subject_means = np.array([np.nanmean(subject, axis=0) for subject in subject_trials])
+        if smoothing_span:
+            subject_means = movmean(subject_means, smoothing_span)
+        estimate = np.nanmean(subject_means, axis=0)
+        sem = np.nanstd(subject_means, axis=0, ddof=1) / np.sqrt(len(subject_means))
+
+    # Time chunks (with the smoothing window as overlap, so smoothing matches the whole timecourse)
+    # Note: The seed is fixed before the chunks are split, so all chunks draw the same resamples
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1)[0])
+    options = {'num_replicates': replicates, 'block_size': block_size, 'smoothing_span': smoothing_span,
+               'confidence': level, 'seed': seed}
+    chunk_size = int(max(chunk_bytes // (8 * (replicates + block_size)), 1))
+    halo = (smoothing_span // 2 + 1) if smoothing_span else 0
+    tasks = []
+    for start in range(0, num_points, chunk_size):
+        stop = min(start + chunk_size, num_points)
+        low, high = max(start - halo, 0), min(stop + halo, num_points)
+        tasks.append((trials[:, low:high], trial_counts, estimate[start:stop], (start - low, high - stop), options))
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_bootstrap_chunk, tasks))
+    else:
+        results = [_bootstrap_chunk(task) for task in tasks]
+
+    lower, upper, standard_error = (np.concatenate(parts) for parts in list(zip(*results))[:3])
+
+    # Simultaneous band: critical value of the largest studentized deviation over the whole timecourse
+    max_deviation = np.max([result[3] for result in results], axis=0)
+    critical_value = np.quantile(max_deviation, level)
+
+    return {'estimate': estimate, 'sem': sem, 'standard_error': standard_error,
+            'pointwise_lower': lower, 'pointwise_upper': upper,
+            'simultaneous_lower': estimate - critical_value * standard_error,
+            'simultaneous_upper': estimate + critical_value * standard_error,
+            'critical_value': critical_value, 'subjects': len(trial_counts), 'trials': int(sum(trial_counts))}
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Hierarchical bootstrap bands of group timecourses (pipeline epoch stores)')
+    parser.add_argument('cohort', help='cohort file (JSON)')
+    parser.add_argument('--work-dir', default='pipeline_output', help='pipeline output folder')
+    parser.add_argument('--events', nargs='+', required=True,
+                        help='event types combined per subject (e.g., glare, or glare nonglare white iso)')
+    parser.add_argument('--signal', default='pupil', help='pupil, blink, saccade, or microsaccade')
+    parser.add_argument('--group', help='subject group (default: all subjects)')
+    parser.add_argument('--replicates', type=int, default=num_replicates)
+    parser.add_argument('--confidence', type=float, default=confidence)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', required=True, help='results file (.npz)')
+    options = parser.parse_args()
+
+    with open(options.cohort) as cohort_file:
+        cohort = json.load(cohort_file)
+
+    # Subject epochs by visual field category (sessions and event types combined)
+    category_trials = {}
+    for subject in cohort['subjects']:
+        if options.group is not None and subject.get('group') != options.group:
+            continue
+        for side in side_types:
+            epochs = [load_epochs(os.path.join(options.work_dir, session_id(subject, session), 'epochs'),
+                                  '%s_%s' % (event_type, side), options.signal)
+                      for session in subject['sessions'] for event_type in options.events]
+            category_trials.setdefault(field_category(subject, side), []).append(np.concatenate(epochs))
+
+    # Note: Pupil means are not smoothed, as in the group analysis
+    smoothing_span = None if options.signal == 'pupil' else blink_saccade_smoothing_span
+    results = {}
+    for category, subject_trials in category_trials.items():
+        bands = hierarchical_bootstrap(subject_trials, options.replicates, options.confidence, smoothing_span,
+                                       options.workers, options.seed)
+        print('%s: %d subjects, %d trials, simultaneous critical value %.2f' % (category, bands['subjects'],
+                                                                               bands['trials'], bands['critical_value']))
+        results.update({'%s_%s' % (category, name): value for name, value in bands.items()})
+
+    # Note: Epochs are centered on the event (as the pipeline epoch stores)
+    num_points = len(bands['estimate'])
+    results['time'] = np.arange(num_points) - (num_points - 1) // 2
+    np.savez(options.output, **results)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,458 @@
+# ************************
+# *** STACKED DECODING ***
+# ************************
+
+# Two-layer (stacked) linear SVM classification of stimulus vs. ISI epochs, as in
+# Machine_Learning_Subject_Level_Layered.m: for each subject, stimulus side, and
+# comparison, a standardized linear SVM per eye metric (pupil, blink, microsaccade)
+# is trained in each of 10 folds (layer 0), and a linear SVM on the out-of-fold
+# layer 0 scores is cross-validated with the same folds (layer 1). Outputs are the
+# accuracy, chance level, PPV, NPV, ROC curve, and ROC AUC.
+#
+# Feature matrices are built once per subject, side, and comparison from the pipeline
+# epoch store and cached (keyed by the epoch task keys), and the layer 0 folds of all
+# subjects run on a process pool. The SVMs are solved in their dual form on Gram
+# matrices (same solution as fitcsvm, up to the solver tolerance):
+#
+#   python decoding.py cohort.json --work-dir <pipeline folder> --output-dir <folder> --workers 8
+#
+# Subjects with a "blind_side" ("left" or "right") and "aware" (true/false) in the
+# cohort file are summarized by blind/sighted field (and blind field awareness);
+# other subjects are summarized by side.
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pipeline import field_category, session_id
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Query interval (samples relative to the event; MATLAB query_interval = 9001:13000)
+query_interval = (0, 4000)
+
+# Eye metrics (features, one layer 0 model each)
+eye_types = ('pupil', 'blink', 'microsaccade')
+
+# Comparisons: class 1 and class 2 event types (without the side)
+comparisons = {
+    'Distractor_vs_ISI_Distractor': (('distractor',), ('ISI_distractor',)),
+    'Glare_Nonglare_White_Iso_vs_ISI': (('glare', 'nonglare', 'white', 'iso'),
+                                        ('ISI_glare', 'ISI_nonglare', 'ISI_white', 'ISI_iso')),
+}
+
+# Stimulus sides
+side_types = ('left', 'right')
+
+# Cross-validation folds
+num_folds = 10
+
+# SVM parameters (fitcsvm default box constraint)
+box_constraint = 1.0
+kkt_tolerance = 1e-3
+iteration_limit = 100000
+
+# Ridge added to the free coefficient system (relative to the mean Gram diagonal)
+# Note: Keeps the Newton steps defined when the Gram matrix is singular (e.g., centered features)
+ridge_factor = 1e-10
+
+# Feature cache version
+# Note: Part of the cache key, so cached features are rebuilt when the features change
+feature_version = 1
+
+# ******************
+# *** LINEAR SVM ***
+# ******************
+
+def train_svm(gram: np.ndarray, labels: np.ndarray, box: float = box_constraint,
+              tolerance: float = kkt_tolerance) -> tuple:
+    '''Dual linear SVM from a Gram matrix (active set method)
+    gram: trials x trials; labels: 1 (class 1) or -1 (class 2)
+    Returns the dual coefficients (alpha * label) and the bias
+    Note: The free (non-bound) coefficients are solved exactly at each step, so the number of steps does not
+    depend on the conditioning of the Gram matrix (unlike SMO on correlated pupil samples)'''
+
+    num_trials = len(labels)
+    labels = labels.astype(np.float64)
+
+    # One class only: constant prediction of that class
+    if np.all(labels == labels[0]):
+        return np.zeros(num_trials), float(labels[0])
+
+    hessian = gram * np.outer(labels, labels)
+    ridge = ridge_factor * max(np.mean(np.diag(gram)), 1e-12)
+    alpha = np.zeros(num_trials)
+    free = np.zeros(num_trials, dtype=bool)
+    at_box = np.zeros(num_trials, dtype=bool)
+    bias = 0.0
+
+    for _ in range(iteration_limit):
+        gradient = hessian @ alpha - 1
+        free_index = np.flatnonzero(free)
+
+        if len(free_index):
+
+            # Newton step on the free coefficients (keeping sum(alpha * label) = 0); the multiplier is the bias
+            size = len(free_index)
+            system = np.zeros((size + 1, size + 1))
+            system[:size, :size] = hessian[np.ix_(free_index, free_index)] + ridge * np.eye(size)
+            system[:size, size] = system[size, :size] = labels[free_index]
+            try:
+                solution = np.linalg.solve(system, np.r_[-gradient[free_index], 0])
+            except np.linalg.LinAlgError:
+                solution = np.linalg.lstsq(system, np.r_[-gradient[free_index], 0], rcond=None)[0]
+            step, bias = solution[:size], solution[size]
+
+            if np.max(np.abs(step)) > 1e-10 * box:
+
+                # Largest step within the box
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    limits = np.where(step > 0, (box - alpha[free_index]) / step,
+                                      np.where(step < 0, -alpha[free_index] / step, np.inf))
+                blocking = np.argmin(limits)
+                length = min(1.0, limits[blocking])
+                alpha[free_index] = np.clip(alpha[free_index] + length * step, 0, box)
+
+                # The blocking coefficient becomes bound
+                if length < 1:
+                    index = free_index[blocking]
+                    alpha[index] = box if step[blocking] > 0 else 0
+                    free[index] = False
+                    at_box[index] = step[blocking] > 0
+                continue
+
+        else:
+            bias = _bias(alpha, labels, gradient, box)
+
+        # KKT conditions of the bound coefficients: margin >= 1 at 0, margin <= 1 at the box constraint
+        reduced_gradient = gradient + bias * labels
+        violation = np.where(at_box, reduced_gradient, -reduced_gradient)
+        violation[free] = 0
+        worst = np.argmax(violation)
+        if violation[worst] < tolerance:
+            break
+
+        # Release the most violating coefficient
+        free[worst] = True
+        at_box[worst] = False
+
+    return alpha * labels, _bias(alpha, labels, hessian @ alpha - 1, box)
+
+def _bias(alpha: np.ndarray, labels: np.ndarray, gradient: np.ndarray, box: float) -> float:
+    '''SVM bias: mean over the free support vectors, or the middle of the interval allowed by the bound
+    coefficients without free support vectors (as LIBSVM)'''
+
+    margin = -labels * gradient
+    free = (alpha > 1e-12 * box) & (alpha < box * (1 - 1e-12))
+    if free.any():
+        return float(np.mean(margin[free]))
+
+    # Coefficients at 0 bound the bias from one side and coefficients at the box constraint from the other
+    at_box = alpha >= box * (1 - 1e-12)
+    lower = np.max(margin[at_box != (labels > 0)], initial=-np.inf)
+    upper = np.min(margin[at_box == (labels > 0)], initial=np.inf)
+    if np.isfinite(lower) and np.isfinite(upper):
+        return float((lower + upper) / 2)
+    return float(lower if np.isfinite(lower) else upper)
+
+def standardize(features: np.ndarray, train: np.ndarray, total: np.ndarray, total_squares: np.ndarray) -> np.ndarray:
+    '''Standardize features with the mean and standard deviation of the training trials (as fitcsvm Standardize)
+    total/total_squares: column sums of all trials, so only the held-out trials are summed per fold
+    Note: Constant features are only centered (standard deviation 1)'''
+
+    held_out = features[~train]
+    num_train = np.count_nonzero(train)
+    mean = (total - np.sum(held_out, axis=0)) / num_train
+    variance = (total_squares - np.sum(held_out**2, axis=0)) / num_train - mean**2
+    deviation = np.sqrt(np.maximum(variance, 0))
+    deviation[deviation < 1e-12 * np.maximum(np.abs(mean), 1)] = 1
+
+    return (features - mean) / deviation
+
+def svm_scores(gram: np.ndarray, labels: np.ndarray, train: np.ndarray) -> np.ndarray:
+    '''Train an SVM on the training trials of a Gram matrix (all trials) and score the held-out trials
+    Returns the class 1 scores of the held-out trials'''
+
+    coefficients, bias = train_svm(gram[np.ix_(train, train)], labels[train])
+
+    return gram[np.ix_(~train, train)] @ coefficients + bias
+
+# ************************
+# *** CROSS-VALIDATION ***
+# ************************
+
+def stratified_folds(classes: np.ndarray, num_folds: int, rng: np.random.Generator) -> np.ndarray:
+    '''Fold of each trial, with the class proportions kept in every fold (as cvpartition KFold)'''
+
+    folds = np.zeros(len(classes), dtype=np.int64)
+    offset = 0
+    for class_value in np.unique(classes):
+        members = rng.permutation(np.flatnonzero(classes == class_value))
+        # Note: Folds continue from the previous class, so small folds are filled evenly
+        folds[members] = (np.arange(len(members)) + offset) % num_folds
+        offset += len(members)
+
+    return folds
+
+def _layer_0_fold(task: tuple) -> np.ndarray:
+    '''Layer 0 class 1 scores of the held-out trials of one fold (held-out trials x eye types)'''
+
+    feature_filename, folds, fold = task
+    with np.load(feature_filename) as data:
+        features, classes, eye_type_index = data['features'], data['classes'], data['eye_type_index']
+    labels = np.where(classes == 1, 1, -1)
+    train = folds != fold
+
+    scores = np.zeros((np.count_nonzero(~train), eye_type_index.max() + 1))
+    for eye in range(scores.shape[1]):
+        eye_features = features[:, eye_type_index == eye]
+
+        # Note: One Gram matrix of all trials gives both the training kernel and the held-out kernel
+        standardized = standardize(eye_features, train, np.sum(eye_features, axis=0), np.sum(eye_features**2, axis=0))
+        scores[:, eye] = svm_scores(standardized @ standardized.T, labels, train)
+
+    return scores
+
+def layer_1(layer_0_scores: np.ndarray, classes: np.ndarray, folds: np.ndarray) -> tuple:
+    '''Cross-validated layer 1 SVM on the layer 0 scores (not standardized, as in the MATLAB analysis)
+    Returns the predicted classes and class 1 scores'''
+
+    labels = np.where(classes == 1, 1, -1)
+
+    # Note: The layer 1 Gram matrix is computed once and shared by all folds
+    gram = layer_0_scores @ layer_0_scores.T
+    scores = np.zeros(len(classes))
+    for fold in np.unique(folds):
+        train = folds != fold
+        scores[~train] = svm_scores(gram, labels, train)
+
+    return np.where(scores > 0, 1, 2), scores
+
+# ***************
+# *** METRICS ***
+# ***************
+
+def roc_curve(classes: np.ndarray, scores: np.ndarray, positive_class: int = 1) -> tuple:
+    '''ROC curve (false positive rate, true positive rate, thresholds) and AUC (as perfcurve)'''
+
+    order = np.argsort(-scores, kind='stable')
+    positive = classes[order] == positive_class
+
+    # Points at each distinct threshold
+    last = np.flatnonzero(np.append(np.diff(scores[order]) != 0, True))
+    true_positives = np.cumsum(positive)[last]
+    false_positives = np.cumsum(~positive)[last]
+
+    true_positive_rate = np.r_[0, true_positives] / max(np.count_nonzero(positive), 1)
+    false_positive_rate = np.r_[0, false_positives] / max(np.count_nonzero(~positive), 1)
+    thresholds = np.r_[np.inf, scores[order][last]]
+
+    return false_positive_rate, true_positive_rate, thresholds, float(np.trapz(true_positive_rate, false_positive_rate))
+
+def classification_metrics(classes: np.ndarray, predicted: np.ndarray, scores: np.ndarray) -> dict:
+    '''Accuracy, chance level, PPV, NPV, and ROC AUC (class 1 is the positive class)'''
+
+    def ratio(count, total):
+        return count / total if total else np.nan
+
+    correct = predicted == classes
+    return {'accuracy': ratio(np.count_nonzero(correct), len(classes)),
+            'chance': ratio(np.count_nonzero(classes == 1), len(classes)),
+            'PPV': ratio(np.count_nonzero(correct & (predicted == 1)), np.count_nonzero(predicted == 1)),
+            'NPV': ratio(np.count_nonzero(correct & (predicted == 2)), np.count_nonzero(predicted == 2)),
+            'AUC': roc_curve(classes, scores)[3],
+            'trials': len(classes)}
+
+# ****************
+# *** FEATURES ***
+# ****************
+
+def epoch_task_key(epoch_dir: str) -> str:
+    '''Pipeline task key of an epoch store'''
+
+    with open(os.path.join(epoch_dir, 'task.json')) as task_file:
+        return json.load(task_file)['key']
+
+def build_features(epoch_dirs: list, comparison: str, side: str) -> tuple:
+    '''Feature matrix of a subject (trials x eye types * query samples), trial classes (1 or 2), and the eye
+    type of each feature column; trials with NaN values in any eye type are removed'''
+
+    blocks, classes = [], []
+    for class_value, event_types in enumerate(comparisons[comparison], 1):
+        for event_type in event_types:
+            event_features = []
+            for eye_type in eye_types:
+
+                # All sessions of the subject
+                epochs = []
+                for epoch_dir in epoch_dirs:
+                    data = np.load(os.path.join(epoch_dir, '%s_%s_%s.npy' % (event_type, side, eye_type)), mmap_mode='r')
+                    event_sample = (data.shape[1] - 1) // 2
+                    epochs.append(np.asarray(data[:, event_sample + query_interval[0]:event_sample + query_interval[1]],
+                                             dtype=np.float64))
+                event_features.append(np.concatenate(epochs))
+
+            blocks.append(np.concatenate(event_features, axis=1))
+            classes.append(np.full(len(blocks[-1]), class_value))
+
+    features = np.concatenate(blocks)
+    classes = np.concatenate(classes)
+    eye_type_index = np.repeat(np.arange(len(eye_types)), query_interval[1] - query_interval[0])
+
+    # Note: Trials are removed if any eye type is NaN, as in the MATLAB analysis
+    keep = ~np.isnan(features).any(axis=1)
+
+    return features[keep], classes[keep], eye_type_index
+
+def cached_features(epoch_dirs: list, comparison: str, side: str, cache_dir: str) -> str:
+    '''Filename of the cached feature matrix of a subject (built if the epoch stores changed)'''
+
+    key = hashlib.sha256(json.dumps([feature_version, [epoch_task_key(epoch_dir) for epoch_dir in epoch_dirs],
+                                     comparison, side, query_interval, eye_types]).encode()).hexdigest()
+    cache_filename = os.path.join(cache_dir, key + '.npz')
+    if os.path.isfile(cache_filename):
+        return cache_filename
+
+    features, classes, eye_type_index = build_features(epoch_dirs, comparison, side)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_filename = cache_filename + '.%d.tmp' % os.getpid()
+    with open(temp_filename, 'wb') as cache_file:
+        np.savez(cache_file, features=features, classes=classes, eye_type_index=eye_type_index)
+    os.replace(temp_filename, cache_filename)
+
+    return cache_filename
+
+# ****************
+# *** DECODING ***
+# ****************
+
+def decode_cohort(cohort: dict, work_dir: str, output_dir: str, comparison_names: list = None, workers: int = 1,
+                  seed: int = 0, log=print) -> dict:
+    '''Stacked SVM decoding of every subject, side, and comparison
+    Returns {comparison: {"subjects": [...], "groups": {category: {metric: [...]}}}}'''
+
+    comparison_names = comparison_names or list(comparisons)
+    cache_dir = os.path.join(output_dir, 'features')
+
+    # Jobs: subject, side, and comparison with cached features and folds
+    jobs = []
+    for subject in cohort['subjects']:
+        epoch_dirs = [os.path.join(work_dir, session_id(subject, session), 'epochs') for session in subject['sessions']]
+        for comparison in comparison_names:
+            for side in side_types:
+                feature_filename = cached_features(epoch_dirs, comparison, side, cache_dir)
+                with np.load(feature_filename) as data:
+                    classes = data['classes']
+
+                # Note: Folds are seeded by the job, so results do not depend on the order or number of processes
+                rng = np.random.default_rng([seed, zlib.crc32(('%s_%s_%s' % (subject['id'], comparison, side)).encode())])
+                folds = stratified_folds(classes, num_folds, rng)
+                jobs.append({'subject': subject, 'comparison': comparison, 'side': side, 'features': feature_filename,
+                             'classes': classes, 'folds': folds})
+
+    # Layer 0: all folds of all jobs
+    tasks = [(job['features'], job['folds'], fold) for job in jobs for fold in np.unique(job['folds'])]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fold_scores = list(executor.map(_layer_0_fold, tasks))
+    else:
+        fold_scores = [_layer_0_fold(task) for task in tasks]
+
+    # Layer 1 and metrics
+    results = {comparison: {'subjects': [], 'groups': {}} for comparison in comparison_names}
+    fold_scores = iter(fold_scores)
+    for job in jobs:
+        folds, classes = job['folds'], job['classes']
+        layer_0_scores = np.zeros((len(classes), len(eye_types)))
+        for fold in np.unique(folds):
+            layer_0_scores[folds == fold] = next(fold_scores)
+
+        predicted, scores = layer_1(layer_0_scores, classes, folds)
+        metrics = classification_metrics(classes, predicted, scores)
+        category = field_category(job['subject'], job['side'])
+        log('%s %s %s (%s): accuracy %.3f, AUC %.3f' % (job['subject']['id'], job['comparison'], job['side'], category,
+                                                       metrics['accuracy'], metrics['AUC']))
+
+        comparison_results = results[job['comparison']]
+        comparison_results['subjects'].append(dict(metrics, subject=job['subject']['id'], side=job['side'],
+                                                   category=category, classes=classes, predicted=predicted, scores=scores))
+
+        # Group summaries (blind field also by awareness)
+        group_names = [category]
+        if category == 'blind' and job['subject'].get('aware') is not None:
+            group_names.append('blind_aware' if job['subject']['aware'] else 'blind_unaware')
+        for group_name in group_names:
+            group = comparison_results['groups'].setdefault(group_name, {})
+            for metric in ('accuracy', 'chance', 'PPV', 'NPV', 'AUC'):
+                group.setdefault(metric, []).append(metrics[metric])
+
+    return results
+
+def save_results(results: dict, output_dir: str):
+    '''Save the results of each comparison: metrics (.json) and predictions and ROC curves (.npz)'''
+
+    interval_name = '%d_%d' % query_interval
+    for comparison, comparison_results in results.items():
+        filename = os.path.join(output_dir, '%s_%s_Layered_Classification_Results' % (comparison, interval_name))
+
+        summary = {'subjects': [{name: value for name, value in subject_results.items()
+                                 if name not in ('classes', 'predicted', 'scores')}
+                                for subject_results in comparison_results['subjects']],
+                   'groups': comparison_results['groups']}
+        with open(filename + '.json', 'w') as summary_file:
+            json.dump(summary, summary_file, indent=1)
+
+        arrays = {}
+        for subject_results in comparison_results['subjects']:
+            name = '%s_%s' % (subject_results['subject'], subject_results['side'])
+            arrays[name + '_true_labels'] = subject_results['classes']
+            arrays[name + '_predicted_labels'] = subject_results['predicted']
+            arrays[name + '_predicted_scores'] = subject_results['scores']
+            false_positive_rate, true_positive_rate, _, _ = roc_curve(subject_results['classes'], subject_results['scores'])
+            arrays[name + '_ROC'] = np.array([false_positive_rate, true_positive_rate])
+        np.savez(filename + '.npz', **arrays)
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Stacked SVM decoding of stimulus vs. ISI epochs (pipeline epoch stores)')
+    parser.add_argument('cohort', help='cohort file (JSON)')
+    parser.add_argument('--work-dir', default='pipeline_output', help='pipeline output folder')
+    parser.add_argument('--output-dir', default='classification_results', help='results and feature cache folder')
+    parser.add_argument('--comparisons', nargs='+', choices=list(comparisons), help='default: all comparisons')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--seed', type=int, default=0, help='fold partition seed')
+    options = parser.parse_args()
+
+    with open(options.cohort) as cohort_file:
+        cohort = json.load(cohort_file)
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    results = decode_cohort(cohort, options.work_dir, options.output_dir, options.comparisons, options.workers, options.seed)
+    save_results(results, options.output_dir)
+
+    for comparison, comparison_results in results.items():
+        for group_name, group in comparison_results['groups'].items():
+            print('%s %s: accuracy %.3f (chance %.3f), AUC %.3f, %d subjects' % (
+                  comparison, group_name, np.nanmean(group['accuracy']), np.nanmean(group['chance']),
+                  np.nanmean(group['AUC']), len(group['accuracy'])))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
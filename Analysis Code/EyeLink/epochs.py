@@ -0,0 +1,188 @@
+# ********************
+# *** EPOCH ENGINE ***
+# ********************
+
+# Vectorized epoch extraction around task events (same epochs, baseline, and
+# trial removal rules as EyeLink_Subject_Analysis_v5.m). The epochs of all event
+# types and signals are cut in one gathered indexing operation per signal;
+# epochs outside the recording are masked (NaN) instead of raising an error:
+#
+#   from sample_store import SampleStore
+#   from epochs import draw_message_times, epoch_events
+#   store = SampleStore('P1_Perception_Task_1')
+#   events = {name: store.sample_index(times) for name, times in draw_message_times(store).items()}
+#   epochs = epoch_events({'pupil': pupil, 'blink': blink}, events)
+#   glare_pupil = epochs['Glare']['pupil']
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import re
+import warnings
+
+import numpy as np
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Pre/post epoch duration (in samples; ms at 1000 Hz)
+epoch_duration = 9000
+
+# Baseline duration (in samples, before the event)
+baseline_duration = 1000
+
+# Trial removal thresholds
+pupil_extreme_threshold = 1750 # Pix
+blink_threshold = 0.5
+
+# Query interval: 1s pre-stimulus and 6s post-stimulus (in samples relative to the event)
+# Note: MATLAB query_interval = 8001:15000 (1-based epoch samples)
+query_interval = (-1000, 6000)
+
+# Binary signals (values must be 0 or 1 within the query interval)
+binary_signals = ('blink', 'microsaccade')
+
+# Stimulus onset messages
+# Note: Task v8 sends flip-stamped messages with the EyeLink time offset ("<offset ms> Draw ... Stimulus")
+draw_pattern = re.compile(r'^(?:(\d+) )?Draw (.+) Stimulus$')
+
+# **************
+# *** EVENTS ***
+# **************
+
+def draw_message_times(store) -> dict:
+    '''Stimulus onset message times of a sample store by stimulus name (e.g., "Glare")
+    The time offset of flip-stamped messages is subtracted, so the times are the stimulus flips'''
+
+    event_times = {}
+    message_times, messages = store.messages
+    for message_time, message in zip(message_times, messages):
+        match = draw_pattern.match(message)
+        if match:
+            offset = int(match.group(1)) if match.group(1) else 0
+            event_times.setdefault(match.group(2), []).append(int(message_time) - offset)
+
+    return {name: np.array(times, dtype=np.int64) for name, times in event_times.items()}
+
+# ****************
+# *** EPOCHING ***
+# ****************
+
+def extract_epochs(signal: np.ndarray, event_index: np.ndarray, valid: np.ndarray = None,
+                   duration: int = epoch_duration, dtype=np.float64) -> np.ndarray:
+    '''Epochs of a signal around event sample indices (events x 2*duration+1)
+    signal: 1D array or memory map (only the epoch samples are read)
+    valid: events to cut (others are NaN); epochs exceeding the signal are NaN'''
+
+    event_index = np.asarray(event_index, dtype=np.int64)
+    if valid is None:
+        valid = np.ones(event_index.shape, dtype=bool)
+
+    # Epoch sample indices and mask
+    # Note: Epochs exceeding the data are masked, not cut short
+    in_range = valid & (event_index - duration >= 0) & (event_index + duration < len(signal))
+    index = np.clip(event_index[:, None] + np.arange(-duration, duration+1), 0, max(len(signal)-1, 0))
+
+    # Gather all epochs at once
+    epochs = np.asarray(signal[index], dtype=dtype)
+    epochs[~in_range] = np.nan
+
+    return epochs
+
+def baseline_epochs(epochs: np.ndarray, duration: int = epoch_duration, baseline: int = baseline_duration) -> np.ndarray:
+    '''Subtract the mean of the baseline samples before the event from each epoch (in place)'''
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        baseline_mean = np.nanmean(epochs[:, duration-baseline:duration], axis=1, keepdims=True)
+    epochs -= baseline_mean
+
+    return epochs
+
+def reject_epochs(epochs: dict, duration: int = epoch_duration, blink_max: float = blink_threshold,
+                  pupil_max: float = pupil_extreme_threshold) -> dict:
+    '''Apply the trial removal rules to a set of epochs (in place)
+    epochs: {signal: events x samples} with pupil, blink, saccade, and/or microsaccade
+    Returns the removal masks ({rule: events})
+    Note: As in the MATLAB analysis, NaN values never trigger a rule'''
+
+    num_events = len(next(iter(epochs.values())))
+    query = slice(duration + query_interval[0], duration + query_interval[1])
+    masks = {}
+
+    with np.errstate(invalid='ignore'):
+
+        # Blink/microsaccade epochs that are not 0s/1s (blink, saccade, microsaccade removed)
+        not_binary = np.zeros(num_events, dtype=bool)
+        for signal in binary_signals:
+            if signal in epochs:
+                values = epochs[signal][:, query]
+                not_binary |= np.any((values > 1) | (values < 0), axis=1)
+        masks['not_binary'] = not_binary
+        for signal in ('blink', 'saccade', 'microsaccade'):
+            if signal in epochs:
+                epochs[signal][not_binary] = np.nan
+
+        # Eye closure/lost tracking: more than half of the query interval (all signals removed)
+        if 'blink' in epochs:
+            blink = epochs['blink'][:, query]
+            masks['blink'] = np.sum(blink, axis=1)/blink.shape[1] > blink_max
+            for values in epochs.values():
+                values[masks['blink']] = np.nan
+
+        # Extreme pupil values (pupil removed)
+        if 'pupil' in epochs:
+            masks['extreme_pupil'] = np.any(np.abs(epochs['pupil'][:, query]) > pupil_max, axis=1)
+            epochs['pupil'][masks['extreme_pupil']] = np.nan
+
+    return masks
+
+def removed_percent(epochs: np.ndarray) -> float:
+    '''Percent of removed (NaN) epochs'''
+
+    if len(epochs) == 0:
+        return 0.0
+    return np.count_nonzero(np.isnan(epochs[:, 0]))/len(epochs)*100
+
+def epoch_events(signals: dict, events: dict, duration: int = epoch_duration, baseline: int = baseline_duration,
+                 reject: bool = True) -> dict:
+    '''Epochs of every signal around every event type, baselined (pupil) and with trials removed
+    signals: {signal: 1D array} (pupil, blink, saccade, microsaccade, ...)
+    events: {event type: sample indices or (sample indices, valid) from SampleStore.sample_index}
+    Returns {event type: {signal: events x 2*duration+1}}'''
+
+    # All events of all types
+    event_types = list(events)
+    event_index, valid = [], []
+    for event_type in event_types:
+        index = events[event_type]
+        if isinstance(index, tuple):
+            index, index_valid = index
+        else:
+            index_valid = np.ones(np.shape(index), dtype=bool)
+        event_index.append(np.asarray(index, dtype=np.int64))
+        valid.append(np.asarray(index_valid, dtype=bool))
+    splits = np.cumsum([len(index) for index in event_index])[:-1]
+    event_index = np.concatenate(event_index) if event_index else np.zeros(0, dtype=np.int64)
+    valid = np.concatenate(valid) if valid else np.zeros(0, dtype=bool)
+
+    # Cut all epochs of each signal
+    epochs = {signal: extract_epochs(values, event_index, valid, duration) for signal, values in signals.items()}
+
+    # Baseline pupil epochs
+    if 'pupil' in epochs:
+        baseline_epochs(epochs['pupil'], duration, baseline)
+
+    # Trial removal
+    if reject and epochs and len(event_index):
+        reject_epochs(epochs, duration)
+
+    # Split by event type (views)
+    event_epochs = {event_type: {} for event_type in event_types}
+    for signal, values in epochs.items():
+        for event_type, part in zip(event_types, np.split(values, splits)):
+            event_epochs[event_type][signal] = part
+
+    return event_epochs
@@ -0,0 +1,257 @@
+# *************************
+# *** GROUP AGGREGATION ***
+# *************************
+
+# Streaming group mean timecourses and SEMs from the pipeline epoch stores. Subjects
+# are read one at a time (epochs in row chunks, memory mapped), so memory does not
+# depend on the cohort size. Each subject mean (removed epochs and NaN samples
+# excluded) is folded into running counts, means, and Welford sums of squares per
+# condition, visual field, signal, and time point. The group mean is the mean of
+# the subject means and the SEM is across subjects, as in EyeLink_Group_Analysis_v2.m.
+#
+# The accumulators are saved to a state file, so new subjects fold into the existing
+# group results without re-reading the subjects already added.
+#
+#   python group_aggregation.py cohort.json --work-dir <pipeline folder> --state group_state.npz
+#
+#   from group_aggregation import GroupAggregator
+#   aggregator = GroupAggregator.load('group_state.npz')
+#   aggregator.add_subject(subject, epoch_dirs)
+#   mean, sem = aggregator.mean('patient', 'glare_blind_pupil'), aggregator.sem('patient', 'glare_blind_pupil')
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from pipeline import default_parameters, field_category, load_epochs, movmean, session_id, signals
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Epochs read at once per subject (rows of an epoch store)
+chunk_rows = 256
+
+# State file format version
+# Note: Increase it when the accumulators change, so old state files are rebuilt
+state_version = 1
+
+# *******************
+# *** ACCUMULATOR ***
+# *******************
+
+class RunningStats:
+    '''NaN-aware running count, mean, and sum of squared deviations (Welford) per time point'''
+
+    def __init__(self, num_points: int):
+
+        self.count = np.zeros(num_points, dtype=np.int64)
+        self.mean_values = np.zeros(num_points)
+        self.m2 = np.zeros(num_points)
+
+    def add(self, rows: np.ndarray):
+        '''Fold in rows (rows x time points; NaN samples are skipped)'''
+
+        rows = np.atleast_2d(np.asarray(rows, dtype=np.float64))
+        valid = ~np.isnan(rows)
+        count = valid.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(valid, rows, 0).sum(axis=0) / count
+            m2 = np.where(valid, (rows - mean)**2, 0).sum(axis=0)
+        self.merge(count, np.nan_to_num(mean), m2)
+
+    def merge(self, count: np.ndarray, mean: np.ndarray, m2: np.ndarray):
+        '''Fold in the counts, means, and sums of squared deviations of another set of rows (Chan et al.)'''
+
+        total = self.count + count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(total > 0, count / total, 0)
+        delta = mean - self.mean_values
+        self.mean_values = self.mean_values + delta * weight
+        self.m2 = self.m2 + m2 + delta**2 * self.count * weight
+        self.count = total
+
+    def mean(self) -> np.ndarray:
+        '''Mean per time point (NaN without values)'''
+
+        return np.where(self.count > 0, self.mean_values, np.nan)
+
+    def variance(self) -> np.ndarray:
+        '''Sample variance per time point (NaN with fewer than 2 values)'''
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    def sem(self) -> np.ndarray:
+        '''Standard error of the mean per time point'''
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(self.variance() / self.count)
+
+def subject_mean(epoch_dirs: list, event_type: str, signal: str) -> np.ndarray:
+    '''Mean epoch of a subject (sessions combined; removed epochs and NaN samples excluded), read in row chunks'''
+
+    stats = None
+    for epoch_dir in epoch_dirs:
+        epochs = load_epochs(epoch_dir, event_type, signal)
+        stats = stats or RunningStats(epochs.shape[1])
+        for start in range(0, len(epochs), chunk_rows):
+            stats.add(epochs[start:start + chunk_rows])
+
+    return stats.mean()
+
+# ******************
+# *** AGGREGATOR ***
+# ******************
+
+class GroupAggregator:
+    '''Running statistics of subject means by subject group and timecourse (<condition>_<field>_<signal>)
+    smoothing_span: moving mean span of blink/saccade/microsaccade subject means (as the group analysis)'''
+
+    def __init__(self, smoothing_span: int = default_parameters['blink_saccade_smoothing_span']):
+
+        self.smoothing_span = smoothing_span
+        self.stats = {}
+        self.subjects = {}
+
+    def add_subject(self, subject: dict, epoch_dirs: list, epoch_keys: list = None):
+        '''Fold in the subject means of every event type and signal of a subject's epoch stores
+        epoch_keys: pipeline task keys of the epoch stores (recorded to detect changed subjects)'''
+
+        if subject['id'] in self.subjects:
+            raise ValueError('Subject %s is already aggregated' % subject['id'])
+
+        # Event types (from the first session)
+        with open(os.path.join(epoch_dirs[0], 'epochs.json')) as summary_file:
+            event_types = list(json.load(summary_file))
+
+        group = subject.get('group') or 'all'
+        for event_type in event_types:
+            # Note: Event types are <condition>_<side>; sides are grouped by blind/sighted field when known
+            condition, side = event_type.rsplit('_', 1)
+            for signal in signals:
+                mean = subject_mean(epoch_dirs, event_type, signal)
+                if signal != 'pupil':
+                    mean = movmean(mean, self.smoothing_span)
+                name = '%s_%s_%s' % (condition, field_category(subject, side), signal)
+                self.stats.setdefault(group, {}).setdefault(name, RunningStats(len(mean))).add(mean)
+
+        self.subjects[subject['id']] = {'group': group, 'epoch_keys': epoch_keys}
+
+    def mean(self, group: str, name: str) -> np.ndarray:
+        '''Group mean timecourse (mean of the subject means)'''
+
+        return self.stats[group][name].mean()
+
+    def sem(self, group: str, name: str) -> np.ndarray:
+        '''Standard error of the group mean timecourse (across subjects)'''
+
+        return self.stats[group][name].sem()
+
+    def save(self, filename: str):
+        '''Save the accumulators (written to a temporary file and renamed, so the state is never partial)'''
+
+        arrays = {}
+        for group, group_stats in self.stats.items():
+            for name, stats in group_stats.items():
+                arrays.update({'%s/%s/%s' % (group, name, field): getattr(stats, attribute) for field, attribute in
+                               (('count', 'count'), ('mean', 'mean_values'), ('m2', 'm2'))})
+        metadata = {'version': state_version, 'smoothing_span': self.smoothing_span, 'subjects': self.subjects}
+
+        temp_filename = '%s.%d.tmp.npz' % (filename, os.getpid())
+        np.savez(temp_filename, metadata=json.dumps(metadata), **arrays)
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename: str):
+        '''Load saved accumulators (None if the file is missing or from another state version)'''
+
+        try:
+            with np.load(filename) as state:
+                metadata = json.loads(str(state['metadata']))
+                if metadata['version'] != state_version:
+                    return None
+                aggregator = cls(metadata['smoothing_span'])
+                aggregator.subjects = metadata['subjects']
+                for array_name in state.files:
+                    if array_name == 'metadata':
+                        continue
+                    group, name, field = array_name.split('/')
+                    stats = aggregator.stats.setdefault(group, {}).setdefault(name, RunningStats(0))
+                    setattr(stats, {'count': 'count', 'mean': 'mean_values', 'm2': 'm2'}[field], state[array_name])
+        except (OSError, KeyError, ValueError):
+            return None
+
+        return aggregator
+
+    def save_results(self, filename: str):
+        '''Save the group means and SEMs (<group>_<timecourse>_mean/_sem, and the subject count)'''
+
+        results = {}
+        for group, group_stats in self.stats.items():
+            for name, stats in group_stats.items():
+                results['%s_%s_mean' % (group, name)] = stats.mean().astype(np.float32)
+                results['%s_%s_sem' % (group, name)] = stats.sem().astype(np.float32)
+                results['%s_%s_subjects' % (group, name)] = stats.count.astype(np.int32)
+        np.savez(filename, **results)
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Streaming group mean timecourses from pipeline epoch stores')
+    parser.add_argument('cohort', help='cohort file (JSON)')
+    parser.add_argument('--work-dir', default='pipeline_output', help='pipeline output folder')
+    parser.add_argument('--state', default='group_state.npz', help='accumulator state file (created if needed)')
+    parser.add_argument('--output', default='group_means.npz', help='group means and SEMs file (.npz)')
+    parser.add_argument('--rebuild', action='store_true', help='ignore the state file and aggregate all subjects')
+    options = parser.parse_args()
+
+    with open(options.cohort) as cohort_file:
+        cohort = json.load(cohort_file)
+    smoothing_span = {**default_parameters, **cohort.get('parameters', {})}['blink_saccade_smoothing_span']
+
+    aggregator = None if options.rebuild else GroupAggregator.load(options.state)
+    if aggregator is not None and aggregator.smoothing_span != smoothing_span:
+        print('Smoothing span changed: rebuilding the group state')
+        aggregator = None
+    aggregator = aggregator or GroupAggregator(smoothing_span)
+
+    added = 0
+    for subject in cohort['subjects']:
+        epoch_dirs = [os.path.join(options.work_dir, session_id(subject, session), 'epochs')
+                      for session in subject['sessions']]
+        epoch_keys = []
+        for epoch_dir in epoch_dirs:
+            with open(os.path.join(epoch_dir, 'task.json')) as task_file:
+                epoch_keys.append(json.load(task_file)['key'])
+
+        # Subjects already aggregated are not read again
+        # Note: Running sums cannot remove a subject, so changed subjects need --rebuild
+        if subject['id'] in aggregator.subjects:
+            if aggregator.subjects[subject['id']]['epoch_keys'] != epoch_keys:
+                print('Subject %s changed since it was aggregated (use --rebuild)' % subject['id'])
+            continue
+
+        aggregator.add_subject(subject, epoch_dirs, epoch_keys)
+        # Note: Saved after every subject, so an interrupted run keeps the subjects done
+        aggregator.save(options.state)
+        added += 1
+        print('Subject %s added' % subject['id'])
+
+    aggregator.save_results(options.output)
+    print('%d subjects added, %d subjects in the group state' % (added, len(aggregator.subjects)))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
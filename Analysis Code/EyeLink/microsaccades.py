@@ -0,0 +1,292 @@
+# ******************************
+# *** MICROSACCADE DETECTION ***
+# ******************************
+
+# Engbert-Kliegl (2003) saccade and microsaccade detection (as GetMicrosaccadesEK
+# in EyeLink_Subject_Analysis_v5.m: 5 sample velocity, median-based elliptic
+# velocity threshold lambda, minimum duration, blinks excluded). A session is
+# processed in chunks with a 2 sample overlap, fanned out over processes; runs of
+# above-threshold samples are stitched across chunk edges, so the saccades are
+# identical to whole-session processing. Several lambda thresholds are tested in
+# the same pass:
+#
+#   from microsaccades import detect_saccades, microsaccades
+#   saccades = detect_saccades(gaze_x, gaze_y, blinks=blink_data, lambdas=(4, 5, 6), workers=8)
+#   microsaccade_data = saccade_vector(microsaccades(saccades[5]), len(gaze_x))
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Sampling rate (Hz)
+sampling_rate = 1000
+
+# Velocity threshold (multiple of the median-based velocity SD) and minimum duration (in samples)
+velocity_factor = 5
+min_duration = 5
+
+# Microsaccade amplitude threshold (deg)
+microsaccade_threshold = 1
+
+# Default chunk size (in samples)
+default_chunk_size = 1000000
+
+# Screen geometry (see EyeLink_Subject_Analysis_v5.m: screen center in pixels, pixel pitch in mm, viewing distance in mm)
+screen_center = (512, 384)
+pixel_pitch = .254
+viewing_distance = 550
+
+# Saccade fields (allSac columns 1-7 and the amplitude)
+# onset/offset: first and last sample index; peak_velocity in deg/s; dx/dy: offset minus onset position;
+# amplitude_x/amplitude_y: signed horizontal and vertical extent; amplitude: sqrt(amplitude_x^2 + amplitude_y^2)
+saccade_dtype = np.dtype([('onset', '<i8'), ('offset', '<i8'), ('peak_velocity', '<f8'), ('dx', '<f8'), ('dy', '<f8'),
+                          ('amplitude_x', '<f8'), ('amplitude_y', '<f8'), ('amplitude', '<f8')])
+
+# ****************
+# *** VELOCITY ***
+# ****************
+
+def gaze_to_degrees(gaze_x: np.ndarray, gaze_y: np.ndarray) -> tuple:
+    '''Convert EyeLink gaze (pixels) to degrees of visual angle from the screen center'''
+
+    gaze_x = np.degrees(np.arctan((np.asarray(gaze_x, dtype=np.float64) - screen_center[0]) * pixel_pitch / viewing_distance))
+    gaze_y = np.degrees(np.arctan((np.asarray(gaze_y, dtype=np.float64) - screen_center[1]) * pixel_pitch / viewing_distance))
+
+    return gaze_x, gaze_y
+
+def velocity(position: np.ndarray, sample_rate: int = sampling_rate, first: bool = True, last: bool = True) -> np.ndarray:
+    '''Velocity with the 5 sample window of Engbert and Kliegl (vecvel)
+    first/last: position starts/ends at the session edge (2 sample difference next to the edge, 0 at the edge);
+    otherwise the 2 samples at that side are only context and their velocity is not returned'''
+
+    position = np.asarray(position, dtype=np.float64)
+    num_samples = position.size
+    v = np.zeros(num_samples)
+
+    v[2:num_samples-2] = sample_rate/6 * (position[4:] + position[3:-1] - position[1:-3] - position[:-4])
+    if first and num_samples > 2:
+        v[1] = sample_rate/2 * (position[2] - position[0])
+    if last and num_samples > 2:
+        v[num_samples-2] = sample_rate/2 * (position[-1] - position[-3])
+
+    return v[(0 if first else 2):(num_samples if last else num_samples-2)]
+
+def velocity_sd(v: np.ndarray) -> float:
+    '''Median-based velocity SD (falls back to the mean-based estimate for constant data)'''
+
+    sd = np.sqrt(np.nanmedian(v**2) - np.nanmedian(v)**2)
+    if sd < np.finfo(float).tiny:
+        sd = np.sqrt(np.nanmean(v**2) - np.nanmean(v)**2)
+
+    return sd
+
+# *****************
+# *** DETECTION ***
+# *****************
+
+def _open(source) -> np.ndarray:
+    '''Array or memory-mapped .npy file'''
+
+    return np.load(source, mmap_mode='r') if isinstance(source, str) else source
+
+def _chunks(num_samples: int, chunk_size: int) -> list:
+    '''Chunk sample ranges (a last chunk shorter than the velocity context is merged into the previous one)'''
+
+    starts = list(range(0, num_samples, max(chunk_size, 2)))
+    if len(starts) > 1 and num_samples - starts[-1] < 2:
+        starts.pop()
+
+    return [(start, stop) for start, stop in zip(starts, starts[1:] + [num_samples])]
+
+def _chunk_velocity(position: np.ndarray, start: int, stop: int, sample_rate: int) -> tuple:
+    '''Positions and velocity of the samples start..stop-1 (with 2 samples of context on each side)'''
+
+    num_samples = len(position)
+    context_start = max(0, start-2)
+    values = np.asarray(position[context_start:min(num_samples, stop+2)], dtype=np.float64)
+    v = velocity(values, sample_rate, start == 0, stop == num_samples)
+
+    return values[start-context_start:stop-context_start], v
+
+def _detect_chunk(task: tuple) -> dict:
+    '''Runs of above-threshold samples in one chunk for each lambda
+    Returns {lambda: run field arrays} with the run statistics needed to stitch runs across chunks'''
+
+    x_source, y_source, start, stop, sd_x, sd_y, lambdas, sample_rate = task
+    chunk_x, vx = _chunk_velocity(_open(x_source), start, stop, sample_rate)
+    chunk_y, vy = _chunk_velocity(_open(y_source), start, stop, sample_rate)
+    speed = np.hypot(vx, vy)
+
+    runs = {}
+    for lam in lambdas:
+
+        # Samples outside the velocity ellipse
+        with np.errstate(invalid='ignore'):
+            test = (vx/(lam*sd_x))**2 + (vy/(lam*sd_y))**2 > 1
+
+        # Runs of consecutive samples
+        edges = np.diff(np.concatenate([[False], test, [False]]).astype(np.int8))
+        onsets = np.flatnonzero(edges == 1)
+        offsets = np.flatnonzero(edges == -1)
+
+        # Run statistics (peak speed, position extremes, and their sample indices)
+        # Note: Reduced over the run samples only (runs are consecutive in the run sample array)
+        if onsets.size:
+            samples = np.flatnonzero(test)
+            run_index = np.repeat(np.arange(onsets.size), offsets - onsets)
+            run_starts = np.concatenate([[0], np.cumsum(offsets - onsets)[:-1]])
+            peak = np.maximum.reduceat(speed[samples], run_starts)
+            min_x, max_x = np.minimum.reduceat(chunk_x[samples], run_starts), np.maximum.reduceat(chunk_x[samples], run_starts)
+            min_y, max_y = np.minimum.reduceat(chunk_y[samples], run_starts), np.maximum.reduceat(chunk_y[samples], run_starts)
+            argmin_x = _first_index(samples, run_index, chunk_x[samples] == min_x[run_index], onsets.size)
+            argmax_x = _first_index(samples, run_index, chunk_x[samples] == max_x[run_index], onsets.size)
+            argmin_y = _first_index(samples, run_index, chunk_y[samples] == min_y[run_index], onsets.size)
+            argmax_y = _first_index(samples, run_index, chunk_y[samples] == max_y[run_index], onsets.size)
+        else:
+            peak = min_x = max_x = min_y = max_y = np.zeros(0)
+            argmin_x = argmax_x = argmin_y = argmax_y = np.zeros(0, dtype=np.int64)
+
+        runs[lam] = {'onset': onsets + start, 'offset': offsets - 1 + start, 'peak': peak,
+                     'start_x': chunk_x[onsets], 'start_y': chunk_y[onsets],
+                     'end_x': chunk_x[offsets-1], 'end_y': chunk_y[offsets-1],
+                     'min_x': min_x, 'max_x': max_x, 'min_y': min_y, 'max_y': max_y,
+                     'argmin_x': argmin_x + start, 'argmax_x': argmax_x + start,
+                     'argmin_y': argmin_y + start, 'argmax_y': argmax_y + start}
+
+    return runs
+
+def _first_index(samples: np.ndarray, run_index: np.ndarray, match: np.ndarray, num_runs: int) -> np.ndarray:
+    '''First matching sample of each run'''
+
+    index = np.full(num_runs, -1, dtype=np.int64)
+    matched = np.flatnonzero(match)
+    # Note: Reversed assignment, so the first match of each run is written last
+    index[run_index[matched][::-1]] = samples[matched][::-1]
+
+    return index
+
+def _stitch(chunk_runs: list) -> dict:
+    '''Concatenate the runs of all chunks and merge runs that continue across chunk edges'''
+
+    runs = {field: np.concatenate([chunk[field] for chunk in chunk_runs]) for field in chunk_runs[0]}
+    num_runs = runs['onset'].size
+    if num_runs == 0:
+        return runs
+
+    # Run groups: a run continues the previous one if it starts on the next sample
+    continues = np.zeros(num_runs, dtype=bool)
+    continues[1:] = runs['onset'][1:] == runs['offset'][:-1] + 1
+    group_starts = np.flatnonzero(~continues)
+    group_ends = np.append(group_starts[1:], num_runs) - 1
+
+    # Merged runs (first minimum/maximum wins ties, as in MATLAB min/max)
+    merged = {'onset': runs['onset'][group_starts], 'offset': runs['offset'][group_ends],
+              'peak': np.maximum.reduceat(runs['peak'], group_starts),
+              'start_x': runs['start_x'][group_starts], 'start_y': runs['start_y'][group_starts],
+              'end_x': runs['end_x'][group_ends], 'end_y': runs['end_y'][group_ends]}
+    for axis in ('x', 'y'):
+        for extreme, reduce in (('min', np.minimum), ('max', np.maximum)):
+            values = runs['%s_%s' % (extreme, axis)]
+            merged_values = reduce.reduceat(values, group_starts)
+            group = np.repeat(np.arange(group_starts.size), group_ends - group_starts + 1)
+            first = np.full(group_starts.size, -1, dtype=np.int64)
+            matched = np.flatnonzero(values == merged_values[group])
+            first[group[matched][::-1]] = runs['arg%s_%s' % (extreme, axis)][matched][::-1]
+            merged['%s_%s' % (extreme, axis)] = merged_values
+            merged['arg%s_%s' % (extreme, axis)] = first
+
+    return merged
+
+def _saccades(runs: dict, min_samples: int, blinks) -> np.ndarray:
+    '''Saccade table from stitched runs (minimum duration, no blink samples)'''
+
+    keep = runs['offset'] - runs['onset'] + 1 >= min_samples
+
+    # Saccades with blink samples
+    if blinks is not None and keep.any():
+        blink_counts = np.concatenate([[0], np.cumsum(np.asarray(blinks, dtype=bool))])
+        keep &= blink_counts[runs['offset']+1] - blink_counts[runs['onset']] == 0
+
+    saccades = np.zeros(np.count_nonzero(keep), dtype=saccade_dtype)
+    saccades['onset'] = runs['onset'][keep]
+    saccades['offset'] = runs['offset'][keep]
+    saccades['peak_velocity'] = runs['peak'][keep]
+    saccades['dx'] = runs['end_x'][keep] - runs['start_x'][keep]
+    saccades['dy'] = runs['end_y'][keep] - runs['start_y'][keep]
+    saccades['amplitude_x'] = np.sign(runs['argmax_x'][keep] - runs['argmin_x'][keep]) * (runs['max_x'][keep] - runs['min_x'][keep])
+    saccades['amplitude_y'] = np.sign(runs['argmax_y'][keep] - runs['argmin_y'][keep]) * (runs['max_y'][keep] - runs['min_y'][keep])
+    saccades['amplitude'] = np.hypot(saccades['amplitude_x'], saccades['amplitude_y'])
+
+    return saccades
+
+def detect_saccades(gaze_x, gaze_y, blinks: np.ndarray = None, lambdas=(velocity_factor,), min_samples: int = min_duration,
+                    sample_rate: int = sampling_rate, chunk_size: int = default_chunk_size, workers: int = 1) -> dict:
+    '''Engbert-Kliegl saccades of a session for each velocity threshold lambda
+    gaze_x/gaze_y: blink-interpolated gaze in degrees (arrays, memory maps, or .npy filenames)
+    blinks: blink samples (saccades with blink samples are removed)
+    workers: number of processes (chunks are processed in parallel)
+    Returns {lambda: saccade table (see saccade_dtype)}'''
+
+    lambdas = tuple(lambdas)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+
+        # Gaze sources for the workers (in-memory arrays are shared as memory-mapped files)
+        sources = []
+        for name, gaze in (('x', gaze_x), ('y', gaze_y)):
+            if workers > 1 and not isinstance(gaze, str):
+                filename = os.path.join(temp_dir, 'gaze_%s.npy' % name)
+                np.save(filename, np.asarray(gaze, dtype=np.float64))
+                gaze = filename
+            sources.append(gaze)
+        num_samples = len(_open(sources[0]))
+
+        # Velocity SD of the whole session
+        # Note: Velocities are computed chunk by chunk; the median needs all of them
+        chunks = _chunks(num_samples, chunk_size)
+        sd = []
+        for source in sources:
+            position = _open(source)
+            v = np.concatenate([_chunk_velocity(position, start, stop, sample_rate)[1] for start, stop in chunks] or [np.zeros(0)])
+            sd.append(velocity_sd(v) if v.size else np.nan)
+
+        # Runs of each chunk
+        tasks = [(sources[0], sources[1], start, stop, sd[0], sd[1], lambdas, sample_rate) for start, stop in chunks]
+        if workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunk_runs = list(executor.map(_detect_chunk, tasks))
+        else:
+            chunk_runs = [_detect_chunk(task) for task in tasks]
+
+    if not chunk_runs:
+        return {lam: np.zeros(0, dtype=saccade_dtype) for lam in lambdas}
+
+    return {lam: _saccades(_stitch([runs[lam] for runs in chunk_runs]), min_samples, blinks) for lam in lambdas}
+
+# ***************
+# *** OUTPUTS ***
+# ***************
+
+def microsaccades(saccades: np.ndarray, threshold: float = microsaccade_threshold) -> np.ndarray:
+    '''Saccades with an amplitude below the microsaccade threshold'''
+
+    return saccades[saccades['amplitude'] < threshold]
+
+def saccade_vector(saccades: np.ndarray, num_samples: int) -> np.ndarray:
+    '''Dense 0/1 vector of saccade samples (saccade_data/microsaccade_data in EyeLink_Subject_Analysis_v5.m)'''
+
+    changes = np.zeros(num_samples + 1, dtype=np.int64)
+    np.add.at(changes, saccades['onset'], 1)
+    np.add.at(changes, saccades['offset'] + 1, -1)
+
+    return (np.cumsum(changes[:-1]) > 0).astype(np.float64)
@@ -0,0 +1,420 @@
+# ****************************************
+# *** CLUSTER-BASED PERMUTATION ENGINE ***
+# ****************************************
+
+# Cluster-based permutation test of Maris & Oostenveld (2007) for timecourses, with
+# the same test as permutest_TimeCourses.m (MEG/Permutation_Analysis): t-values of
+# dependent (paired) or independent samples, clusters of contiguous above-threshold
+# time points, and the cluster t-sum compared with the distribution of the largest
+# cluster t-sum of each permutation.
+#
+# Permutations are evaluated in batches as matrix products (t-values of all the
+# permutations of a batch at once), clusters are found with a vectorized run-length
+# pass, and batches are split across processes. With early stopping, permutations
+# stop once the significance of every cluster is settled.
+#
+#   from permutation import permutest
+#   clusters, p_values, t_sums, distribution = permutest(glare, nonglare, two_sided=True, workers=8)
+#
+# glare/nonglare: subjects (or trials) x time points. On the pipeline group output:
+#
+#   python permutation.py <group folder> --signal pupil --conditions glare_left nonglare_left --group patient
+#   python permutation.py <group folder> --signal pupil --conditions glare_left --groups control patient
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import json
+import math
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import stats
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Defaults of permutest_TimeCourses.m
+default_num_permutations = 10000
+default_p_threshold = 0.05
+
+# Permutations per batch (batch t-values are batch size x time points)
+batch_size = 256
+
+# Early stopping: permutations between checks, significance level, and confidence
+# Note: Checks happen at fixed permutation counts, so results do not depend on the number of processes
+check_every = 1000
+early_stopping_alpha = 0.05
+early_stopping_confidence = 0.999
+
+# Relative tolerance of the t-sum comparison (t-sums of identical permutations may differ in the last bits)
+t_sum_tolerance = 1e-9
+
+# Group analysis settings (EyeLink_Group_Analysis_v2.m)
+group_num_permutations = 1000
+group_query_interval = (-1000, 4000) # Samples relative to the event (query_int = 8001:13000)
+
+# ****************
+# *** T-VALUES ***
+# ****************
+
+def dependent_t_values(differences: np.ndarray, signs: np.ndarray) -> np.ndarray:
+    '''One-sample t-values of sign-flipped paired differences (as simpleTTest)
+    differences: pairs x time points; signs: permutations x pairs (1 or -1)
+    Returns permutations x time points'''
+
+    num_pairs = differences.shape[0]
+
+    # Note: Sign flips do not change the sum of squares, so only the means need a matrix product
+    mean = (signs @ differences) / num_pairs
+    sum_squares = np.sum(differences**2, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = np.maximum(sum_squares - num_pairs * mean**2, 0) / (num_pairs - 1)
+        return mean / np.sqrt(variance / num_pairs)
+
+def independent_t_values(data: np.ndarray, groups: np.ndarray, num_group_2: int, squares: np.ndarray = None) -> np.ndarray:
+    '''Two-sample (unequal variance) t-values of permuted group labels (as simpleTTest2)
+    data: trials of both groups x time points (centered); groups: permutations x trials (1 for group 2)
+    squares: data**2 (computed if not given)
+    Returns permutations x time points'''
+
+    num_group_1 = data.shape[0] - num_group_2
+    if squares is None:
+        squares = data**2
+
+    # Group 2 sums and sums of squares (group 1 is the rest)
+    sum_2 = groups @ data
+    sum_squares_2 = groups @ squares
+
+    # Means and variances (in place: batches are large)
+    mean_1 = np.sum(data, axis=0) - sum_2
+    mean_1 /= num_group_1
+    mean_2 = sum_2
+    mean_2 /= num_group_2
+    variance_1 = np.sum(squares, axis=0) - sum_squares_2
+    variance_1 -= num_group_1 * mean_1**2
+    variance_2 = sum_squares_2
+    variance_2 -= num_group_2 * mean_2**2
+
+    # Standard error of the difference
+    # Note: Groups of one trial have no variance (NaN t-values, as in simpleTTest2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        standard_error = np.maximum(variance_1, 0, out=variance_1)
+        standard_error /= (num_group_1 - 1) * num_group_1
+        standard_error += np.maximum(variance_2, 0, out=variance_2) / ((num_group_2 - 1) * num_group_2)
+        np.sqrt(standard_error, out=standard_error)
+
+        mean_1 -= mean_2
+        mean_1 /= standard_error
+
+    return mean_1
+
+# ****************
+# *** CLUSTERS ***
+# ****************
+
+def cluster_runs(above: np.ndarray) -> tuple:
+    '''Runs of contiguous True values in each row
+    Returns the row, start, and end (exclusive) of each run'''
+
+    padded = np.zeros((above.shape[0], above.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = above
+    change = np.diff(padded, axis=1)
+
+    # Note: Starts and ends are found in row order, so the nth start and nth end are the same run
+    rows, starts = np.nonzero(change == 1)
+    _, ends = np.nonzero(change == -1)
+
+    return rows, starts, ends
+
+def cluster_t_sums(t_values: np.ndarray, threshold: float, two_sided: bool) -> tuple:
+    '''Clusters (row, start, end) and t-sums of each row of t-values
+    Positive clusters first, then negative clusters (two-sided test)'''
+
+    # Cumulative t-values (NaN t-values are never part of a cluster)
+    cumulative = np.zeros((t_values.shape[0], t_values.shape[1] + 1))
+    np.cumsum(np.nan_to_num(t_values, nan=0.0, posinf=0.0, neginf=0.0), axis=1, out=cumulative[:, 1:])
+
+    masks = (t_values > threshold, t_values < -threshold) if two_sided else (t_values > threshold,)
+    runs = [cluster_runs(mask) for mask in masks]
+    rows, starts, ends = (np.concatenate(parts) for parts in zip(*runs))
+
+    return rows, starts, ends, cumulative[rows, ends] - cumulative[rows, starts]
+
+def max_cluster_t_sums(t_values: np.ndarray, threshold: float, two_sided: bool) -> np.ndarray:
+    '''Largest (absolute) cluster t-sum of each row of t-values (0 without clusters)'''
+
+    rows, _, _, t_sums = cluster_t_sums(t_values, threshold, two_sided)
+
+    # Largest absolute t-sum per row: sort by row, then by absolute t-sum, and take the last of each row
+    maximum = np.zeros(t_values.shape[0])
+    if len(rows):
+        order = np.lexsort((np.abs(t_sums), rows))
+        sorted_rows = rows[order]
+        last = np.flatnonzero(np.append(sorted_rows[1:] != sorted_rows[:-1], True))
+        maximum[sorted_rows[last]] = t_sums[order[last]]
+
+    return maximum
+
+# ********************
+# *** PERMUTATIONS ***
+# ********************
+
+def _unrank_combination(rank: int, num_items: int, num_chosen: int) -> list:
+    '''Combination of num_chosen out of num_items with a given lexicographic rank (as nchoosek rows)'''
+
+    chosen = []
+    item = 0
+    while num_chosen:
+        count = math.comb(num_items - item - 1, num_chosen - 1)
+        if rank < count:
+            chosen.append(item)
+            num_chosen -= 1
+        else:
+            rank -= count
+        item += 1
+
+    return chosen
+
+def permutation_vectors(rng: np.random.Generator, num_permutations: int, dependent: bool, num_trials_1: int,
+                        num_trials_2: int) -> np.ndarray:
+    '''Permutations (permutations x trials) as in permutest_TimeCourses.m
+    Dependent: signs (1 or -1) of each pair; independent: 1 for trials assigned to group 2
+    Permutations are drawn randomly, or without repetition when there are few possible permutations'''
+
+    if dependent:
+        max_permutations = 2**num_trials_1
+    else:
+        max_permutations = math.comb(num_trials_1 + num_trials_2, num_trials_1)
+    if num_permutations > max_permutations:
+        warnings.warn('Only %d permutations are possible. Using this value instead of %d.' % (max_permutations, num_permutations))
+        num_permutations = max_permutations
+
+    num_trials = num_trials_1 if dependent else num_trials_1 + num_trials_2
+    vectors = np.zeros((num_permutations, num_trials), dtype=np.int8)
+
+    # At least 1000 times more possible permutations than requested: random draws
+    if num_permutations < max_permutations / 1000:
+        if dependent:
+            vectors[:] = rng.integers(0, 2, vectors.shape) * 2 - 1
+        else:
+            group_2 = np.argsort(rng.random(vectors.shape), axis=1)[:, :num_trials_2]
+            np.put_along_axis(vectors, group_2, 1, axis=1)
+
+    # Otherwise: permutations without repetition
+    else:
+        ranks = rng.choice(max_permutations, num_permutations, replace=False)
+        if dependent:
+            bits = (ranks[:, None] >> np.arange(num_trials - 1, -1, -1)) & 1
+            vectors[:] = bits * 2 - 1
+        else:
+            for permutation, rank in enumerate(ranks):
+                vectors[permutation, _unrank_combination(int(rank), num_trials, num_trials_2)] = 1
+
+    return vectors
+
+# Data of the worker processes (set once per process)
+_worker_data = {}
+
+def _init_worker(data: np.ndarray, dependent: bool, num_trials_2: int, threshold: float, two_sided: bool):
+    '''Set the test data of a worker process'''
+
+    _worker_data.update(data=data, squares=data**2, dependent=dependent, num_trials_2=num_trials_2,
+                        threshold=threshold, two_sided=two_sided)
+
+def _permutation_t_values(vectors: np.ndarray) -> np.ndarray:
+    '''T-values of permutations (permutations x trials) of the worker data'''
+
+    vectors = vectors.astype(np.float64)
+    if _worker_data['dependent']:
+        return dependent_t_values(_worker_data['data'], vectors)
+    return independent_t_values(_worker_data['data'], vectors, _worker_data['num_trials_2'], _worker_data['squares'])
+
+def _permutation_batch(vectors: np.ndarray) -> np.ndarray:
+    '''Largest cluster t-sum of each permutation of a batch'''
+
+    return max_cluster_t_sums(_permutation_t_values(vectors), _worker_data['threshold'], _worker_data['two_sided'])
+
+def _exceedances(distribution: np.ndarray, t_sums: np.ndarray, two_sided: bool) -> np.ndarray:
+    '''Number of permutation t-sums at least as large as each cluster t-sum'''
+
+    if two_sided:
+        distribution, t_sums = np.abs(distribution), np.abs(t_sums)
+    limits = t_sums - t_sum_tolerance * np.abs(t_sums)
+
+    return np.sum(distribution[:, None] >= limits[None, :], axis=0)
+
+def _settled(exceedances: np.ndarray, num_done: int, num_permutations: int) -> bool:
+    '''Whether the significance of every cluster is settled (early stopping)'''
+
+    # Already non-significant whatever the remaining permutations are
+    final_minimum = (exceedances + 1) / (num_permutations + 1)
+    certain = final_minimum > early_stopping_alpha
+
+    # Wilson interval of the exceedance probability excludes the significance level
+    z = stats.norm.ppf(1 - (1 - early_stopping_confidence) / 2)
+    proportion = exceedances / num_done
+    center = (proportion + z**2 / (2 * num_done)) / (1 + z**2 / num_done)
+    half_width = z * np.sqrt(proportion * (1 - proportion) / num_done + z**2 / (4 * num_done**2)) / (1 + z**2 / num_done)
+
+    return bool(np.all(certain | (center - half_width > early_stopping_alpha) | (center + half_width < early_stopping_alpha)))
+
+# ************
+# *** TEST ***
+# ************
+
+def permutest(trial_group_1: np.ndarray, trial_group_2: np.ndarray, dependent_samples: bool = True,
+              p_threshold: float = default_p_threshold, num_permutations: int = default_num_permutations,
+              two_sided: bool = False, num_clusters: int = None, workers: int = 1, early_stopping: bool = False,
+              seed=None) -> tuple:
+    '''Cluster-based permutation test (as permutest_TimeCourses.m)
+    trial_group_1/trial_group_2: trials (or subjects) x time points; the number of trials can differ for
+    independent samples
+    num_clusters: maximum number of (largest) clusters tested
+    Returns the clusters (time point indices, largest absolute t-sum first), their p-values and t-sums, and
+    the permutation distribution (one value per permutation run)'''
+
+    trial_group_1 = np.asarray(trial_group_1, dtype=np.float64)
+    trial_group_2 = np.asarray(trial_group_2, dtype=np.float64)
+    if trial_group_1.ndim != 2 or trial_group_2.ndim != 2:
+        raise ValueError('Trial groups need to be 2D (trials x time points)')
+    num_trials_1, num_trials_2 = len(trial_group_1), len(trial_group_2)
+    if trial_group_1.shape[1] != trial_group_2.shape[1]:
+        raise ValueError('Trial groups need the same number of time points')
+    if dependent_samples and num_trials_1 != num_trials_2:
+        raise ValueError('Size of all dimensions should be identical for two dependent samples')
+
+    # T-value threshold
+    # Note: As in permutest_TimeCourses.m, independent samples use n1+n2-1 degrees of freedom
+    degrees_of_freedom = num_trials_1 - 1 if dependent_samples else num_trials_1 + num_trials_2 - 1
+    threshold = abs(stats.t.ppf(p_threshold, degrees_of_freedom))
+
+    # Test data
+    if dependent_samples:
+        data = trial_group_1 - trial_group_2
+    else:
+        # Note: Centering all trials does not change the t-values and keeps the sums of squares accurate
+        data = np.concatenate([trial_group_1, trial_group_2])
+        data = data - np.mean(data, axis=0)
+
+    # Observed clusters
+    _init_worker(data, dependent_samples, num_trials_2, threshold, two_sided)
+    observed = np.ones((1, data.shape[0])) if dependent_samples else np.r_[np.zeros(num_trials_1), np.ones(num_trials_2)][None]
+    _, starts, ends, t_sums = cluster_t_sums(_permutation_t_values(observed), threshold, two_sided)
+
+    # Clusters by absolute t-sum
+    order = np.argsort(-np.abs(t_sums), kind='stable')
+    if num_clusters is not None:
+        order = order[:num_clusters]
+    t_sums = t_sums[order]
+    clusters = [np.arange(starts[index], ends[index]) for index in order]
+
+    # Permutation distribution
+    rng = np.random.default_rng(seed)
+    vectors = permutation_vectors(rng, num_permutations, dependent_samples, num_trials_1, num_trials_2)
+    num_permutations = len(vectors)
+    batches = [vectors[start:start + batch_size] for start in range(0, num_permutations, batch_size)]
+    batches_per_check = math.ceil(check_every / batch_size)
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(data, dependent_samples, num_trials_2, threshold, two_sided)) if workers > 1 else None
+    distribution = []
+    try:
+        for start in range(0, len(batches), batches_per_check):
+            round_batches = batches[start:start + batches_per_check]
+            if executor is None:
+                distribution.extend(_permutation_batch(batch) for batch in round_batches)
+            else:
+                distribution.extend(executor.map(_permutation_batch, round_batches))
+
+            # Stop once the significance of every cluster is settled
+            if early_stopping and len(t_sums):
+                done = np.concatenate(distribution)
+                if _settled(_exceedances(done, t_sums, two_sided), len(done), num_permutations):
+                    break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    distribution = np.concatenate(distribution) if distribution else np.zeros(0)
+    p_values = (_exceedances(distribution, t_sums, two_sided) + 1) / (len(distribution) + 1)
+
+    return clusters, p_values, t_sums, distribution
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Cluster-based permutation test of subject mean timecourses (pipeline group output)')
+    parser.add_argument('group_dir', help='pipeline group folder (subject_means.npz, subjects.json)')
+    parser.add_argument('--signal', default='pupil', help='pupil, blink, saccade, or microsaccade')
+    parser.add_argument('--conditions', nargs='+', required=True,
+                        help='two event types (dependent test) or one event type (independent test between --groups)')
+    parser.add_argument('--group', help='subject group of a dependent test (default: all subjects)')
+    parser.add_argument('--groups', nargs=2, help='two subject groups of an independent test')
+    parser.add_argument('--interval', nargs=2, type=int, default=group_query_interval, help='samples relative to the event')
+    parser.add_argument('--permutations', type=int, default=group_num_permutations)
+    parser.add_argument('--p-threshold', type=float, default=default_p_threshold)
+    parser.add_argument('--one-sided', action='store_true', help='one-sided test (default: two-sided)')
+    parser.add_argument('--early-stopping', action='store_true', help='stop once the cluster p-values are settled')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help='results file (.npz)')
+    options = parser.parse_args()
+
+    means = np.load(os.path.join(options.group_dir, 'subject_means.npz'))
+    with open(os.path.join(options.group_dir, 'subjects.json')) as subject_file:
+        subject_groups = np.array([subject['group'] for subject in json.load(subject_file)])
+
+    def timecourses(condition, group=None):
+        data = means['%s_%s' % (condition, options.signal)]
+        event_sample = (data.shape[1] - 1) // 2
+        data = data[:, event_sample + options.interval[0]:event_sample + options.interval[1]]
+        return data if group is None else data[subject_groups == group]
+
+    # Dependent test: two conditions of the same subjects; independent test: one condition of two groups
+    if len(options.conditions) == 2:
+        group_1, group_2 = (timecourses(condition, options.group) for condition in options.conditions)
+        keep = ~np.any(np.isnan(group_1) | np.isnan(group_2), axis=1)
+        group_1, group_2 = group_1[keep], group_2[keep]
+        dependent = True
+    elif len(options.conditions) == 1 and options.groups:
+        group_1, group_2 = (timecourses(options.conditions[0], group) for group in options.groups)
+        group_1, group_2 = (group[~np.any(np.isnan(group), axis=1)] for group in (group_1, group_2))
+        dependent = False
+    else:
+        parser.error('Use two --conditions, or one condition and two --groups')
+
+    # Note: Subjects without epochs (NaN mean timecourses) are left out
+    print('%d and %d subjects' % (len(group_1), len(group_2)))
+    clusters, p_values, t_sums, distribution = permutest(group_1, group_2, dependent, options.p_threshold,
+                                                         options.permutations, not options.one_sided,
+                                                         workers=options.workers, early_stopping=options.early_stopping,
+                                                         seed=options.seed)
+
+    print('%d permutations' % len(distribution))
+    for cluster, p_value, t_sum in zip(clusters, p_values, t_sums):
+        print('%6d to %6d ms: t-sum %10.2f, p = %.4f' % (cluster[0] + options.interval[0], cluster[-1] + options.interval[0],
+                                                         t_sum, p_value))
+
+    if options.output:
+        significant = np.zeros(group_1.shape[1], dtype=bool)
+        for cluster, p_value in zip(clusters, p_values):
+            significant[cluster] = p_value < options.p_threshold
+        np.savez(options.output, p_values=p_values, t_sums=t_sums, distribution=distribution,
+                 sig_time_pts=np.flatnonzero(significant) + options.interval[0],
+                 **{'cluster_%d' % index: cluster + options.interval[0] for index, cluster in enumerate(clusters)})
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
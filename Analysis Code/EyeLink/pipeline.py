@@ -0,0 +1,523 @@
+# *************************
+# *** ANALYSIS PIPELINE ***
+# *************************
+
+# Dependency-aware pipeline for the EyeLink subject analysis (the stages of
+# EyeLink_Subject_Analysis_v5.m). Each session is a chain of tasks:
+#
+#   store (edfmex .mat -> sample store)   trials (behavioral .log -> trial table)
+#        \-> blinks (Stublinks60) -> saccades (Engbert-Kliegl) -> epochs <-/
+#
+# and the cohort has one group task over the epochs of all sessions. Tasks run on a
+# process pool as soon as their inputs are ready, so independent sessions run in
+# parallel. Each task has a key (hash of its stage version, parameters, input files,
+# and upstream task keys); tasks whose key is unchanged are skipped, so editing one
+# recording or one parameter only recomputes the affected tasks. With a result cache
+# (result_cache.py), task outputs are also reused across work folders and parameter
+# sweeps (e.g., returning to an earlier parameter value).
+#
+# Cohort file (JSON):
+#
+#   {"subjects": [{"id": "P1", "group": "patient", "eye": "left",
+#                  "blind_side": "left", "aware": false,
+#                  "sessions": [{"id": "1", "eyelink": "P1_Perception_Task_1.mat",
+#                                "log": "P1_Session_1_..._v7.log"}]}],
+#    "parameters": {"velocity_factor": 6}}
+#
+# ("blind_side" and "aware" are optional; they group results by blind/sighted field.)
+#
+#   python pipeline.py cohort.json --work-dir <folder> --workers 8
+#   python pipeline.py cohort.json --work-dir <folder> --cache-dir <folder> --set epoch_duration=6000
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+# Behavioral log parser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Behavior'))
+
+import log_parser
+from blink_engine import deblink_recording
+from epochs import draw_message_times, epoch_events, removed_percent
+from microsaccades import detect_saccades, gaze_to_degrees, microsaccades, saccade_vector
+from result_cache import ResultCache
+from sample_store import SampleStore, convert_mat
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Default analysis parameters (see EyeLink_Subject_Analysis_v5.m)
+default_parameters = {
+    'sampling_rate': 1000,
+    'pupil_correction_value': 1000,
+    'pupil_smoothing_span': 100,
+    'blink_saccade_smoothing_span': 100,
+    'velocity_factor': 5,
+    'min_saccade_duration': 5,
+    'microsaccade_threshold': 1,
+    'epoch_duration': 9000,
+    'baseline_duration': 1000,
+    'isi_event_time': [4000, 7000],
+    'isi_seed': 0,
+}
+
+# Stages: version, parameters, and upstream stages
+# Note: Increase a stage version when its code changes, so its outputs are recomputed
+stages = {
+    'store': {'version': 1, 'parameters': (), 'inputs': ()},
+    'trials': {'version': 1, 'parameters': (), 'inputs': ()},
+    'blinks': {'version': 1, 'parameters': ('sampling_rate', 'pupil_correction_value', 'pupil_smoothing_span'),
+               'inputs': ('store',)},
+    'saccades': {'version': 1, 'parameters': ('sampling_rate', 'velocity_factor', 'min_saccade_duration'),
+                 'inputs': ('store', 'blinks')},
+    'epochs': {'version': 1, 'parameters': ('microsaccade_threshold', 'epoch_duration', 'baseline_duration',
+                                            'isi_event_time', 'isi_seed'),
+               'inputs': ('store', 'trials', 'blinks', 'saccades')},
+    'group': {'version': 1, 'parameters': ('blink_saccade_smoothing_span',), 'inputs': ('epochs',)},
+}
+
+# Session stages in dependency order
+session_stages = ('store', 'trials', 'blinks', 'saccades', 'epochs')
+
+# Epoch signals
+signals = ('pupil', 'blink', 'saccade', 'microsaccade')
+
+# Main phase stimulus types (trial table codes) and epoch event names
+# Note: Distractor plus and cross are one distractor event type, as in the MATLAB analysis
+event_stim_names = {0: 'glare', 1: 'nonglare', 2: 'iso', 3: 'white', 4: 'distractor', 5: 'distractor'}
+side_names = {0: 'left', 1: 'right'}
+
+# *************
+# *** UTILS ***
+# *************
+
+def hash_values(*values) -> str:
+    '''Hash of JSON-serializable values'''
+
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+def file_hash(filename: str, fingerprints: dict = None) -> str:
+    '''Content hash of a file (reused while its size and modification time are unchanged)'''
+
+    stat = os.stat(filename)
+    fingerprint = [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+    if fingerprints is not None and fingerprints.get(fingerprint[0], [None])[:2] == fingerprint[1:]:
+        return fingerprints[fingerprint[0]][2]
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b''):
+            digest.update(block)
+
+    if fingerprints is not None:
+        fingerprints[fingerprint[0]] = fingerprint[1:] + [digest.hexdigest()]
+    return digest.hexdigest()
+
+def movmean(data: np.ndarray, span: int) -> np.ndarray:
+    '''Moving mean along the last axis with MATLAB movmean windows (shrinking at the edges; NaN if the window
+    has a NaN)'''
+
+    data = np.asarray(data, dtype=np.float64)
+    missing = np.isnan(data)
+    before, after = span//2, (span-1)//2
+    start = np.zeros(data.shape[:-1] + (1,))
+    cumsum = np.concatenate([start, np.cumsum(np.where(missing, 0, data), axis=-1)], axis=-1)
+    missing_count = np.concatenate([start, np.cumsum(missing, axis=-1)], axis=-1)
+    index = np.arange(data.shape[-1])
+    low = np.maximum(index - before, 0)
+    high = np.minimum(index + after + 1, data.shape[-1])
+
+    mean = (cumsum[..., high] - cumsum[..., low]) / (high - low)
+    mean[missing_count[..., high] > missing_count[..., low]] = np.nan
+
+    return mean
+
+def naninterp(data: np.ndarray) -> np.ndarray:
+    '''Linear interpolation over NaN samples (edges hold the nearest value)'''
+
+    data = np.array(data, dtype=np.float64)
+    missing = np.isnan(data)
+    if missing.any() and not missing.all():
+        data[missing] = np.interp(np.flatnonzero(missing), np.flatnonzero(~missing), data[~missing])
+
+    return data
+
+# **************
+# *** STAGES ***
+# **************
+
+def run_store(session: dict, parameters: dict, inputs: dict, output_dir: str):
+    '''Convert the EyeLink recording into a sample store'''
+
+    convert_mat(session['eyelink'], output_dir, parameters['sampling_rate'])
+
+def run_trials(session: dict, parameters: dict, inputs: dict, output_dir: str):
+    '''Parse the behavioral log into a trial table'''
+
+    np.save(os.path.join(output_dir, 'trials.npy'), log_parser.load_trial_table(session['log'], cache_dir=None))
+
+def run_blinks(session: dict, parameters: dict, inputs: dict, output_dir: str):
+    '''Blink removal (Stublinks60) and pupil smoothing'''
+
+    store = SampleStore(inputs['store'])
+    correction_value = parameters['pupil_correction_value']
+
+    # Pupil data (scaled for stublinks)
+    pupil = np.asarray(store.channel('pa', session['eye']), dtype=np.float64) / correction_value
+
+    stublinked, blinks, failures = deblink_recording(pupil, parameters['sampling_rate'])
+
+    # Return data to original scale and smooth
+    pupil = movmean(stublinked * correction_value, parameters['pupil_smoothing_span'])
+
+    np.save(os.path.join(output_dir, 'pupil.npy'), pupil.astype(np.float32))
+    np.save(os.path.join(output_dir, 'blinks.npy'), blinks)
+    with open(os.path.join(output_dir, 'failures.json'), 'w') as failure_file:
+        json.dump([list(map(str, failure)) for failure in failures], failure_file)
+
+def run_saccades(session: dict, parameters: dict, inputs: dict, output_dir: str):
+    '''Saccade detection on the blink-interpolated gaze'''
+
+    store = SampleStore(inputs['store'])
+    blinks = np.load(os.path.join(inputs['blinks'], 'blinks.npy'))
+
+    # Gaze in degrees, interpolated over blinks
+    gaze_x, gaze_y = gaze_to_degrees(store.channel('gx', session['eye']), store.channel('gy', session['eye']))
+    gaze_x[blinks] = np.nan
+    gaze_y[blinks] = np.nan
+
+    saccades = detect_saccades(naninterp(gaze_x), naninterp(gaze_y), blinks, (parameters['velocity_factor'],),
+                               parameters['min_saccade_duration'], parameters['sampling_rate'])
+
+    np.save(os.path.join(output_dir, 'saccades.npy'), saccades[parameters['velocity_factor']])
+
+def session_events(store: SampleStore, trials: np.ndarray, parameters: dict) -> dict:
+    '''Stimulus and ISI event sample indices by event type (e.g., glare_left, ISI_glare_left)'''
+
+    # Main phase stimulus onset messages
+    message_times, messages = store.messages
+    main_start = [t for t, message in zip(message_times, messages) if message == 'Starting Glare Illusion Main Phase']
+    main_end = [t for t, message in zip(message_times, messages) if message == 'Starting Glare Illusion Perception Phase']
+    # Note: Stimulus flip times of all stimulus names in time order (the offset of v8 messages is subtracted)
+    onset_times = np.sort(np.concatenate([np.zeros(0, dtype=np.int64)] + list(draw_message_times(store).values())))
+    draw_times = [t for t in onset_times if (not main_start or t >= main_start[0]) and (not main_end or t < main_end[0])]
+
+    # Main phase trials with a stimulus (same order as the onset messages)
+    main_trials = trials[(trials['phase'] == 0) & ~np.isnan(trials['onset'])]
+    if len(main_trials) != len(draw_times):
+        raise ValueError('%d stimulus messages but %d main phase trials' % (len(draw_times), len(main_trials)))
+
+    # ISI events: random time after each stimulus onset
+    rng = np.random.default_rng(parameters['isi_seed'])
+    isi_min, isi_max = parameters['isi_event_time']
+    isi_offsets = rng.integers(isi_min, isi_max, len(draw_times), endpoint=True)
+
+    index, valid = store.sample_index(draw_times)
+    isi_index, isi_valid = store.sample_index(np.array(draw_times, dtype=np.int64) + isi_offsets)
+
+    events = {}
+    for stim_type, stim_name in event_stim_names.items():
+        for side, side_name in side_names.items():
+            selected = (main_trials['stim_type'] == stim_type) & (main_trials['side'] == side)
+            for name, event_index, event_valid in (('%s_%s' % (stim_name, side_name), index, valid),
+                                                   ('ISI_%s_%s' % (stim_name, side_name), isi_index, isi_valid)):
+                previous_index, previous_valid = events.get(name, (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)))
+                events[name] = (np.concatenate([previous_index, event_index[selected]]),
+                                np.concatenate([previous_valid, event_valid[selected]]))
+
+    return events
+
+def run_epochs(session: dict, parameters: dict, inputs: dict, output_dir: str):
+    '''Cut the epochs of every event type and signal (epoch store)'''
+
+    store = SampleStore(inputs['store'])
+    trials = np.load(os.path.join(inputs['trials'], 'trials.npy'))
+    saccades = np.load(os.path.join(inputs['saccades'], 'saccades.npy'))
+
+    # Session signals
+    signal_data = {'pupil': np.load(os.path.join(inputs['blinks'], 'pupil.npy')),
+                   'blink': np.load(os.path.join(inputs['blinks'], 'blinks.npy')),
+                   'saccade': saccade_vector(saccades, store.num_samples),
+                   'microsaccade': saccade_vector(microsaccades(saccades, parameters['microsaccade_threshold']), store.num_samples)}
+
+    epochs = epoch_events(signal_data, session_events(store, trials, parameters), parameters['epoch_duration'],
+                          parameters['baseline_duration'])
+
+    # Epoch store: <event type>_<signal>.npy and a summary
+    summary = {}
+    for event_type, event_epochs in epochs.items():
+        for signal, values in event_epochs.items():
+            np.save(os.path.join(output_dir, '%s_%s.npy' % (event_type, signal)), values.astype(np.float32))
+        summary[event_type] = {'events': len(event_epochs['pupil']),
+                               'removed': {signal: removed_percent(values) for signal, values in event_epochs.items()}}
+    with open(os.path.join(output_dir, 'epochs.json'), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=1)
+
+def load_epochs(epoch_dir: str, event_type: str, signal: str) -> np.ndarray:
+    '''Epochs of an event type and signal from an epoch store (events x samples)'''
+
+    return np.load(os.path.join(epoch_dir, '%s_%s.npy' % (event_type, signal)), mmap_mode='r')
+
+def run_group(cohort: dict, parameters: dict, inputs: dict, output_dir: str):
+    '''Subject mean timecourses of every event type and signal (sessions of a subject combined)'''
+
+    # Event types (from the first session)
+    with open(os.path.join(next(iter(inputs.values())), 'epochs.json')) as summary_file:
+        event_types = list(json.load(summary_file))
+
+    subject_ids = [subject['id'] for subject in cohort['subjects']]
+    means = {}
+    for event_type in event_types:
+        for signal in signals:
+            subject_means = []
+            for subject in cohort['subjects']:
+
+                # All sessions; removed (NaN) epochs excluded
+                epochs = np.concatenate([load_epochs(inputs[session_id(subject, session)], event_type, signal)
+                                         for session in subject['sessions']])
+                epochs = epochs[~np.isnan(epochs[:, 0])]
+                mean = np.mean(epochs, axis=0) if len(epochs) else np.full(epochs.shape[1], np.nan)
+
+                # Smooth blink, saccade, microsaccade data
+                if signal != 'pupil':
+                    mean = movmean(mean, parameters['blink_saccade_smoothing_span'])
+                subject_means.append(mean)
+
+            means['%s_%s' % (event_type, signal)] = np.array(subject_means, dtype=np.float32)
+
+    np.savez(os.path.join(output_dir, 'subject_means.npz'), **means)
+    with open(os.path.join(output_dir, 'subjects.json'), 'w') as subject_file:
+        json.dump([{'id': subject['id'], 'group': subject.get('group')} for subject in cohort['subjects']], subject_file)
+
+# Stage functions
+stage_functions = {'store': run_store, 'trials': run_trials, 'blinks': run_blinks, 'saccades': run_saccades,
+                   'epochs': run_epochs, 'group': run_group}
+
+# *****************
+# *** SCHEDULER ***
+# *****************
+
+def session_id(subject: dict, session: dict) -> str:
+    '''Session identifier (subject and session IDs)'''
+
+    return '%s_%s' % (subject['id'], session['id'])
+
+def field_category(subject: dict, side: str) -> str:
+    '''Visual field category of a stimulus side: blind/sighted (subjects with a "blind_side") or the side'''
+
+    if subject.get('blind_side') is None:
+        return side
+    return 'blind' if side == subject['blind_side'] else 'sighted'
+
+def run_task(stage: str, config: dict, parameters: dict, inputs: dict, output_dir: str, key: str,
+             cache: ResultCache = None):
+    '''Run a task into a temporary folder and replace its output folder
+    Returns the duration, or "cached" if the output was taken from the result cache'''
+
+    start = time.perf_counter()
+
+    # Note: Outputs are written to a temporary folder first, so an interrupted task never looks complete
+    temp_dir = '%s.%d.tmp' % (output_dir, os.getpid())
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    if cache is not None and cache.get(key, temp_dir, stage):
+        result = 'cached'
+    else:
+        stage_functions[stage](config, parameters, inputs, temp_dir)
+        if cache is not None:
+            cache.put(key, temp_dir, stage)
+        result = None
+    with open(os.path.join(temp_dir, 'task.json'), 'w') as task_file:
+        json.dump({'stage': stage, 'key': key}, task_file)
+
+    old_dir = '%s.%d.old' % (output_dir, os.getpid())
+    if os.path.isdir(output_dir):
+        os.replace(output_dir, old_dir)
+    os.replace(temp_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return result or time.perf_counter() - start
+
+class Pipeline:
+    '''Tasks of a cohort, their keys, and the scheduler
+    cohort: cohort dictionary (see the cohort file); work_dir: task output folder
+    cache: optional result cache shared by work folders'''
+
+    def __init__(self, cohort: dict, work_dir: str, parameters: dict = None, workers: int = 1,
+                 cache: ResultCache = None):
+
+        self.cohort = cohort
+        self.work_dir = work_dir
+        self.workers = workers
+        self.cache = cache
+        self.parameters = dict(default_parameters, **cohort.get('parameters', {}), **(parameters or {}))
+
+        # Input file hashes (reused while files are unchanged)
+        self.fingerprint_filename = os.path.join(work_dir, 'file_hashes.json')
+        self.fingerprints = {}
+        if os.path.isfile(self.fingerprint_filename):
+            with open(self.fingerprint_filename) as fingerprint_file:
+                self.fingerprints = json.load(fingerprint_file)
+
+        self.tasks = self._build_tasks()
+
+    def _build_tasks(self) -> dict:
+        '''Tasks {(session, stage): task} in dependency order with their keys'''
+
+        tasks = {}
+
+        def add_task(owner: str, stage: str, config: dict, inputs: dict, files: list, metadata=None):
+            stage_info = stages[stage]
+            key = hash_values(stage, stage_info['version'], {name: self.parameters[name] for name in stage_info['parameters']},
+                              [file_hash(filename, self.fingerprints) for filename in files],
+                              {name: tasks[dependency]['key'] for name, dependency in sorted(inputs.items())}, metadata)
+            tasks[owner, stage] = {'stage': stage, 'config': config, 'inputs': inputs, 'key': key,
+                                   'output_dir': os.path.join(self.work_dir, owner, stage)}
+
+        epoch_tasks = {}
+        for subject in self.cohort['subjects']:
+            for session in subject['sessions']:
+                owner = session_id(subject, session)
+                config = dict(session, eye=session.get('eye', subject.get('eye', 'left')))
+                for stage in session_stages:
+                    files = {'store': [config['eyelink']], 'trials': [config['log']]}.get(stage, [])
+                    add_task(owner, stage, config, {name: (owner, name) for name in stages[stage]['inputs']}, files)
+                epoch_tasks[owner] = (owner, 'epochs')
+
+        # Note: The subject labels (group, blind_side, aware, etc.) and sessions of each subject are part of the group
+        # output (subjects.json, subject order), so they are part of its key
+        subjects = [dict({name: value for name, value in subject.items() if name != 'sessions'},
+                         sessions=[session_id(subject, session) for session in subject['sessions']])
+                    for subject in self.cohort['subjects']]
+        add_task('cohort', 'group', self.cohort, epoch_tasks, [], subjects)
+
+        return tasks
+
+    def is_current(self, task: dict) -> bool:
+        '''Whether the task output exists with the same key'''
+
+        try:
+            with open(os.path.join(task['output_dir'], 'task.json')) as task_file:
+                return json.load(task_file)['key'] == task['key']
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def run(self, force: bool = False, log=print) -> dict:
+        '''Run all outdated tasks (dependencies first, independent tasks in parallel)
+        Returns {task: duration in seconds, "skipped", "cached", or "failed: <reason>"}
+        Note: A failed task only stops the tasks that depend on it'''
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        with open(self.fingerprint_filename, 'w') as fingerprint_file:
+            json.dump(self.fingerprints, fingerprint_file)
+
+        report = {}
+        pending = dict(self.tasks)
+        running = {}
+
+        # Up-to-date tasks
+        for name, task in list(pending.items()):
+            if not force and self.is_current(task):
+                report[name] = 'skipped'
+                del pending[name]
+
+        def finish(name, result):
+            report[name] = result
+            log('%s %s: %s' % (name[0], name[1], '%.2f s' % result if isinstance(result, float) else result))
+
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        try:
+            while pending or running:
+
+                # Tasks whose inputs are done (or failed)
+                ready = [name for name, task in pending.items() if all(dependency in report for dependency in task['inputs'].values())]
+                if not ready and not running:
+                    raise RuntimeError('Unresolved task dependencies: %s' % list(pending))
+
+                for name in ready:
+                    task = pending.pop(name)
+                    failed = [dependency for dependency in task['inputs'].values() if str(report[dependency]).startswith('failed')]
+                    if failed:
+                        finish(name, 'failed: input %s %s failed' % failed[0])
+                        continue
+
+                    inputs = {stage: self.tasks[dependency]['output_dir'] for stage, dependency in task['inputs'].items()}
+                    arguments = (task['stage'], task['config'], self.parameters, inputs, task['output_dir'], task['key'],
+                                 self.cache)
+                    if executor is None:
+                        try:
+                            finish(name, run_task(*arguments))
+                        except Exception as error:
+                            finish(name, 'failed: %r' % error)
+                    else:
+                        running[executor.submit(run_task, *arguments)] = name
+
+                # Wait for a task to finish
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        error = future.exception()
+                        finish(name, future.result() if error is None else 'failed: %r' % error)
+
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        return report
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Run the EyeLink subject and group analysis pipeline')
+    parser.add_argument('cohort', help='cohort file (JSON)')
+    parser.add_argument('--work-dir', default='pipeline_output', help='task output folder')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--set', nargs='*', default=[], metavar='NAME=VALUE', help='parameter overrides (JSON values)')
+    parser.add_argument('--force', action='store_true', help='rerun all tasks (cached outputs are still used)')
+    parser.add_argument('--cache-dir', help='result cache folder (shared by work folders)')
+    parser.add_argument('--cache-gb', type=float, default=100, help='result cache size limit (GB)')
+    options = parser.parse_args()
+
+    with open(options.cohort) as cohort_file:
+        cohort = json.load(cohort_file)
+
+    # Relative data paths are relative to the cohort file
+    cohort_dir = os.path.dirname(os.path.abspath(options.cohort))
+    for subject in cohort['subjects']:
+        for session in subject['sessions']:
+            for field in ('eyelink', 'log'):
+                session[field] = os.path.join(cohort_dir, session[field])
+
+    parameters = {}
+    for setting in options.set:
+        name, value = setting.split('=', 1)
+        parameters[name] = json.loads(value)
+
+    cache = ResultCache(options.cache_dir, options.cache_gb * 1024**3) if options.cache_dir else None
+    pipeline = Pipeline(cohort, options.work_dir, parameters, options.workers, cache)
+    report = pipeline.run(options.force)
+
+    print('%d tasks run, %d cached, %d skipped, %d failed' % (sum(isinstance(value, float) for value in report.values()),
+          sum(value == 'cached' for value in report.values()), sum(value == 'skipped' for value in report.values()),
+          sum(str(value).startswith('failed') for value in report.values())))
+
+    return 1 if any(str(value).startswith('failed') for value in report.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
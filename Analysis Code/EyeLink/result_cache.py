@@ -0,0 +1,254 @@
+# *********************************
+# *** INTERMEDIATE RESULT CACHE ***
+# *********************************
+
+# Content-addressed disk cache for pipeline stage outputs. Each entry is the output
+# folder of one task, stored under its task key (hash of the stage version,
+# parameters, input files, and upstream task keys), so results are reused across
+# work folders and parameter sweeps: a sweep over an epoching parameter reuses the
+# cached sample stores, cleaned pupil, and saccades of every session.
+#
+#   from result_cache import ResultCache
+#   cache = ResultCache('cache', max_bytes=50e9)
+#   if not cache.get(key, output_dir, stage='blinks'):
+#       ... compute output_dir ...
+#       cache.put(key, output_dir, stage='blinks')
+#   print(cache.stats())
+#
+# The cache size is limited; the least recently used entries are removed first.
+# Several processes can read and write the same cache at the same time: entries are
+# written to a temporary folder and renamed into place (the first writer of a key
+# wins), and entries are renamed away before being deleted.
+#
+#   python result_cache.py <cache folder>              (size and hit/miss statistics)
+#   python result_cache.py <cache folder> --max-gb 20  (evict down to 20 GB)
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Default cache size limit (bytes)
+default_max_bytes = 100 * 1024**3
+
+# Entry description file (stage, size, creation time)
+# Note: Its modification time is the last use time of the entry
+entry_filename = 'entry.json'
+
+# Files of a task output folder that are not cached
+excluded_files = ('task.json',)
+
+# *************
+# *** UTILS ***
+# *************
+
+def link_or_copy(source: str, destination: str):
+    '''Hard link a file (copy it if linking is not possible, e.g., across file systems)'''
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def folder_size(folder: str) -> int:
+    '''Total size of the files in a folder (bytes)'''
+
+    return sum(os.path.getsize(os.path.join(root, filename)) for root, _, filenames in os.walk(folder)
+               for filename in filenames)
+
+# *************
+# *** CACHE ***
+# *************
+
+class ResultCache:
+    '''Disk cache of task output folders by key
+    cache_dir: cache folder (created if needed); max_bytes: size limit
+    Note: Files are hard linked into and out of the cache when possible, so entries share
+    disk space with the work folders; the size limit counts each entry in full'''
+
+    def __init__(self, cache_dir: str, max_bytes: float = default_max_bytes):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.stats_filename = os.path.join(cache_dir, 'stats.log')
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def entry_dir(self, key: str) -> str:
+        '''Folder of a cache entry'''
+
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def _record(self, stage: str, event: str):
+        '''Add a hit/miss/store event to the statistics'''
+
+        # Note: Single short appends are atomic, so parallel workers can share the file
+        with open(self.stats_filename, 'a') as stats_file:
+            stats_file.write('%s\t%s\n' % (stage, event))
+
+    def get(self, key: str, output_dir: str, stage: str = '') -> bool:
+        '''Copy a cached entry into output_dir (created if needed); returns False if the key is not cached'''
+
+        entry_dir = self.entry_dir(key)
+        # Note: The entry is copied to a staging folder first, so a miss leaves no partial copy in output_dir
+        staging_dir = '%s.%d.get' % (os.path.normpath(output_dir), os.getpid())
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            # Mark the entry as used (also fails if the entry does not exist)
+            os.utime(os.path.join(entry_dir, entry_filename))
+            shutil.copytree(entry_dir, staging_dir, copy_function=link_or_copy,
+                            ignore=shutil.ignore_patterns(entry_filename))
+        except (OSError, shutil.Error):
+            # Note: A missing entry or an entry evicted while it was being read is a miss
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            self._record(stage, 'miss')
+            return False
+
+        # Move the complete copy into output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        shutil.copytree(staging_dir, output_dir, copy_function=os.replace, dirs_exist_ok=True)
+        shutil.rmtree(staging_dir)
+
+        self._record(stage, 'hit')
+        return True
+
+    def put(self, key: str, output_dir: str, stage: str = '') -> bool:
+        '''Store a task output folder under its key; returns False if the key was already cached'''
+
+        entry_dir = self.entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return False
+
+        temp_dir = '%s.%d.tmp' % (entry_dir, os.getpid())
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        shutil.copytree(output_dir, temp_dir, copy_function=link_or_copy, ignore=shutil.ignore_patterns(*excluded_files))
+        with open(os.path.join(temp_dir, entry_filename), 'w') as entry_file:
+            json.dump({'stage': stage, 'size': folder_size(temp_dir), 'created': time.time()}, entry_file)
+
+        # Note: Renaming onto an existing (non-empty) entry fails, so a concurrent writer of the same key wins
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return False
+
+        self._record(stage, 'store')
+        self.evict()
+        return True
+
+    def entries(self) -> list:
+        '''Cache entries (key, stage, size, last use time), least recently used first'''
+
+        entries = []
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for key in os.listdir(prefix_dir) if os.path.isdir(prefix_dir) else []:
+                # Note: Temporary folders (key.<pid>.tmp) and entries being evicted are skipped
+                if '.' in key:
+                    continue
+                entry_file_path = os.path.join(prefix_dir, key, entry_filename)
+                try:
+                    with open(entry_file_path) as entry_file:
+                        entry = json.load(entry_file)
+                    entries.append((key, entry['stage'], entry['size'], os.path.getmtime(entry_file_path)))
+                except (OSError, ValueError, KeyError):
+                    continue
+
+        return sorted(entries, key=lambda entry: entry[3])
+
+    def size(self) -> int:
+        '''Total size of the cache entries (bytes)'''
+
+        return sum(entry[2] for entry in self.entries())
+
+    def evict(self, max_bytes: float = None) -> list:
+        '''Remove the least recently used entries until the cache fits its size limit; returns the removed keys'''
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(entry[2] for entry in entries)
+        removed = []
+
+        for key, stage, size, _ in entries:
+            if total <= max_bytes:
+                break
+
+            # Note: The entry is renamed first, so readers never see a partly deleted entry
+            trash_dir = '%s.%d.evicted' % (self.entry_dir(key), os.getpid())
+            try:
+                os.rename(self.entry_dir(key), trash_dir)
+            except OSError:
+                # Already evicted by another process
+                continue
+            shutil.rmtree(trash_dir, ignore_errors=True)
+            total -= size
+            removed.append(key)
+            self._record(stage, 'evict')
+
+        return removed
+
+    def stats(self) -> dict:
+        '''Hit/miss/store/evict counts by stage ({stage: {event: count}})'''
+
+        stats = {}
+        try:
+            with open(self.stats_filename) as stats_file:
+                for line in stats_file:
+                    stage, _, event = line.rstrip('\n').partition('\t')
+                    counts = stats.setdefault(stage, {'hit': 0, 'miss': 0, 'store': 0, 'evict': 0})
+                    counts[event] = counts.get(event, 0) + 1
+        except FileNotFoundError:
+            pass
+
+        return stats
+
+    def clear_stats(self):
+        '''Reset the hit/miss statistics'''
+
+        try:
+            os.remove(self.stats_filename)
+        except FileNotFoundError:
+            pass
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Show or trim a pipeline result cache')
+    parser.add_argument('cache_dir', help='cache folder')
+    parser.add_argument('--max-gb', type=float, help='evict the least recently used entries down to this size')
+    parser.add_argument('--clear-stats', action='store_true', help='reset the hit/miss statistics')
+    options = parser.parse_args()
+
+    cache = ResultCache(options.cache_dir)
+    if options.max_gb is not None:
+        removed = cache.evict(options.max_gb * 1024**3)
+        print('%d entries evicted' % len(removed))
+
+    entries = cache.entries()
+    print('%d entries, %.2f GB' % (len(entries), sum(entry[2] for entry in entries) / 1024**3))
+    for stage, counts in sorted(cache.stats().items()):
+        lookups = counts['hit'] + counts['miss']
+        print('%-10s %5d hits %5d misses (%3.0f%% hit rate) %5d stored %5d evicted' % (
+              stage, counts['hit'], counts['miss'], counts['hit'] / lookups * 100 if lookups else 0,
+              counts['store'], counts['evict']))
+
+    if options.clear_stats:
+        cache.clear_stats()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
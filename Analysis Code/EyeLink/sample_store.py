@@ -0,0 +1,304 @@
+# ****************************
+# *** EYELINK SAMPLE STORE ***
+# ****************************
+
+# Memory-mapped, columnar on-disk layout for EyeLink recordings. Each session is
+# converted once from the edfmex .mat file (edf_data.FSAMPLE/FEVENT) into a store
+# folder with one contiguous binary array per channel, a time index of the
+# continuous recording segments, and the task messages:
+#
+#   store_dir/meta.json         sample rate, number of samples, channels, segments
+#   store_dir/time.bin          sample time stamps (ms, uint32)
+#   store_dir/<channel>_<eye>.bin   gx/gy/pa of the left and right eye (float32)
+#   store_dir/message_times.bin, messages.txt   task messages (type 24 events)
+#
+# Channels are opened as read-only memory maps, so slicing an epoch or iterating
+# over chunks only reads those samples from disk and never loads the session:
+#
+#   from sample_store import SampleStore
+#   store = SampleStore('P1_Perception_Task_1')
+#   for start, stop in store.chunks():
+#       pupil = store.channel('pa', 'left')[start:stop]
+#
+#   python sample_store.py <mat files> --output-dir <folder>
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Store format version
+store_version = 1
+
+# Default chunk size (in samples; 10 minutes at 1000 Hz)
+default_chunk_size = 600000
+
+# Sample channels of each eye (gaze x/y and pupil area, see file_sample_flags in the task)
+sample_channels = ('gx', 'gy', 'pa')
+
+# Eyes (edfmex row 1 = left; 2 = right)
+eyes = ('left', 'right')
+
+# Data types
+time_dtype = np.dtype('<u4')
+channel_dtype = np.dtype('<f4')
+
+# EyeLink message event type
+message_event_type = 24
+
+# ********************
+# *** STORE WRITER ***
+# ********************
+
+class SampleStoreWriter:
+    '''Append samples and messages chunk by chunk to a new sample store
+    store_dir: store folder (created; existing channel files are replaced)
+    sample_rate: in Hz'''
+
+    def __init__(self, store_dir: str, sample_rate: int = 1000, chunk_size: int = default_chunk_size):
+
+        self.store_dir = store_dir
+        self.sample_rate = sample_rate
+        self.chunk_size = chunk_size
+        self.num_samples = 0
+
+        # Continuous recording segments (first sample index, first time stamp)
+        self.segments = []
+        self.last_time = None
+
+        os.makedirs(store_dir, exist_ok=True)
+
+        # Channel files
+        self.time_file = open(os.path.join(store_dir, 'time.bin'), 'wb')
+        self.channel_files = {(channel, eye): open(os.path.join(store_dir, '%s_%s.bin' % (channel, eye)), 'wb')
+                              for channel in sample_channels for eye in eyes}
+
+        # Messages
+        self.message_times = []
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, time: np.ndarray, channels: dict):
+        '''Append samples
+        time: time stamps (ms); channels: {(channel, eye): values} (missing channels are stored as NaN)'''
+
+        time = np.asarray(time, dtype=np.int64)
+        if time.size == 0:
+            return
+
+        # Segment starts (first sample and time gaps)
+        # Note: A new segment starts wherever the time step is not one sample interval
+        interval = 1000 // self.sample_rate
+        steps = np.diff(time, prepend=time[0] if self.last_time is None else self.last_time)
+        for start in np.flatnonzero(steps != interval):
+            self.segments.append((self.num_samples + int(start), int(time[start])))
+
+        time.astype(time_dtype).tofile(self.time_file)
+        for key, channel_file in self.channel_files.items():
+            values = channels.get(key)
+            if values is None:
+                values = np.full(time.size, np.nan)
+            np.asarray(values, dtype=channel_dtype).tofile(channel_file)
+
+        self.num_samples += time.size
+        self.last_time = int(time[-1])
+
+    def add_message(self, time: int, message: str):
+        '''Add a task message'''
+
+        self.message_times.append(time)
+        self.messages.append(message.replace('\n', ' '))
+
+    def close(self):
+        '''Close the channel files and write the messages and store metadata'''
+
+        if self.time_file.closed:
+            return
+
+        self.time_file.close()
+        for channel_file in self.channel_files.values():
+            channel_file.close()
+
+        # Messages (sorted by time)
+        order = np.argsort(self.message_times, kind='stable')
+        np.asarray(self.message_times, dtype=time_dtype)[order].tofile(os.path.join(self.store_dir, 'message_times.bin'))
+        with open(os.path.join(self.store_dir, 'messages.txt'), 'w', encoding='utf-8') as message_file:
+            message_file.writelines(self.messages[i] + '\n' for i in order)
+
+        # Metadata
+        # Note: Written last, so an interrupted conversion leaves no readable store
+        meta = {'store_version': store_version, 'sample_rate': self.sample_rate, 'num_samples': self.num_samples,
+                'chunk_size': self.chunk_size, 'channels': list(sample_channels), 'eyes': list(eyes),
+                'segments': self.segments, 'num_messages': len(self.messages)}
+        with open(os.path.join(self.store_dir, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+# ********************
+# *** STORE READER ***
+# ********************
+
+class SampleStore:
+    '''Read-only, memory-mapped access to a sample store folder'''
+
+    def __init__(self, store_dir: str):
+
+        self.store_dir = store_dir
+
+        with open(os.path.join(store_dir, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+
+        if meta['store_version'] != store_version:
+            raise ValueError('Unsupported sample store version: %s' % meta['store_version'])
+
+        self.sample_rate = meta['sample_rate']
+        self.num_samples = meta['num_samples']
+        self.chunk_size = meta['chunk_size']
+
+        # Time index: continuous segments (first sample index, first time stamp, length)
+        segments = np.array(meta['segments'], dtype=np.int64).reshape(-1, 2)
+        self.segment_starts = segments[:, 0]
+        self.segment_times = segments[:, 1]
+        self.segment_lengths = np.diff(np.append(self.segment_starts, self.num_samples))
+
+        self.time = self._map('time.bin', time_dtype)
+        self._channels = {}
+        self._messages = None
+
+    def _map(self, filename: str, dtype: np.dtype) -> np.ndarray:
+        '''Read-only memory map of a store file'''
+
+        path = os.path.join(self.store_dir, filename)
+        num_values = os.path.getsize(path) // dtype.itemsize
+        if num_values == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(num_values,))
+
+    def channel(self, channel: str, eye: str) -> np.ndarray:
+        '''Memory-mapped channel (gx, gy, or pa) of the left or right eye'''
+
+        if (channel, eye) not in self._channels:
+            self._channels[channel, eye] = self._map('%s_%s.bin' % (channel, eye), channel_dtype)
+        return self._channels[channel, eye]
+
+    def sample_index(self, times) -> tuple:
+        '''Sample indices of time stamps (ms)
+        Returns (index, valid): valid is False for times outside the recording segments'''
+
+        times = np.asarray(times, dtype=np.int64)
+        interval = 1000 // self.sample_rate
+
+        # Segment of each time and offset within the segment
+        segment = np.searchsorted(self.segment_times, times, side='right') - 1
+        segment_clipped = np.maximum(segment, 0)
+        offset = (times - self.segment_times[segment_clipped]) // interval
+        valid = (segment >= 0) & (offset < self.segment_lengths[segment_clipped])
+
+        index = np.where(valid, self.segment_starts[segment_clipped] + offset, 0)
+        return index, valid
+
+    def time_slice(self, start_time: int, stop_time: int) -> slice:
+        '''Sample slice from start_time up to (not including) stop_time (ms)'''
+
+        time = self.time
+        return slice(int(np.searchsorted(time, start_time)), int(np.searchsorted(time, stop_time)))
+
+    def chunks(self, chunk_size: int = None):
+        '''Yield (start, stop) sample ranges of at most chunk_size samples'''
+
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, self.num_samples, chunk_size):
+            yield start, min(start + chunk_size, self.num_samples)
+
+    @property
+    def messages(self) -> tuple:
+        '''Task messages: (time stamps, message strings)'''
+
+        if self._messages is None:
+            with open(os.path.join(self.store_dir, 'messages.txt'), encoding='utf-8') as message_file:
+                messages = message_file.read().splitlines()
+            self._messages = (np.array(self._map('message_times.bin', time_dtype), dtype=np.int64), messages)
+        return self._messages
+
+    def find_messages(self, prefix: str) -> tuple:
+        '''Time stamps and messages starting with prefix'''
+
+        message_times, messages = self.messages
+        index = [i for i, message in enumerate(messages) if message.startswith(prefix)]
+        return message_times[index], [messages[i] for i in index]
+
+# *****************
+# *** CONVERTER ***
+# *****************
+
+def convert_mat(mat_filename: str, store_dir: str, sample_rate: int = 1000, chunk_size: int = default_chunk_size) -> SampleStore:
+    '''Convert an edfmex .mat file (edf_data.FSAMPLE/FEVENT) into a sample store
+    Note: MATLAB v5/v7 files are read once as a whole by SciPy (a struct cannot be read field by field), so the
+    memory needed is the loaded edf_data variable: all FSAMPLE fields in double precision, about the uncompressed
+    size of the file; samples are written chunk by chunk'''
+
+    from scipy.io import loadmat
+
+    edf_data = loadmat(mat_filename, squeeze_me=True, struct_as_record=False, variable_names=['edf_data'])['edf_data']
+    samples = edf_data.FSAMPLE
+
+    time = np.atleast_1d(samples.time)
+    channels = {channel: np.atleast_2d(getattr(samples, channel)) for channel in sample_channels}
+    messages = [(int(event.sttime), event.message) for event in np.atleast_1d(edf_data.FEVENT)
+                if event.type == message_event_type and isinstance(event.message, str)]
+
+    # Note: The other FSAMPLE fields (velocities, head target, raw pupil, etc.) are released before writing
+    del edf_data, samples
+
+    with SampleStoreWriter(store_dir, sample_rate, chunk_size) as writer:
+
+        # Samples
+        for start in range(0, time.size, chunk_size):
+            stop = start + chunk_size
+            writer.append(time[start:stop], {(channel, eye): values[num_eye, start:stop]
+                                             for channel, values in channels.items()
+                                             for num_eye, eye in enumerate(eyes) if num_eye < values.shape[0]})
+
+        # Messages
+        for message_time, message in messages:
+            writer.add_message(message_time, message)
+
+    return SampleStore(store_dir)
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Convert edfmex EyeLink .mat files into memory-mapped sample stores')
+    parser.add_argument('mat_files', nargs='+', help='edfmex .mat files')
+    parser.add_argument('--output-dir', default='.', help='folder of the sample stores (one subfolder per file)')
+    parser.add_argument('--sample-rate', type=int, default=1000, help='sampling rate (Hz)')
+    parser.add_argument('--chunk-size', type=int, default=default_chunk_size, help='samples per chunk')
+    options = parser.parse_args()
+
+    for mat_filename in options.mat_files:
+
+        store_dir = os.path.join(options.output_dir, os.path.splitext(os.path.basename(mat_filename))[0])
+        store = convert_mat(mat_filename, store_dir, options.sample_rate, options.chunk_size)
+
+        print('%s: %d samples, %d segments, %d messages' % (store_dir, store.num_samples, len(store.segment_starts),
+              len(store.messages[1])))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,462 @@
+# **************************
+# *** SYNTHETIC SESSIONS ***
+# **************************
+
+# Writes synthetic Glare Illusion main phase sessions for tests and benchmarks: an
+# edfmex-style EyeLink .mat file (edf_data.FSAMPLE/FEVENT) and the matching
+# behavioral .log, with the structure of Glare_Illusion_Paradigm_v8.py:
+#
+#   - 40 trials per block (8 glare, 8 nonglare, 8 iso, 8 white, 4 distractor plus,
+#     4 distractor cross; half left, half right), shuffled per block
+#   - 3-5 s pre- and post-stimulus ISIs (whole seconds), 3 s stimuli, up to 30 blocks
+#   - 1000 Hz binocular gaze and pupil samples with blinks (pupil 0, gaze missing),
+#     fixational drift, microsaccades (inhibited after stimulus onsets), and pupil
+#     constrictions that depend on the stimulus type (weaker in a blind hemifield)
+#   - distractor key presses with reaction times
+#
+#   python synthetic_sessions.py <output folder> --subjects 10 --blocks 8 --seed 0
+#
+# writes <subject>_Perception_Task_1.mat and <subject>_Session_1_..._v8.log for every
+# subject, plus a cohort file (cohort.json) for pipeline.py. Patients (every other
+# subject) get a random "blind_side" and "aware" field.
+#
+#   from synthetic_sessions import write_session
+#   write_session('P1_Perception_Task_1.mat', 'P1_Session_1_Glare_Illusion_Perception_v8.log',
+#                 np.random.default_rng(0), num_blocks=4, blind_side='left')
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.io import savemat
+from scipy.signal import lfilter
+
+from microsaccades import pixel_pitch, screen_center, viewing_distance
+
+# ******************
+# *** PARAMETERS ***
+# ******************
+
+# Task structure (see Glare_Illusion_Paradigm_v8.py)
+max_num_blocks = 30
+stim_counts = (8, 8, 8, 8, 4, 4)
+stim_names = ('Glare', 'Nonglare', 'Iso', 'White', 'Distractor Plus', 'Distractor Cross')
+distractor_stim_types = (4, 5)
+stimulus_duration = 3 # in seconds
+isi_range = (3, 5) # in seconds (inclusive)
+frame_duration = 1 / 60 # in seconds
+
+# Time before the first block and block break durations (in seconds)
+lead_in_duration = 10
+block_break_range = (15, 60)
+
+# Sampling rate (Hz) and first EyeLink time stamp (ms)
+sampling_rate = 1000
+first_time_stamp = 2000000
+
+# EyeLink missing gaze value (edfmex)
+missing_gaze = 1e8
+
+# Samples generated at once (memory is proportional to the chunk, not the session)
+chunk_size = 600000
+
+# Pupil (EyeLink area units): baseline, slow drift, and noise
+pupil_baseline = 3000
+pupil_drift_amplitude = 300
+pupil_noise = 10
+
+# Peak pupil response to each stimulus type (fraction of baseline; negative = constriction)
+# Note: Glare constricts more than nonglare (the glare illusion); the blind hemifield response is scaled
+pupil_response_amplitudes = (-0.08, -0.045, -0.06, -0.12, -0.03, -0.03)
+blind_response_scale = 0.4
+
+# Pupil impulse response (Hoeks & Levelt, 1993): t^n exp(-n t / t_max)
+pupil_response_n = 10.1
+pupil_response_t_max = 0.93 # in seconds
+
+# Blinks: rate (per second) at rest, during stimuli, and after stimulus offset; duration range (s)
+blink_rate = 0.25
+stimulus_blink_rate = 0.08
+offset_blink_rate = 0.8
+offset_blink_window = (0.2, 1.2)
+blink_duration_range = (0.1, 0.3)
+
+# Microsaccades: rate (per second), post-onset inhibition and rebound windows (s after onset)
+microsaccade_rate = 1.2
+inhibition_rate = 0.1
+inhibition_window = (0.1, 0.35)
+rebound_rate = 2.5
+rebound_window = (0.35, 0.6)
+microsaccade_amplitude = 0.4 # median in degrees (log-normal)
+
+# Fixational drift (pixels per sample) and measurement noise (pixels)
+drift_step = 0.05
+drift_reversion = 1e-4
+gaze_noise = 0.05
+
+# Distractor detection rates (sighted and blind hemifield) and reaction times (log-normal, s)
+detection_rate = 0.95
+blind_detection_rate = 0.3
+reaction_time = 0.55
+
+# Fixation break rate (per trial)
+fixation_break_rate = 0.05
+
+# Delay of flip-stamped EyeLink messages after the flip (ms, inclusive; sent as "<offset ms> <message>")
+message_offset_range = (0, 5)
+
+# Right eye offset from the left eye (pixels) and pupil scale
+right_eye_offset = (3, -1)
+right_pupil_scale = 0.97
+
+# ****************
+# *** SCHEDULE ***
+# ****************
+
+def session_schedule(rng: np.random.Generator, num_blocks: int) -> np.ndarray:
+    '''Main phase trials of a session (block, trial, stim_type, side, pre_isi, post_isi)
+    Note: Same layout as build_phase_schedule in the paradigm'''
+
+    schedule_dtype = [('block', 'i4'), ('trial', 'i4'), ('stim_type', 'i4'), ('side', 'i4'), ('pre_isi', 'i4'), ('post_isi', 'i4')]
+    block_types = np.repeat(np.arange(len(stim_counts)), stim_counts)
+    block_sides = np.concatenate([np.repeat([0, 1], count//2) for count in stim_counts])
+
+    schedule = np.zeros((num_blocks, block_types.size), dtype=schedule_dtype)
+    for block in range(num_blocks):
+        sides = block_sides.copy()
+        for stim_type in range(len(stim_counts)):
+            selected = block_types == stim_type
+            sides[selected] = rng.permutation(sides[selected])
+        order = rng.permutation(block_types.size)
+        schedule[block]['stim_type'] = block_types[order]
+        schedule[block]['side'] = sides[order]
+    schedule['block'] = np.arange(1, num_blocks+1)[:, None]
+    schedule['trial'] = np.arange(1, block_types.size+1)[None, :]
+    schedule['pre_isi'] = rng.integers(isi_range[0], isi_range[1], size=schedule.shape, endpoint=True)
+    schedule['post_isi'] = rng.integers(isi_range[0], isi_range[1], size=schedule.shape, endpoint=True)
+
+    return schedule
+
+def session_timeline(rng: np.random.Generator, schedule: np.ndarray) -> tuple:
+    '''Trial start, stimulus onset, and block start/end times of a session (in seconds from the task start)'''
+
+    trial_starts = np.zeros(schedule.shape)
+    onsets = np.zeros(schedule.shape)
+    block_times = np.zeros((schedule.shape[0], 2))
+
+    t = lead_in_duration
+    for block in range(schedule.shape[0]):
+        block_times[block, 0] = t
+        for trial in range(schedule.shape[1]):
+            trial_starts[block, trial] = t
+            # Note: The pre-stimulus interval starts on the next frame
+            onsets[block, trial] = t + frame_duration + schedule[block, trial]['pre_isi']
+            t = onsets[block, trial] + stimulus_duration + schedule[block, trial]['post_isi'] - frame_duration
+        block_times[block, 1] = t
+        t += rng.uniform(*block_break_range)
+
+    return trial_starts, onsets, block_times, t + lead_in_duration
+
+# ***********
+# *** LOG ***
+# ***********
+
+def format_array(values: np.ndarray) -> str:
+    '''Array as printed by NumPy in the task log (floats, wrapped lines)'''
+
+    return str(np.asarray(values, dtype=float))
+
+def session_log(rng: np.random.Generator, schedule: np.ndarray, trial_starts: np.ndarray, onsets: np.ndarray,
+                block_times: np.ndarray, end_time: float, blind_side: str = None) -> tuple:
+    '''Behavioral log lines and EyeLink messages ((time, message) in seconds) of a session'''
+
+    lines, messages = [], []
+
+    def log(t, message, level='EXP', eyelink=True, eyelink_message=None, flip=False):
+        lines.append('%.4f \t%s \t%s' % (t, level, message))
+        if eyelink:
+            # Note: v8 sends flip-stamped messages after the flip with the delay as a prefix
+            if flip:
+                offset = rng.integers(message_offset_range[0], message_offset_range[1], endpoint=True)
+                messages.append((t + offset / 1000, '%d %s' % (offset, eyelink_message or message)))
+            else:
+                messages.append((t, eyelink_message or message))
+
+    log(0, 'Start Experiment', eyelink=False)
+    log(lead_in_duration / 2, 'Starting Glare Illusion Main Phase')
+    log(lead_in_duration / 2, 'Button Condition: 1')
+
+    blind_code = {'left': 0, 'right': 1}.get(blind_side)
+    for block, block_schedule in enumerate(schedule):
+        block_start, block_end = block_times[block]
+        log(block_start, 'Waiting for start trigger')
+        log(block_start, 'Keypress: 5', 'DATA', eyelink=False)
+        log(block_start, 'Start trigger received')
+        log(block_start, 'Block #%d' % (block + 1))
+        log(block_start, 'Right Stimulus Location: (12, 5)')
+        log(block_start, 'Left Stimulus Location: (-12, 5)')
+        log(block_start, 'All Stimuli Type Array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor): ' +
+            format_array(block_schedule['stim_type']))
+        for stim_type, stim_name in enumerate(stim_names):
+            log(block_start, '%s Stimuli Location Array (0 = left; 1 = right): %s' %
+                (stim_name, format_array(block_schedule['side'][block_schedule['stim_type'] == stim_type])))
+
+        breaks = 0
+        for trial, trial_info in enumerate(block_schedule):
+            t = trial_starts[block, trial]
+            onset = onsets[block, trial]
+            if rng.random() < fixation_break_rate:
+                log(t, 'Fixation break: %.2f cm' % rng.uniform(3, 15))
+                breaks += 1
+            log(t, 'Starting Trial #%d' % trial_info['trial'], eyelink_message='Starting Trial %d' % trial_info['trial'])
+            log(t, 'Trial Pre-Stimulus Time: %d' % trial_info['pre_isi'])
+            log(t, 'Trial Post-Stimulus Time: %d' % trial_info['post_isi'])
+            log(t + frame_duration, 'Pre-stimulus interval', flip=True)
+            log(onset, 'Draw %s Stimulus' % stim_names[trial_info['stim_type']], flip=True)
+
+            # Distractor responses (fewer in the blind hemifield)
+            if trial_info['stim_type'] in distractor_stim_types:
+                rate = blind_detection_rate if trial_info['side'] == blind_code else detection_rate
+                rt = rng.lognormal(np.log(reaction_time), 0.25)
+                if rng.random() < rate and rt < stimulus_duration:
+                    log(onset + rt, 'Keypress: 1', 'DATA', eyelink=False)
+                    log(onset + rt + 0.004, 'Perceived Distractor')
+                    log(onset + rt + 0.004, 'Response RT: 1 %.4f' % rt)
+
+            log(onset + stimulus_duration, 'Post-stimulus interval', flip=True)
+
+        log(block_end, 'Block fixation breaks: %d' % breaks)
+        log(block_end, 'Block duration: %s' % (block_end - block_start))
+        log(block_end + 5, 'Keypress: space', 'DATA', eyelink=False)
+
+    log(end_time - lead_in_duration / 2, 'Starting Glare Illusion Perception Phase')
+    log(end_time, '*** END EXPERIMENT ***')
+
+    return lines, messages
+
+# ***************
+# *** SAMPLES ***
+# ***************
+
+def pupil_response(sample_rate: int = sampling_rate) -> np.ndarray:
+    '''Pupil response to a stimulus of the stimulus duration (peak 1)'''
+
+    t = np.arange(int(4 * sample_rate)) / sample_rate
+    impulse = t**pupil_response_n * np.exp(-pupil_response_n * t / pupil_response_t_max)
+    response = np.convolve(np.ones(int(stimulus_duration * sample_rate)), impulse)
+
+    return response / response.max()
+
+def event_times(rng: np.random.Generator, duration: float, max_rate: float, rate_function) -> np.ndarray:
+    '''Times of a Poisson process with a time-varying rate (thinning of a max_rate process)'''
+
+    candidates = np.sort(rng.uniform(0, duration, rng.poisson(max_rate * duration)))
+
+    return candidates[rng.random(candidates.size) < rate_function(candidates) / max_rate]
+
+def time_since(times: np.ndarray, events: np.ndarray) -> np.ndarray:
+    '''Time since the last event (inf before the first event)'''
+
+    index = np.searchsorted(events, times, side='right') - 1
+    return np.where(index >= 0, times - events[np.maximum(index, 0)], np.inf)
+
+def session_events(rng: np.random.Generator, onsets: np.ndarray, duration: float) -> tuple:
+    '''Blink intervals and microsaccade (time, duration, dx, dy in pixels) of a session'''
+
+    onsets = np.sort(onsets.ravel())
+    offsets = onsets + stimulus_duration
+
+    # Blinks: suppressed during stimuli, frequent shortly after stimulus offsets
+    def blink_rate_at(t):
+        since_onset, since_offset = time_since(t, onsets), time_since(t, offsets)
+        rate = np.where(since_onset < stimulus_duration, stimulus_blink_rate, blink_rate)
+        return np.where((since_offset >= offset_blink_window[0]) & (since_offset < offset_blink_window[1]), offset_blink_rate, rate)
+
+    blink_starts = event_times(rng, duration, offset_blink_rate, blink_rate_at)
+    blink_ends = blink_starts + rng.uniform(*blink_duration_range, blink_starts.size)
+
+    # Microsaccades: inhibited after stimulus onsets, then a rebound
+    def microsaccade_rate_at(t):
+        since_onset = time_since(t, onsets)
+        rate = np.where((since_onset >= inhibition_window[0]) & (since_onset < inhibition_window[1]), inhibition_rate, microsaccade_rate)
+        return np.where((since_onset >= rebound_window[0]) & (since_onset < rebound_window[1]), rebound_rate, rate)
+
+    saccade_times = event_times(rng, duration, rebound_rate, microsaccade_rate_at)
+    amplitude = rng.lognormal(np.log(microsaccade_amplitude), 0.5, saccade_times.size)
+    direction = rng.uniform(0, 2*np.pi, saccade_times.size)
+    # Note: Amplitude in pixels at the screen center; duration grows with amplitude (main sequence)
+    amplitude_pixels = np.tan(np.radians(amplitude)) * viewing_distance / pixel_pitch
+    saccades = np.stack([saccade_times, 0.015 + 0.0022 * amplitude, amplitude_pixels * np.cos(direction),
+                         amplitude_pixels * np.sin(direction)], axis=1)
+
+    return np.stack([blink_starts, blink_ends], axis=1), saccades
+
+def session_samples(rng: np.random.Generator, schedule: np.ndarray, onsets: np.ndarray, duration: float,
+                    blind_side: str = None) -> tuple:
+    '''Binocular gaze (pixels) and pupil samples of a session
+    Returns time stamps (ms) and {channel: 2 x samples} for gx, gy, and pa (float32)'''
+
+    num_samples = int(duration * sampling_rate)
+    blinks, saccades = session_events(rng, onsets, duration)
+    response = pupil_response()
+
+    # Pupil response amplitude of every trial
+    blind_code = {'left': 0, 'right': 1}.get(blind_side)
+    amplitudes = np.array(pupil_response_amplitudes)[schedule['stim_type']] * pupil_baseline
+    amplitudes = np.where(schedule['side'] == blind_code, amplitudes * blind_response_scale, amplitudes)
+    amplitudes *= rng.lognormal(0, 0.3, amplitudes.shape)
+    onset_samples = np.round(onsets * sampling_rate).astype(np.int64).ravel()
+    amplitudes = amplitudes.ravel()
+
+    # Session channels (edfmex rows: left eye, right eye)
+    time = first_time_stamp + np.arange(num_samples, dtype=np.float64)
+    channels = {channel: np.zeros((2, num_samples), dtype=np.float32) for channel in ('gx', 'gy', 'pa')}
+    drift_phase = rng.uniform(0, 2*np.pi, 2)
+    pupil_walk, gaze_state = 0.0, [np.zeros(1), np.zeros(1)]
+
+    # Note: Samples are generated in chunks; random walks carry their state across chunks
+    for start in range(0, num_samples, chunk_size):
+        stop = min(start + chunk_size, num_samples)
+        t = np.arange(start, stop) / sampling_rate
+
+        # Pupil: slow drift, random walk, stimulus responses, and noise
+        pupil = pupil_baseline + pupil_drift_amplitude * (0.6*np.sin(2*np.pi*t/97 + drift_phase[0]) +
+                                                          0.4*np.sin(2*np.pi*t/23 + drift_phase[1]))
+        walk = pupil_walk + np.cumsum(rng.normal(0, 0.5, stop - start))
+        pupil_walk = walk[-1]
+        pupil += walk
+        for onset, amplitude in zip(onset_samples, amplitudes):
+            low, high = max(onset, start), min(onset + response.size, stop)
+            if low < high:
+                pupil[low - start:high - start] += amplitude * response[low - onset:high - onset]
+
+        # Gaze: mean-reverting drift plus microsaccade steps (raised cosine position profiles)
+        steps = rng.normal(0, drift_step, (2, stop - start))
+        for saccade_time, saccade_duration, dx, dy in saccades[(saccades[:, 0] * sampling_rate >= start) &
+                                                                (saccades[:, 0] * sampling_rate < stop)]:
+            first = int(saccade_time * sampling_rate) - start
+            length = max(int(saccade_duration * sampling_rate), 2)
+            profile = np.diff(0.5 - 0.5*np.cos(np.linspace(0, np.pi, length + 1)))[:stop - start - first]
+            steps[0, first:first + profile.size] += dx * profile
+            steps[1, first:first + profile.size] += dy * profile
+        gaze = []
+        for axis in range(2):
+            position, gaze_state[axis] = lfilter([1], [1, -(1 - drift_reversion)], steps[axis], zi=gaze_state[axis])
+            gaze.append(position)
+
+        for eye in range(2):
+            scale = right_pupil_scale if eye else 1
+            channels['pa'][eye, start:stop] = pupil * scale + rng.normal(0, pupil_noise, stop - start)
+            channels['gx'][eye, start:stop] = (screen_center[0] + gaze[0] + right_eye_offset[0] * eye +
+                                               rng.normal(0, gaze_noise, stop - start))
+            channels['gy'][eye, start:stop] = (screen_center[1] + gaze[1] + right_eye_offset[1] * eye +
+                                               rng.normal(0, gaze_noise, stop - start))
+
+    # Blinks: pupil closes over 30 ms, then no pupil or gaze
+    for blink_start, blink_end in np.round(blinks * sampling_rate).astype(np.int64):
+        ramp_start = max(blink_start - 30, 0)
+        channels['pa'][:, ramp_start:blink_start] *= np.linspace(1, 0.4, blink_start - ramp_start, dtype=np.float32)
+        channels['pa'][:, blink_start:blink_end] = 0
+        channels['gx'][:, blink_start:blink_end] = missing_gaze
+        channels['gy'][:, blink_start:blink_end] = missing_gaze
+
+    return time, channels
+
+# **************
+# *** WRITER ***
+# **************
+
+def write_session(mat_filename: str, log_filename: str, rng: np.random.Generator, num_blocks: int = 8,
+                  blind_side: str = None) -> dict:
+    '''Write a synthetic session (.mat and .log); returns its number of trials and samples'''
+
+    if not 1 <= num_blocks <= max_num_blocks:
+        raise ValueError('The number of blocks must be between 1 and %d' % max_num_blocks)
+
+    schedule = session_schedule(rng, num_blocks)
+    trial_starts, onsets, block_times, duration = session_timeline(rng, schedule)
+    lines, messages = session_log(rng, schedule, trial_starts, onsets, block_times, duration, blind_side)
+    time, channels = session_samples(rng, schedule, onsets, duration, blind_side)
+
+    with open(log_filename, 'w') as log_file:
+        log_file.write('\n'.join(lines) + '\n')
+
+    # EyeLink messages (type 24 events)
+    events = np.zeros((1, len(messages)), dtype=[('type', 'O'), ('sttime', 'O'), ('message', 'O')])
+    for index, (t, message) in enumerate(messages):
+        events[0, index] = (24, float(first_time_stamp + round(t * sampling_rate)), message)
+    # Note: Samples are saved as single precision (edfmex saves doubles) to halve the file size
+    savemat(mat_filename, {'edf_data': {'FSAMPLE': dict(time=time, **channels), 'FEVENT': events}})
+
+    return {'trials': int(schedule.size), 'samples': int(time.size)}
+
+def _write_subject(task: tuple) -> str:
+    '''Write the session of one cohort subject (worker task)'''
+
+    output_dir, subject, num_blocks, seed = task
+    session = subject['sessions'][0]
+    write_session(os.path.join(output_dir, session['eyelink']), os.path.join(output_dir, session['log']),
+                  np.random.default_rng(seed), num_blocks, subject.get('blind_side'))
+
+    return subject['id']
+
+def write_cohort(output_dir: str, num_subjects: int, num_blocks: int = 8, seed: int = 0, workers: int = 1,
+                 log=print) -> dict:
+    '''Write synthetic sessions of a cohort (patients and controls alternate) and its cohort file'''
+
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    subjects = []
+    for number in range(num_subjects):
+        patient = number % 2 == 0
+        subject_id = '%s%d' % ('P' if patient else 'C', number // 2 + 1)
+        subject = {'id': subject_id, 'group': 'patient' if patient else 'control', 'eye': 'left',
+                   'sessions': [{'id': '1', 'eyelink': '%s_Perception_Task_1.mat' % subject_id,
+                                 'log': '%s_Session_1_Glare_Illusion_Perception_v8.log' % subject_id}]}
+        if patient:
+            subject.update(blind_side=str(rng.choice(['left', 'right'])), aware=bool(rng.random() < 0.5))
+        subjects.append(subject)
+
+    tasks = [(output_dir, subject, num_blocks, [seed, number]) for number, subject in enumerate(subjects)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for subject_id in executor.map(_write_subject, tasks):
+                log('Subject %s written' % subject_id)
+    else:
+        for task in tasks:
+            log('Subject %s written' % _write_subject(task))
+
+    cohort = {'subjects': subjects}
+    with open(os.path.join(output_dir, 'cohort.json'), 'w') as cohort_file:
+        json.dump(cohort, cohort_file, indent=1)
+
+    return cohort
+
+# ********************
+# *** COMMAND LINE ***
+# ********************
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Write synthetic Glare Illusion sessions (.mat and .log) and a cohort file')
+    parser.add_argument('output_dir', help='output folder')
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--blocks', type=int, default=8, help='main phase blocks per session (1-%d)' % max_num_blocks)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    options = parser.parse_args()
+
+    write_cohort(options.output_dir, options.subjects, options.blocks, options.seed, options.workers)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,413 +12,1748 @@ task_version = 'v8'
 # *** IMPORTANT LIBRARIES ***
 # ***************************
 
-# Python and Psychopy Functions
-import random
-import warnings
-from psychopy import visual, gui, data, core, event, monitors, logging, sound 
-from psychopy.hardware import keyboard
-import numpy as np
+# Startup time
+# Note: Used for the startup timing breakdown
 import time
-import pylink
+import_start = time.perf_counter()
+
+# Python Functions
+import argparse
+import sys
+import numpy as np
 import os
 import platform
-import sys
-from scipy.signal import find_peaks
-import argparse
+import csv
+import threading
+import queue
+import json
 from collections import deque
-from scipy.io import loadmat, savemat
-import statistics 
-from scipy.signal import savgol_filter, find_peaks, peak_prominences
-from scipy.optimize import curve_fit
-import math
-
-# EyeLink Functions
-from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
-from PIL import Image
+from functools import cached_property
 from string import ascii_letters, digits
 
-# ********************
-# *** SETUP SCREEN ***
-# ********************
+# Psychopy and EyeLink Functions
+# Note: Imported by the session on first use (see TaskSession.modules), so the
+# task can be imported without starting PsychoPy or connecting to EyeLink
+visual = gui = data = core = event = keyboard = logging = pylink = EyeLinkCoreGraphicsPsychoPy = None
+
+# Command line options
+# Note: "--simulate" runs the whole task headless with a simulated window, keyboard,
+# clock, and EyeLink and a scripted virtual participant (see headless_simulation.py)
+parser = argparse.ArgumentParser(description='Glare Illusion Perception Task')
+parser.add_argument('--simulate', action='store_true', help='run headless in simulated time with a virtual participant')
+parser.add_argument('--seed', type=int, default=None, help='simulation: session and participant random seed')
+parser.add_argument('--time-scale', type=float, default=0, help='simulation: speed-up over real time (0 = as fast as possible)')
+parser.add_argument('--blocks', type=int, default=None, help='simulation: number of blocks per task phase (default = all)')
+parser.add_argument('--trace', action='store_true', help='write a Chrome trace file of the task phases, blocks, trials, and intervals')
+
+# Module import duration
+import_duration = time.perf_counter() - import_start
+
+# ***********************
+# *** TASK PARAMETERS ***
+# ***********************
+
+# Setup the subject info screen
+info_defaults = {'Session #': 1, 'Subject ID': 'Test', 'EyeLink': ['n','y'], 'EyeLink EDF': 'test.edf', 'Button Condition':['1','2'], '(1) Skip Positioning Phase': ['n','y'],
+                 '(1) Positioning Mode': ['manual','adaptive'], 'Blind Field': ['left','right','upper left','lower left','upper right','lower right'],
+                 '(2) Skip Main Phase': ['n','y'], '(3) Skip Brightness Phase': ['n','y'], 'Final X position':0,'Final Y position':0, 'Random Seed': ''}
+
+# Set this variable to True if you use the built-in retina screen as your
+# primary display device on macOS. If have an external monitor, set this
+# variable True if you choose to "Optimize for Built-in Retina Display"
+# in the Displays preference settings.
+use_retina = True
+
+# Define screen resolution
+resolution = [2560, 1440]
+
+# Nominal screen refresh rate (Hz)
+# Note: Only used if the refresh rate cannot be measured
+nominal_frame_rate = 60
+
+# Data folders
+behavioral_folder = 'Behavioral_Data'
+eyelink_folder = 'EyeLink_Data'
+
+# Max block number
+max_num_blocks = 30
+
+# Main Task Phase
+
+# Number of stimuli
+num_glare_stim = 8
+num_nonglare_stim = 8
+num_iso_stim = 8
+num_white_stim = 8
+num_distractor_plus_stim = 4
+num_distractor_cross_stim = 4
+
+# Stimulus duration
+stimulus_duration = 3 # in seconds
+
+# Set inter-stimulus interval (ISI) min and max durations
+ISI_min_duration_sec = 3 # in seconds
+ISI_max_duration_sec = 5 # in seconds
+
+# Stimulus start locations
+start_stim_x_pos = 12 # in centimeters
+start_stim_y_pos = 5 # in centimeters
+
+# Adaptive stimulus positioning
+# Note: Brief distractors are shown in the blind field, and staircases on the stimulus position 
+# (x: distance from the vertical meridian; y: height, for quadrant blind fields) converge on the 
+# position where the distractor detection rate is the target rate (see Staircase)
+positioning_target_rate = 0.25 # blind field distractor detection rate
+positioning_initial_step = 2 # in centimeters (step into the blind field after a detection)
+positioning_min_step = 0.25 # in centimeters (as the manual positioning)
+positioning_reversals = 8 # staircase reversals before stopping
+positioning_max_trials = 60 # blind field trials (all staircases)
+positioning_x_limits = (4, 20) # in centimeters
+positioning_y_limits = (-10, 10) # in centimeters
+positioning_flash_duration = 0.2 # in seconds
+positioning_response_window = 1.5 # in seconds from distractor onset
+positioning_ISI = (1, 2) # in seconds (random interval before each distractor)
+positioning_catch_rate = 0.2 # fraction of distractors shown in the sighted field (mirrored position)
+
+# Distractor stimulus types
+distractor_stim_types = (4, 5)
+
+# Fixation monitoring
+# Note: Gaze further than the break radius from the fixation cross for longer than
+# the minimum duration during stimulus presentation is a fixation break
+fixation_break_radius = 3 # in centimeters
+fixation_break_min_duration = 0.05 # in seconds
+gaze_buffer_duration = 2 # in seconds (link samples kept in the ring buffer)
+
+# Repeat main phase trials with a fixation break at the end of the block (once per trial)
+# Note: Repeated trials reuse their trial number (see README before enabling)
+rerun_fixation_break_trials = False
+
+# Online pupil preprocessing
+# Note: Blinks (missing pupil samples) are padded and linearly interpolated as in 
+# Stublinks60.m (4 and 9 samples at 60 Hz before/after each blink), and trials are 
+# rejected with the blink and extreme pupil thresholds of the offline analysis
+pupil_blink_padding = (0.067, 0.15) # in seconds before/after each blink
+pupil_max_interpolated_blink = 0.5 # in seconds (longer blinks are not interpolated)
+pupil_baseline_duration = 1 # in seconds before stimulus onset
+pupil_response_window = 3 # in seconds after stimulus onset
+pupil_blink_threshold = 0.5 # max fraction of blink samples in the response window
+pupil_extreme_threshold = 1750 # max baseline-corrected pupil size (EyeLink pupil units)
+
+# Brightness Perception Phase
+
+# Number of contrast types
+num_glare_vs_nonglare = 10
+num_glare_vs_iso = 10
+num_nonglare_vs_iso = 10
+
+# Pre-stimulus interval
+brightness_pre_stim_time = 2 # in seconds
+
+# Stimuli
+
+# Define stimulus image directory
+_thisDir = os.path.dirname(os.path.abspath(__file__))
+
+# Stimuli directories
+glare_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'glare_square.png';
+nonglare_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'nonglare_square.png';
+iso_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'iso_square.png';
+white_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'white_square.png';
+black_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'black_square.png';
+distractor_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'red_square.png';
+
+# Stimuli size
+stim_x_size = 7 # in centimeters
+stim_y_size = 7 # in centimeters
+
+# ************************
+# *** SESSION SCHEDULE ***
+# ************************
+
+# Schedule fields
+schedule_dtype = [('block', 'i4'), ('trial', 'i4'), ('stim_type', 'i4'), ('side', 'i4'), ('pre_isi', 'i4'), ('post_isi', 'i4')]
+
+def build_phase_schedule(rng: np.random.Generator, stim_counts: list, pre_isi_range: tuple, post_isi_range: tuple) -> np.ndarray:
+    '''Generate the trial schedule of every block of a task phase
+    stim_counts: number of trials of each stimulus type per block (half left, half right)
+    pre_isi_range/post_isi_range: min and max ISI in whole seconds (inclusive)
+    Returns a (block x trial) structured array with block, trial, stim_type, side, pre_isi, and post_isi fields'''
+
+    # Stimulus types and locations of one block, grouped by stimulus type
+    block_types = np.repeat(np.arange(len(stim_counts)), stim_counts)
+    block_sides = np.concatenate([np.repeat([0, 1], count//2) for count in stim_counts])
+    num_trials = block_types.size
+
+    # Shuffle locations within each stimulus type for all blocks
+    # Note: Sorting by stimulus type and then a random key permutes each type independently
+    random_keys = rng.random((max_num_blocks, num_trials))
+    side_order = np.lexsort((random_keys, np.broadcast_to(block_types, random_keys.shape)), axis=-1)
+    sides = block_sides[side_order]
+
+    # Shuffle trial order for all blocks
+    trial_order = np.argsort(rng.random((max_num_blocks, num_trials)), axis=-1)
+
+    # Create schedule
+    schedule = np.zeros((max_num_blocks, num_trials), dtype=schedule_dtype)
+    schedule['block'] = np.arange(1, max_num_blocks+1)[:, None]
+    schedule['trial'] = np.arange(1, num_trials+1)[None, :]
+    schedule['stim_type'] = block_types[trial_order]
+    schedule['side'] = np.take_along_axis(sides, trial_order, axis=-1)
+    schedule['pre_isi'] = rng.integers(pre_isi_range[0], pre_isi_range[1], size=(max_num_blocks, num_trials), endpoint=True)
+    schedule['post_isi'] = rng.integers(post_isi_range[0], post_isi_range[1], size=(max_num_blocks, num_trials), endpoint=True)
+
+    return schedule
+
+# *********************
+# *** STIMULUS POOL ***
+# *********************
+
+class StimulusPool:
+    '''Create every stimulus and text object once at startup and reuse it
+    
+    Objects are created with add() and drawn once off-screen by preload(), so
+    textures are uploaded and text is laid out before the task starts. The 
+    time each object takes to create and first draw is logged. Objects added 
+    after preload() are uploaded immediately and logged as a warning, so any 
+    upload during a timed task phase shows in the log.'''
+    
+    def __init__(self, win):
+        
+        # Window
+        self.win = win
+        
+        # Pooled objects and their creation/first draw times (in seconds)
+        self.stimuli = {}
+        self.create_times = {}
+        self.upload_times = {}
+        
+        # Preload status
+        self.preloaded = False
+        
+    def add(self, stim_class, **kwargs):
+        '''Create a stimulus object and add it to the pool under its name'''
+        
+        # Create object
+        create_start = core.getTime()
+        stimulus = stim_class(**kwargs)
+        self.create_times[kwargs['name']] = core.getTime() - create_start
+        self.stimuli[kwargs['name']] = stimulus
+        
+        # Upload now if the pool was already preloaded
+        if self.preloaded:
+            self._upload(kwargs['name'])
+            logging.warning('Stimulus uploaded after preload: ' + kwargs['name'])
+        
+        return stimulus
+    
+    def get(self, name: str, text: str = None, pos: tuple = None):
+        '''Return a pooled object with updated text and/or position'''
+        
+        stimulus = self.stimuli[name]
+        
+        # Only lay out the text again if it changed
+        if text is not None and stimulus.text != text:
+            stimulus.text = text
+            
+        # Update position
+        if pos is not None:
+            stimulus.pos = pos
+        
+        return stimulus
+    
+    def preload(self) -> None:
+        '''Draw every pooled object once off-screen and log the upload times'''
+        
+        # Loop over objects not yet drawn
+        for name in self.stimuli:
+            if name not in self.upload_times:
+                self._upload(name)
+                
+        # Remove preload drawing from the back buffer
+        self.win.clearBuffer()
+        self.preloaded = True
+        
+        # Log
+        total_time = sum(self.create_times.values()) + sum(self.upload_times.values())
+        logging.log(level=logging.EXP,msg='Stimulus preload duration: %.1f ms (%d objects)' % (total_time*1000, len(self.stimuli)))
+    
+    def _upload(self, name: str) -> None:
+        '''Draw an object to the back buffer and log the create/first draw time'''
+        
+        # First draw
+        upload_start = core.getTime()
+        self.stimuli[name].draw()
+        self.upload_times[name] = core.getTime() - upload_start
+        
+        # Log
+        logging.log(level=logging.EXP,msg='Stimulus upload: %s (create %.2f ms; first draw %.2f ms)' % 
+                    (name, self.create_times[name]*1000, self.upload_times[name]*1000))
+
+# ************************
+# *** EVENT DISPATCHER ***
+# ************************
+
+class EventDispatcher:
+    '''Send task events to the log file and EyeLink from a background thread
+    
+    Events are stamped on the render thread (either immediately or on the next
+    window flip) and written by a worker thread that takes all queued events
+    as one batch, so log file and EyeLink link I/O stay off the render thread.
+    Flip-stamped events are sent to EyeLink with the standard message time 
+    offset prefix ("<offset ms> <message>"), so the EDF timestamp is the flip 
+    time rather than the time the message was sent.'''
+    
+    def __init__(self, win, el_tracker, max_batch_size: int = 64):
+        
+        # Window and EyeLink tracker
+        self.win = win
+        self.el_tracker = el_tracker
+        
+        # Maximum number of events written per batch
+        self.max_batch_size = max_batch_size
+        
+        # Queue of (timestamp, log message, EyeLink message, flip-stamped) events
+        self.event_queue = queue.Queue()
+        
+        # Start worker thread
+        self.worker = threading.Thread(target=self._dispatch_events, name='EventDispatcher', daemon=True)
+        self.worker.start()
+    
+    def send(self, msg: str, eyelink_msg: str = None) -> None:
+        '''Queue an event stamped with the current time
+        eyelink_msg: EyeLink message text, if different from the log message'''
+        
+        self.event_queue.put((logging.defaultClock.getTime(), msg, eyelink_msg or msg, False))
+    
+    def send_on_flip(self, msg: str, eyelink_msg: str = None) -> None:
+        '''Queue an event stamped with the time of the next window flip
+        eyelink_msg: EyeLink message text, if different from the log message'''
+        
+        self.win.callOnFlip(self._stamp_flip, msg, eyelink_msg or msg)
+    
+    def drain(self) -> None:
+        '''Wait until all queued events have been written'''
+        
+        self.event_queue.join()
+    
+    def stop(self) -> None:
+        '''Write all queued events and stop the worker thread'''
+        
+        if self.worker.is_alive():
+            self.event_queue.put(None)
+            self.worker.join()
+    
+    def _stamp_flip(self, msg: str, eyelink_msg: str) -> None:
+        '''Flip callback: runs right after the buffer swap'''
+        
+        self.event_queue.put((logging.defaultClock.getTime(), msg, eyelink_msg, True))
+    
+    def _dispatch_events(self) -> None:
+        '''Worker loop: write queued events in batches'''
+        
+        running = True
+        
+        while running:
+            
+            # Wait for the next event, then take everything else already queued
+            batch = [self.event_queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.event_queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            # Write batch
+            for item in batch:
+                
+                # Stop signal
+                if item is None:
+                    running = False
+                    continue
+                
+                t, msg, eyelink_msg, flip_stamped = item
+                
+                # Log with the event time
+                logging.log(level=logging.EXP, msg=msg, t=t)
+                
+                # EyeLink message (with time offset if stamped on a flip)
+                if flip_stamped:
+                    offset = int(round((logging.defaultClock.getTime() - t)*1000))
+                    self.el_tracker.sendMessage('%d %s' % (offset, eyelink_msg))
+                else:
+                    self.el_tracker.sendMessage(eyelink_msg)
+            
+            # Mark batch written
+            for item in batch:
+                self.event_queue.task_done()
+
+# *******************
+# *** EVENT STORE ***
+# *******************
+
+# Event file fields
+# Note: Fixed-size little-endian records without a header, so blocks can be appended
+# and the file read with np.fromfile (Python) or memmapfile (MATLAB)
+event_dtype = np.dtype([('phase', '<i4'), ('record', '<i4'), ('block', '<i4'), ('trial', '<i4'), ('stim_type', '<i4'), ('side', '<i4'),
+                        ('onset', '<f8'), ('offset', '<f8'), ('response', '<i4'), ('rt', '<f8'), ('fixation_break', '<i4')])
+
+# Event file codes
+phase_codes = {'main': 0, 'brightness': 1}
+record_codes = {'trial': 0, 'response': 1}
+
+class EventStore:
+    '''Typed per-trial and per-response records, appended to a binary file in batches
+    
+    Rows are buffered in memory during a block and written with flush() at the
+    block boundary, so no file I/O happens during trials.'''
+    
+    def __init__(self, filename: str):
+        
+        # Event file and rows not yet written
+        self.filename = filename
+        self.rows = []
+    
+    def add(self, phase: str, record: str, block: int, trial: int, stim_type: int, side: int,
+            onset: float = np.nan, offset: float = np.nan, response: int = 0, rt: float = np.nan, fixation_break: bool = False) -> None:
+        '''Buffer one row
+        onset/offset: stimulus onset/offset flip times (trial) or key press time (response), log clock in seconds
+        response: response key (0 = no response); rt: reaction time from stimulus onset (in seconds)
+        fixation_break: gaze left fixation during the stimulus'''
+        
+        self.rows.append((phase_codes[phase], record_codes[record], block, trial, stim_type, side, onset, offset, response, rt, int(fixation_break)))
+    
+    def flush(self) -> None:
+        '''Append the buffered rows to the event file'''
+        
+        if not self.rows:
+            return
+        
+        with open(self.filename, 'ab') as event_file:
+            np.array(self.rows, dtype=event_dtype).tofile(event_file)
+        self.rows = []
+
+# ***********************
+# *** TIMING RECORDER ***
+# ***********************
+
+# Timing file fields
+# Note: Fixed-size little-endian records without a header (as the event file)
+# kind: flip (value = interval since the previous flip, NaN after a wait), message (EyeLink sendMessage),
+# log (logging.log), key_poll (getKeys), wait (waitKeys); value: duration in seconds; time: log clock in seconds
+timing_dtype = np.dtype([('phase', 'u1'), ('kind', 'u1'), ('block', '<u2'), ('trial', '<u2'), ('time', '<f8'), ('value', '<f4')])
+
+# Timing file codes
+timing_phase_codes = {'setup': 0, 'positioning': 1, 'main': 2, 'brightness': 3}
+timing_kind_codes = {'flip': 0, 'message': 1, 'log': 2, 'key_poll': 3, 'wait': 4}
+
+class TimingRecorder:
+    '''Per-frame timing records (flip intervals, message/log latency, key poll cost), tagged with the task
+    phase, block, and trial, and appended to a binary file in batches
+
+    The window flip, EyeLink sendMessage, logging.log, and getKeys/waitKeys functions are
+    replaced with timed wrappers by instrument(), so every call is recorded without changing
+    the call sites. Rows are buffered in memory and written with flush() at the block boundary.
+    Note: Calls from the event dispatcher thread are tagged with the trial current at the time
+    they are written; rows are buffered in a deque, so rows added by that thread during a
+    flush are kept for the next flush'''
+
+    def __init__(self, filename: str, frame_duration: float):
+
+        # Timing file, nominal frame duration, and rows not yet written
+        self.filename = filename
+        self.frame_duration = frame_duration
+        self.rows = deque()
+
+        # Current phase, block, and trial
+        self.context = (timing_phase_codes['setup'], 0, 0)
+
+        # Time of the previous flip (None after a wait)
+        self.last_flip = None
+
+    def set_context(self, phase: str, block: int = 0, trial: int = 0) -> None:
+        '''Tag the following records with a task phase, block, and trial (0 = none)'''
+
+        self.context = (timing_phase_codes[phase], block, trial)
+
+    def instrument(self, owner, attribute: str, kind: str) -> None:
+        '''Replace a function (e.g., win.flip) with a timed wrapper'''
+
+        original = getattr(owner, attribute)
+        kind_code = timing_kind_codes[kind]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = original(*args, **kwargs)
+            duration = time.perf_counter() - start
+
+            # Flip: interval from the previous flip time (returned by flip)
+            if kind == 'flip':
+                value = result - self.last_flip if self.last_flip is not None else np.nan
+                self.last_flip = result
+            else:
+                value = duration
+
+                # Waiting for a key press interrupts the frame sequence
+                if kind == 'wait':
+                    self.last_flip = None
+
+            self.rows.append(self.context + (kind_code, logging.defaultClock.getTime(), value))
+
+            return result
+
+        setattr(owner, attribute, timed)
+
+    def summary(self) -> str:
+        '''Dropped frames and latency percentiles of the buffered rows (since the last flush)'''
+
+        if not self.rows:
+            return 'no frames'
+
+        # Rows as arrays (context fields first, see instrument)
+        rows = np.array(list(self.rows), dtype=[('phase', 'u1'), ('block', '<u2'), ('trial', '<u2'), ('kind', 'u1'), ('time', '<f8'), ('value', '<f8')])
+
+        # Flip intervals and dropped frames (frames missed between consecutive flips)
+        intervals = rows['value'][(rows['kind'] == timing_kind_codes['flip']) & ~np.isnan(rows['value'])]
+        frames = np.maximum(np.round(intervals/self.frame_duration), 1)
+        dropped_frames = int(np.sum(frames - 1))
+        text = '%d flips, %d dropped frames (%.2f%%)' % (np.sum(rows['kind'] == timing_kind_codes['flip']), dropped_frames,
+                                                         100*dropped_frames/max(np.sum(frames), 1))
+        if intervals.size:
+            text += ', flip interval median %.2f ms (99th percentile %.2f ms, max %.2f ms)' % tuple(
+                np.append(np.percentile(intervals, [50, 99]), intervals.max())*1000)
+
+        # Latency (median / 99th percentile / max) of each call type
+        latencies = []
+        for kind, name in (('message', 'EyeLink message'), ('log', 'log'), ('key_poll', 'key poll')):
+            values = rows['value'][rows['kind'] == timing_kind_codes[kind]]
+            if values.size:
+                latencies.append('%s %.3f/%.3f/%.3f ms' % ((name,) + tuple(np.append(np.percentile(values, [50, 99]), values.max())*1000)))
+        if latencies:
+            text += '; latency median/99th percentile/max: ' + ', '.join(latencies)
+
+        return text
+
+    def flush(self) -> None:
+        '''Append the buffered rows to the timing file'''
+
+        # Note: The next flip interval spans the file write, so it is not counted
+        self.last_flip = None
+
+        if not self.rows:
+            return
+
+        # Take the buffered rows
+        # Note: popleft until empty (the dispatcher thread may append meanwhile, append/popleft are thread-safe)
+        rows = []
+        while True:
+            try:
+                rows.append(self.rows.popleft())
+            except IndexError:
+                break
+
+        records = np.zeros(len(rows), dtype=timing_dtype)
+        fields = list(zip(*rows))
+        for index, field in enumerate(['phase', 'block', 'trial', 'kind', 'time', 'value']):
+            records[field] = fields[index]
+
+        with open(self.filename, 'ab') as timing_file:
+            records.tofile(timing_file)
+
+# *******************
+# *** SPAN TRACER ***
+# *******************
+
+# Spans kept in the trace buffer (phases, blocks, trials, and trial intervals)
+# Note: About 10 spans per trial; spans beyond the buffer are counted but not kept
+trace_capacity = 2**16
+
+class SpanTracer:
+    '''Nested task spans (phases, blocks, trials, intervals) exported as a Chrome trace file
+
+    Span names are registered once with register(); begin() stores the name id and
+    the monotonic start time in preallocated buffers and returns the span slot;
+    end() stores the end time. Spans of the same thread nest by time, so trace
+    viewers (chrome://tracing, Perfetto) show the phase > block > trial > interval
+    hierarchy. A disabled tracer has no buffers, so begin() and end() return right away.
+    Note: The buffers are preallocated lists (item assignment is faster than for
+    arrays), converted to arrays when the trace is exported
+    Note: The thread CPU clock costs about 0.4 us per read, so CPU time is only
+    measured for spans begun with cpu=True (phases and blocks)'''
+
+    def __init__(self, filename: str = None, capacity: int = trace_capacity):
+
+        # Trace file (None = disabled)
+        self.filename = filename
+        self.enabled = filename is not None
+        capacity = capacity if self.enabled else 0
+
+        # Span name table (name, category) and preallocated span buffers (times in ns)
+        self.names = []
+        self.name_ids = {}
+        self.span_names = [0]*capacity
+        self.numbers = [0]*capacity
+        self.starts = [0]*capacity
+        self.ends = [0]*capacity
+        self.cpu_starts = [0]*capacity
+        self.cpu_ends = [0]*capacity
+        self.capacity = capacity
+
+        # Spans begun (including spans beyond the buffer)
+        self.count = 0
+
+    def register(self, name: str, category: str = 'task') -> int:
+        '''Span name id for begin() (registered once, before the spans of that name)
+        Note: A span name has one category (the category of its first registration)'''
+
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append((name, category))
+
+        return name_id
+
+    def begin(self, name_id: int, number: int = 0, cpu: bool = False) -> int:
+        '''Start a span (name_id: see register; number: block or trial number shown after the name, 0 = none)
+        Returns the span slot for end() (-1 = not kept or disabled)'''
+
+        # Note: A disabled tracer has no capacity
+        slot = self.count
+        self.count = slot + 1
+        if slot >= self.capacity:
+            return -1
+
+        self.span_names[slot] = name_id
+        self.numbers[slot] = number
+        if cpu:
+            self.cpu_starts[slot] = time.thread_time_ns()
+        self.starts[slot] = time.perf_counter_ns()
+
+        return slot
+
+    def end(self, slot: int) -> None:
+        '''End a span'''
+
+        if slot >= 0:
+            self.ends[slot] = time.perf_counter_ns()
+            if self.cpu_starts[slot]:
+                self.cpu_ends[slot] = time.thread_time_ns()
+
+    def export(self) -> None:
+        '''Write the kept spans as a Chrome trace file (JSON, complete events in us)
+        Note: Spans not ended yet (e.g., when the task is ended early) end at the export time and are marked unfinished'''
+
+        if not self.enabled:
+            return
+
+        now = time.perf_counter_ns()
+        num_spans = min(self.count, self.capacity)
+        starts = np.array(self.starts[:num_spans], dtype=np.int64)
+        ends = np.array(self.ends[:num_spans], dtype=np.int64)
+        unfinished = ends == 0
+        ends = np.where(unfinished, now, ends)
+        origin = starts.min() if num_spans else now
+
+        # Trace events (one thread: the task thread)
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 1, 'args': {'name': 'Glare Illusion Task ' + task_version}},
+                  {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': 1, 'args': {'name': 'task'}}]
+        for slot in range(num_spans):
+            name, category = self.names[self.span_names[slot]]
+            event = {'name': name if not self.numbers[slot] else '%s %d' % (name, self.numbers[slot]), 'cat': category, 'ph': 'X',
+                     'ts': (starts[slot] - origin)/1000, 'dur': (ends[slot] - starts[slot])/1000, 'pid': pid, 'tid': 1}
+            if self.cpu_ends[slot]:
+                event['args'] = {'cpu_ms': round((self.cpu_ends[slot] - self.cpu_starts[slot])/1e6, 3)}
+            if unfinished[slot]:
+                event['args'] = {'unfinished': True}
+            events.append(event)
+
+        with open(self.filename, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'spans': self.count, 'dropped_spans': max(self.count - self.capacity, 0),
+                                     'unfinished_spans': int(unfinished.sum())}}, trace_file)
+
+# ****************************
+# *** ADAPTIVE POSITIONING ***
+# ****************************
+
+class Staircase:
+    '''Weighted up-down staircase (Kaernbach, 1991) on one stimulus coordinate
+
+    A detected distractor moves the stimulus one step further into the blind 
+    field and a missed distractor moves it back by step*target/(1 - target), so 
+    the position converges where the detection rate is the target rate. The 
+    step is halved at each reversal, down to the minimum step.
+    direction: sign of the coordinate change into the blind field'''
+
+    def __init__(self, start: float, direction: int, limits: tuple, target_rate: float = positioning_target_rate,
+                 initial_step: float = positioning_initial_step, min_step: float = positioning_min_step):
+
+        # Current position, direction into the blind field, and position limits
+        self.value = float(np.clip(start, *limits))
+        self.direction = direction
+        self.limits = limits
+
+        # Target detection rate and step sizes
+        self.target_rate = target_rate
+        self.step = initial_step
+        self.min_step = min_step
+
+        # Trials, last answer, and the positions at each reversal
+        self.trials = 0
+        self.last_detected = None
+        self.reversals = []
+
+    def update(self, detected: bool) -> None:
+        '''Move the position after a blind field distractor'''
+
+        # Reversal (detection after a miss or a miss after a detection)
+        if self.last_detected is not None and detected != self.last_detected:
+            self.reversals.append(self.value)
+            self.step = max(self.step/2, self.min_step)
+        self.last_detected = detected
+        self.trials += 1
+
+        # Step into the blind field after a detection, back out after a miss
+        step = self.step if detected else -self.step*self.target_rate/(1 - self.target_rate)
+        self.value = float(np.clip(self.value + self.direction*step, *self.limits))
+
+    @property
+    def done(self) -> bool:
+        '''Enough reversals to estimate the target position'''
+
+        return len(self.reversals) >= positioning_reversals
+
+    def estimate(self) -> float:
+        '''Target position: mean position at the reversals (the first two, with large steps, are left out)'''
+
+        if len(self.reversals) < 3:
+            return self.value
+
+        return float(np.mean(self.reversals[2:]))
+
+# **********************************
+# *** ONLINE PUPIL PREPROCESSING ***
+# **********************************
+
+class PupilPreprocessor:
+    '''Online blink interpolation and running per-condition pupil responses
+    
+    Link samples are processed one at a time with fixed memory: each valid sample
+    passes through a short delay line (so it can still become blink padding), 
+    blinks are held until the pupil returns and then linearly interpolated, and 
+    each processed sample is added to the baseline and response sums of the 
+    trials it falls in. The pupil response of a trial is the mean pupil size in 
+    the response window minus the mean in the baseline before stimulus onset.'''
+    
+    def __init__(self, sample_rate: float = 1000):
+        
+        # Blink padding and max interpolated blink (in samples)
+        self.pad_before = int(round(pupil_blink_padding[0]*sample_rate))
+        self.pad_after = int(round(pupil_blink_padding[1]*sample_rate))
+        self.max_gap = int(round(pupil_max_interpolated_blink*sample_rate)) + self.pad_before + self.pad_after
+        
+        # Baseline and response window (in ms)
+        self.baseline_duration = pupil_baseline_duration*1000
+        self.response_window = pupil_response_window*1000
+        
+        # Recent valid (time, pupil) samples not yet processed
+        self.delay = deque()
+        
+        # Blink: sample times waiting for interpolation, padding samples left, and blink too long to interpolate
+        self.in_blink = False
+        self.gap = deque()
+        self.post_count = 0
+        self.gap_too_long = False
+        
+        # Last processed valid pupil size (start of the blink interpolation)
+        self.last_value = np.nan
+        
+        # Processed (time, pupil) samples for the baseline
+        self.history = deque(maxlen=int(pupil_baseline_duration*sample_rate))
+        
+        # Trials added by the task thread and trials waiting for samples
+        self.new_trials = queue.SimpleQueue()
+        self.trials = deque()
+        
+        # Pupil responses per (stimulus type, side): [sum, count]
+        self.responses = {}
+        self.responses_lock = threading.Lock()
+        
+        # Block blink and rejected trial counts
+        self.block_samples = 0
+        self.block_blink_samples = 0
+        self.block_rejected_trials = 0
+    
+    def add_trial(self, onset: float, stim_type: int, side: int) -> None:
+        '''Add a trial (onset in tracker time, ms)'''
+        
+        self.new_trials.put({'onset': onset, 'stim_type': stim_type, 'side': side, 'baseline': None,
+                             'count': 0, 'blinks': 0, 'sum': 0.0, 'valid': 0, 'max_deviation': 0.0})
+    
+    def start_block(self) -> None:
+        '''Reset the block blink and rejected trial counts'''
+        
+        self.block_samples = 0
+        self.block_blink_samples = 0
+        self.block_rejected_trials = 0
+    
+    def summary(self) -> dict:
+        '''Mean pupil response per (stimulus type, side) and the block blink fraction'''
+        
+        with self.responses_lock:
+            responses = {condition: total/count for condition, (total, count) in self.responses.items()}
+        
+        blink_fraction = self.block_blink_samples/self.block_samples if self.block_samples else np.nan
+        
+        return {'responses': responses, 'blink_fraction': blink_fraction, 'rejected_trials': self.block_rejected_trials}
+    
+    def add_sample(self, t: float, pupil_size: float) -> None:
+        '''Process one sample (pupil size 0 = blink or track loss)'''
+        
+        # Blink sample
+        if not pupil_size > 0:
+            
+            # Blink start: the recent samples become padding
+            if not self.in_blink:
+                self.in_blink = True
+                for delayed_t, _ in self.delay:
+                    self._add_gap(delayed_t)
+                self.delay.clear()
+            
+            self._add_gap(t)
+            self.post_count = self.pad_after
+            return
+        
+        if self.in_blink:
+            
+            # Padding after the blink
+            if self.post_count > 0:
+                self.post_count -= 1
+                self._add_gap(t)
+                return
+            
+            # Blink end: interpolate up to this sample
+            self._end_blink(pupil_size)
+        
+        # Delay valid samples by the padding before blinks
+        self.delay.append((t, pupil_size))
+        if len(self.delay) > self.pad_before:
+            self._process(*self.delay.popleft(), False)
+    
+    def _add_gap(self, t: float) -> None:
+        '''Hold a blink sample for interpolation'''
+        
+        # Blink too long to interpolate: process the oldest sample as missing
+        if len(self.gap) >= self.max_gap:
+            self.gap_too_long = True
+            self._process(self.gap.popleft(), np.nan, True)
+        
+        self.gap.append(t)
+    
+    def _end_blink(self, end_value: float) -> None:
+        '''Linearly interpolate the blink from the last valid sample to end_value'''
+        
+        start_value = self.last_value
+        num_samples = len(self.gap)
+        
+        for i, t in enumerate(self.gap):
+            if self.gap_too_long or np.isnan(start_value):
+                self._process(t, np.nan, True)
+            else:
+                self._process(t, start_value + (end_value - start_value)*(i + 1)/(num_samples + 1), True)
+        
+        self.gap.clear()
+        self.gap_too_long = False
+        self.in_blink = False
+    
+    def _process(self, t: float, value: float, blink: bool) -> None:
+        '''Add a processed sample to the blink counts, trials, and baseline history'''
+        
+        # Blink counts
+        self.block_samples += 1
+        if blink:
+            self.block_blink_samples += 1
+        else:
+            self.last_value = value
+        
+        # New trials
+        while not self.new_trials.empty():
+            self.trials.append(self.new_trials.get())
+        
+        # Trials with a complete response window
+        while self.trials and t >= self.trials[0]['onset'] + self.response_window:
+            self._finish_trial(self.trials.popleft())
+        
+        # Trials in their response window
+        for trial in self.trials:
+            if t < trial['onset']:
+                break
+            
+            # Baseline from the samples before onset
+            if trial['baseline'] is None:
+                baseline = [v for ht, v in self.history if ht >= trial['onset'] - self.baseline_duration and not np.isnan(v)]
+                trial['baseline'] = np.mean(baseline) if baseline else np.nan
+            
+            # Sample counts and pupil sum (interpolated blinks included)
+            trial['count'] += 1
+            trial['blinks'] += blink
+            if not np.isnan(value):
+                trial['sum'] += value
+                trial['valid'] += 1
+                trial['max_deviation'] = max(trial['max_deviation'], abs(value - trial['baseline']))
+        
+        self.history.append((t, value))
+    
+    def _finish_trial(self, trial: dict) -> None:
+        '''Add the trial pupil response, unless rejected for blinks or extreme values'''
+        
+        # Reject trials with mostly blinks, extreme pupil values, or no baseline
+        if (trial['valid'] == 0 or trial['blinks']/trial['count'] > pupil_blink_threshold or 
+                trial['max_deviation'] > pupil_extreme_threshold or np.isnan(trial['baseline'])):
+            self.block_rejected_trials += 1
+            return
+        
+        response = trial['sum']/trial['valid'] - trial['baseline']
+        
+        with self.responses_lock:
+            total, count = self.responses.get((trial['stim_type'], trial['side']), (0.0, 0))
+            self.responses[(trial['stim_type'], trial['side'])] = (total + response, count + 1)
+
+# ********************
+# *** GAZE MONITOR ***
+# ********************
+
+class GazeMonitor:
+    '''Stream EyeLink link samples into a ring buffer and detect fixation breaks online
+    
+    A worker thread reads the link sample queue and updates the gaze deviation
+    from the fixation cross one sample at a time, so the render thread only 
+    marks the start and end of each trial. Samples with missing gaze (blinks)
+    do not count as fixation breaks. The pupil size of each sample is passed
+    to the online pupil preprocessor.'''
+    
+    def __init__(self, el_tracker, screen_size: tuple, px_per_cm: float, sample_rate: float = 1000, poll_interval: float = 0.001):
+        
+        # EyeLink tracker and gaze coordinates of the fixation cross (screen center, in pixels)
+        self.el_tracker = el_tracker
+        self.center = (screen_size[0]/2.0, screen_size[1]/2.0)
+        self.px_per_cm = px_per_cm
+        
+        # Ring buffer of recent (tracker time in ms, gaze deviation in cm) samples
+        self.samples = deque(maxlen=int(gaze_buffer_duration*sample_rate))
+        self.last_sample_time = 0
+        
+        # Online pupil preprocessing
+        self.pupil = PupilPreprocessor(sample_rate)
+        
+        # Sample queue polling interval (in seconds)
+        self.poll_interval = poll_interval
+        
+        # Eye used (0 = left; 1 = right)
+        self.eye_used = 0
+        
+        # Time the gaze left the fixation window (None = within the window)
+        self.break_start = None
+        
+        # Current trial: monitored, fixation break, and max gaze deviation (in cm)
+        self.trial_active = False
+        self.trial_break = False
+        self.trial_max_deviation = 0.0
+        
+        self.worker = None
+        self.running = False
+    
+    def start(self, eye_used: int, threaded: bool = True) -> None:
+        '''Start reading samples
+        threaded: read samples on a worker thread (otherwise at the start and end of each trial)'''
+        
+        self.eye_used = eye_used
+        
+        if threaded:
+            self.running = True
+            self.worker = threading.Thread(target=self._read_samples, name='GazeMonitor', daemon=True)
+            self.worker.start()
+    
+    def stop(self) -> None:
+        '''Stop the worker thread'''
+        
+        self.running = False
+        if self.worker is not None and self.worker.is_alive():
+            self.worker.join()
+    
+    def begin_trial(self, stim_type: int = None, side: int = None) -> None:
+        '''Start monitoring fixation (called on the stimulus onset flip)
+        stim_type/side: add the trial to the pupil responses'''
+        
+        if self.worker is None:
+            self.poll()
+        
+        # Stimulus onset at the newest sample
+        if stim_type is not None:
+            self.pupil.add_trial(self.last_sample_time, stim_type, side)
+        
+        # Note: A break start left from the previous trial would skip the minimum break duration
+        self.trial_break = False
+        self.trial_max_deviation = 0.0
+        self.break_start = None
+        self.trial_active = True
+    
+    def end_trial(self) -> tuple:
+        '''Stop monitoring fixation
+        Returns (fixation break, max gaze deviation in cm) of the trial'''
+        
+        if self.worker is None:
+            self.poll()
+        
+        self.trial_active = False
+        
+        return self.trial_break, self.trial_max_deviation
+    
+    def pupil_summary(self) -> dict:
+        '''Online pupil summary (see PupilPreprocessor.summary)'''
+        
+        if self.worker is None:
+            self.poll()
+        
+        return self.pupil.summary()
+    
+    def poll(self) -> None:
+        '''Read all samples in the link queue'''
+        
+        while True:
+            
+            # Next sample or event
+            data_type = self.el_tracker.getNextData()
+            if not data_type:
+                break
+            
+            # Skip eye events
+            if data_type == pylink.SAMPLE_TYPE:
+                self._add_sample(self.el_tracker.getFloatData())
+    
+    def _read_samples(self) -> None:
+        '''Worker loop: poll the link sample queue'''
+        
+        while self.running:
+            self.poll()
+            time.sleep(self.poll_interval)
+    
+    def _add_sample(self, sample) -> None:
+        '''Update the fixation state with one sample'''
+        
+        # Eye data
+        eye = sample.getLeftEye() if self.eye_used == 0 else sample.getRightEye()
+        if eye is None:
+            return
+        t = sample.getTime()
+        x, y = eye.getGaze()
+        self.last_sample_time = t
+        
+        # Missing gaze (blink or track loss)
+        if x == pylink.MISSING_DATA or y == pylink.MISSING_DATA:
+            self.samples.append((t, np.nan))
+            self.pupil.add_sample(t, 0)
+            self.break_start = None
+            return
+        
+        # Pupil size
+        self.pupil.add_sample(t, eye.getPupilSize())
+        
+        # Gaze deviation from the fixation cross
+        # Note: Plain float math, which is faster than NumPy for a single sample
+        deviation = ((x - self.center[0])**2 + (y - self.center[1])**2)**0.5/self.px_per_cm
+        self.samples.append((t, deviation))
+        
+        if not self.trial_active:
+            return
+        
+        self.trial_max_deviation = max(self.trial_max_deviation, deviation)
+        
+        # Fixation break after the minimum time outside the fixation window
+        if deviation > fixation_break_radius:
+            if self.break_start is None:
+                self.break_start = t
+            elif t - self.break_start >= fixation_break_min_duration*1000:
+                self.trial_break = True
+        else:
+            self.break_start = None
+
+# ********************
+# *** TASK SESSION ***
+# ********************
+
+class TaskSession:
+    '''Task session setup (dialog, files, window, EyeLink, stimuli)
+
+    Each part is set up on first use and timed, so the task can be imported
+    without starting a session and startup() reports where startup time goes.'''
+
+    def __init__(self):
+
+        # Command line options (set by main)
+        self.options = argparse.Namespace(simulate=False, seed=None, time_scale=0, blocks=None, trace=False)
+
+        # Data folders are relative to the folder the task was started from
+        self.launch_dir = os.getcwd()
+
+        # Startup stage durations (in seconds)
+        self.startup_times = {'module imports': import_duration}
+
+    def _timed(self, stage: str):
+        '''Time a startup stage'''
+
+        return StartupTimer(self.startup_times, stage)
+
+    @cached_property
+    def modules(self) -> None:
+        '''Import PsychoPy and pylink (or the headless simulation stand-ins)'''
+
+        global visual, gui, data, core, event, keyboard, logging, pylink, EyeLinkCoreGraphicsPsychoPy
+
+        with self._timed('psychopy/pylink imports'):
+
+            from psychopy import data, logging
+
+            # Headless simulation mode
+            if self.options.simulate:
+                from headless_simulation import HeadlessSimulation
+                self.simulation = HeadlessSimulation(seed=self.options.seed, time_scale=self.options.time_scale, num_blocks=self.options.blocks)
+                visual, gui, core, event, pylink = self.simulation.visual, self.simulation.gui, self.simulation.core, self.simulation.event, self.simulation.pylink
+                keyboard = self.simulation.keyboard
+                EyeLinkCoreGraphicsPsychoPy = self.simulation.EyeLinkCoreGraphicsPsychoPy
+            else:
+                from psychopy import visual, gui, core, event
+                from psychopy.hardware import keyboard
+                import pylink
+                from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+
+    @cached_property
+    def info(self) -> dict:
+        '''Subject info screen'''
+
+        self.modules
+
+        with self._timed('dialog'):
+
+            # Setup the subject info screen
+            info = dict(info_defaults)
+
+            # Experiment title
+            dlg = gui.DlgFromDict(info, title = 'Glare Illusion Perception Experiment')
+
+            # Find experiment date
+            info['date'] = data.getDateStr()
+
+        return info
+
+    @property
+    def button_condition(self) -> int:
+        '''Button Condition'''
+
+        return int(self.info['Button Condition'])
+
+    @property
+    def dummy_mode(self) -> bool:
+        '''EyeLink Dummy mode? - Set to False if testing with actual system'''
+
+        return self.info['EyeLink'] == 'n'
+
+    @cached_property
+    def win(self):
+        '''PsychoPy window'''
+
+        self.modules
+
+        with self._timed('window'):
+
+            # Setup the window
+            # Note: Screen is set to gray (0,0,0)
+            win = visual.Window(size = resolution, color = [0,0,0], monitor = 'testMonitor', fullscr = True, units ='cm') #Set color and fullscreen mode (True or False)
+
+        return win
+
+    @cached_property
+    def keyboard(self):
+        '''Hardware keyboard for time-stamped responses'''
+
+        self.win
+
+        with self._timed('keyboard'):
+
+            # Setup keyboard
+            # Note: Key presses are time stamped by the keyboard backend (psychtoolbox
+            # if available), not when they are read in the frame loop
+            task_keyboard = keyboard.Keyboard()
+
+        return task_keyboard
+
+    @cached_property
+    def frame_rate(self) -> float:
+        '''Measured screen refresh rate (Hz)'''
+
+        win = self.win
+
+        with self._timed('refresh rate measurement'):
+
+            # Measure the screen refresh rate
+            # Note: Trial intervals are scheduled as a whole number of frames at this rate
+            frame_rate = win.getActualFrameRate(nIdentical=10, nMaxFrames=120, nWarmUpFrames=10, threshold=1)
+
+            # Use the nominal refresh rate if the measurement did not stabilize
+            if frame_rate is None:
+                frame_rate = nominal_frame_rate
+
+        return frame_rate
+
+    @property
+    def frame_duration(self) -> float:
+        '''Frame duration in seconds'''
+
+        return 1.0/self.frame_rate
 
-# Setup the subject info screen
-info = {'Session #': 1, 'Subject ID': 'Test', 'EyeLink': ['n','y'], 'EyeLink EDF': 'test.edf', 'Button Condition':['1','2'], '(1) Skip Positioning Phase': ['n','y'], 
-        '(2) Skip Main Phase': ['n','y'], '(3) Skip Brightness Phase': ['n','y'], 'Final X position':0,'Final Y position':0}
+    @cached_property
+    def behavioral_filename(self) -> str:
+        '''Data folders, filenames, and log file
+        Returns the behavioral output filename (without extension)'''
 
-# Experiment title
-dlg = gui.DlgFromDict(info, title = 'Glare Illusion Perception Experiment')
+        info = self.info
 
-# Find experiment date
-info['date'] = data.getDateStr()
+        with self._timed('data files'):
 
-# Set this variable to True if you use the built-in retina screen as your 
-# primary display device on macOS. If have an external monitor, set this 
-# variable True if you choose to "Optimize for Built-in Retina Display" 
-# in the Displays preference settings.
-use_retina = True
+            # Filename = Subject ID entered above
+            sub_filename = info['Subject ID']
 
-# ********************
-# *** SETUP WINDOW ***
-# ********************
+            # Check for the behavioral data directory, otherwise make it
+            if not os.path.isdir(os.path.join(self.launch_dir, behavioral_folder)):
+                    os.makedirs(os.path.join(self.launch_dir, behavioral_folder))  # if this fails (e.g. permissions) we will get error
 
-# Define screen resolution
-resolution = [2560, 1440] 
+            # Check for the EyeLink data directory, otherwise make it
+            if not os.path.isdir(os.path.join(self.launch_dir, eyelink_folder)):
+                    os.makedirs(os.path.join(self.launch_dir, eyelink_folder)) # if this fails (e.g. permissions) we will get error
 
-# Setup the window
-# Note: Screen is set to gray (0,0,0)
-win = visual.Window(size = resolution, color = [0,0,0], monitor = 'testMonitor', fullscr = True, units ='cm') #Set color and fullscreen mode (True or False)
+            # EyeLink EDF filename
+            tmp_str = info['EyeLink EDF']
 
-# *****************************************
-# *** MANAGE DATA FOLDERS AND FILENAMES ***
-# *****************************************
+            # Strip trailing characters, ignore the ".edf" extension
+            self.edf_fname = tmp_str.rstrip().split('.')[0]
 
-# Filename = Subject ID entered above
-sub_filename = info['Subject ID']
+            # Check if the EDF filename is valid (length <= 8 & no special char)
+            allowed_char = ascii_letters + digits + '_'
 
-# Behavioral data file
-behavioral_folder = 'Behavioral_Data'
+            # If too many characters in EyeLink filename
+            if not all([c in allowed_char for c in self.edf_fname]):
+                print('ERROR: *** Invalid EDF filename')
+                core.quit()  # abort experiment
 
-# Check for the behavioral data directory, otherwise make it
-if not os.path.isdir(behavioral_folder):
-        os.makedirs(behavioral_folder)  # if this fails (e.g. permissions) we will get error
+            elif len(self.edf_fname) > 8:
+                print('ERROR: *** EDF filename should not exceed 8 characters')
+                core.quit()  # abort experiment
 
-# Eyelink data file
-eyelink_folder = 'EyeLink_Data'
+            # Download EDF data file from the EyeLink Host PC to the local hard
+            # drive at the end of each testing session, here we rename the EDF to
+            # include session start date/time
+            time_str = time.strftime("_%Y_%m_%d_%H_%M", time.localtime())
+            self.session_identifier = self.edf_fname + time_str
 
-# Check for the EyeLink data directory, otherwise make it
-if not os.path.isdir(eyelink_folder):
-        os.makedirs(eyelink_folder) # if this fails (e.g. permissions) we will get error
+            # Behavioral output filename (without extension)
+            behavioral_filename = os.path.join(self.launch_dir, behavioral_folder, sub_filename + '_Session_'+str(info['Session #'])+'_Glare_Illusion_Perception_'+info['date']+'_'+task_version)
 
-# EyeLink EDF filename
-tmp_str = info['EyeLink EDF']
+            # Setup log file
+            # Note: Show only critical log messages in the PsychoPy console
+            self.logFile = logging.LogFile(behavioral_filename + '.log', level=logging.EXP)
 
-# Strip trailing characters, ignore the ".edf" extension
-edf_fname = tmp_str.rstrip().split('.')[0]
+            # Frame timing report file
+            # Note: One row per trial with the planned vs. actual stimulus onset/offset times
+            self.frame_timing_filename = behavioral_filename + '_Frame_Timing.tsv'
 
-# Check if the EDF filename is valid (length <= 8 & no special char)
-allowed_char = ascii_letters + digits + '_'
+            # Event file
+            # Note: One typed row per trial and per response (see event_dtype)
+            self.event_filename = behavioral_filename + '_Events.bin'
 
-# If too many characters in EyeLink filename
-if not all([c in allowed_char for c in edf_fname]):
-    print('ERROR: *** Invalid EDF filename')
-    core.quit()  # abort experiment
+            # Timing file
+            # Note: One typed row per flip, EyeLink message, log message, and key poll (see timing_dtype)
+            self.timing_filename = behavioral_filename + '_Timing.bin'
 
-elif len(edf_fname) > 8:
-    print('ERROR: *** EDF filename should not exceed 8 characters')
-    core.quit()  # abort experiment
+            # Trace file
+            # Note: Only written with the --trace option (see SpanTracer)
+            self.trace_filename = behavioral_filename + '_Trace.json'
 
-# Download EDF data file from the EyeLink Host PC to the local hard
-# drive at the end of each testing session, here we rename the EDF to
-# include session start date/time
-time_str = time.strftime("_%Y_%m_%d_%H_%M", time.localtime())
-session_identifier = edf_fname + time_str
+        return behavioral_filename
 
-# Setup log file
-# Note: Show only critical log messages in the PsychoPy console
-logFile = logging.LogFile(behavioral_folder + os.path.sep + sub_filename + '_Session_'+str(info['Session #'])+'_Glare_Illusion_Perception_'+info['date']+'_'+task_version+'.log', level=logging.EXP)
+    @cached_property
+    def schedules(self) -> dict:
+        '''Session random seed and the trial schedule of each task phase'''
 
-# Button Condition 
-button_condition = int(info['Button Condition'])
-    
-# ***********************
-# *** TASK PARAMETERS ***
-# ***********************
+        info = self.info
+        behavioral_filename = self.behavioral_filename
 
-# Max block number
-max_num_blocks = 30
+        with self._timed('schedule'):
 
-# Main Task Phase
+            # Session random seed
+            # Note: A new seed is drawn if none was entered; the seed is logged and saved
+            # with the schedule so the session can be reproduced exactly
+            if str(info['Random Seed']).strip() == '':
+                self.session_seed = int(np.random.SeedSequence().generate_state(1)[0])
+            else:
+                self.session_seed = int(info['Random Seed'])
 
-# Number of stimuli
-num_glare_stim = 8
-num_nonglare_stim = 8
-num_iso_stim = 8
-num_white_stim = 8
-num_distractor_plus_stim = 4
-num_distractor_cross_stim = 4
+            # Setup random number generator
+            rng = np.random.default_rng(self.session_seed)
 
-# Stimulus duration
-stimulus_duration = 3 # in seconds
+            # Main task phase schedule
+            # Note: Stimulus types (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor plus; 5 = distractor cross)
+            main_schedule = build_phase_schedule(rng, [num_glare_stim, num_nonglare_stim, num_iso_stim, num_white_stim, num_distractor_plus_stim, num_distractor_cross_stim],
+                                                 (ISI_min_duration_sec, ISI_max_duration_sec), (ISI_min_duration_sec, ISI_max_duration_sec))
 
-# Set inter-stimulus interval (ISI) min and max durations
-ISI_min_duration_sec = 3 # in seconds
-ISI_max_duration_sec = 5 # in seconds
+            # Brightness perception phase schedule
+            # Note: Stimulus types (0 = glare vs nonglare; 1 = glare vs iso; 2 = nonglare vs iso)
+            brightness_schedule = build_phase_schedule(rng, [num_glare_vs_nonglare, num_glare_vs_iso, num_nonglare_vs_iso],
+                                                       (brightness_pre_stim_time, brightness_pre_stim_time), (0, 0))
 
-# Stimulus start locations
-start_stim_x_pos = 12 # in centimeters
-start_stim_y_pos = 5 # in centimeters
+            # Save schedule
+            np.savez(behavioral_filename + '_Schedule.npz', seed=self.session_seed, main_schedule=main_schedule, brightness_schedule=brightness_schedule)
 
-# ********************
-# *** TASK STIMULI ***
-# ********************
+            # Log
+            logging.log(level=logging.EXP,msg='Random Seed: ' + str(self.session_seed))
+
+        return {'main': main_schedule, 'brightness': brightness_schedule}
+
+    @cached_property
+    def el_tracker(self):
+        '''EyeLink tracker connection'''
+
+        win = self.win
+        self.behavioral_filename
+        self.schedules
+
+        with self._timed('tracker connection'):
+
+            # Step 1: Connect to the EyeLink Host PC
+
+            # The Host IP address, by default, is "100.1.1.1".
+            # the "el_tracker" objected created here can be accessed through the Pylink
+            # Set the Host PC address to "None" (without quotes) to run the script
+            # in "Dummy Mode"
+            if self.dummy_mode:
+                el_tracker = pylink.EyeLink(None)
+            else:
+                try:
+                    el_tracker = pylink.EyeLink("100.1.1.1")
+                except RuntimeError as error:
+                    print('ERROR:', error)
+                    core.quit()
+                    sys.exit()
+
+            # Step 2: Open an EDF data file on the Host PC
+
+            # Define edf fileanme
+            edf_file = self.edf_fname + ".EDF"
+
+            try:
+                el_tracker.openDataFile(edf_file)
+            except RuntimeError as err:
+                print('ERROR:', err)
+                # close the link if we have one open
+                if el_tracker.isConnected():
+                    el_tracker.close()
+                core.quit()
+                sys.exit()
+
+            # Step 3: Configure the tracker
+
+            # Put the tracker in offline mode before we change tracking parameters
+            el_tracker.setOfflineMode()
+
+            # Get the software version:  1-EyeLink I, 2-EyeLink II, 3/4-EyeLink 1000,
+            # 5-EyeLink 1000 Plus, 6-Portable DUO
+            if self.dummy_mode:
+                eyelink_ver = 0  # set version to 0, in case running in Dummy mode
+            else:
+                eyelink_ver = 5
+
+            if not self.dummy_mode:
+                vstr = el_tracker.getTrackerVersionString()
+                eyelink_ver = int(vstr.split()[-1].split('.')[0])
+                # print out some version info in the shell
+                print('Running experiment on %s, version %d' % (vstr, eyelink_ver))
+
+            # File and Link data control
+            # what eye events to save in the EDF file, include everything by default
+            file_event_flags = 'LEFT,RIGHT,FIXATION,SACCADE,BLINK,MESSAGE,BUTTON,INPUT'
+            # what eye events to make available over the link, include everything by default
+            link_event_flags = 'LEFT,RIGHT,FIXATION,SACCADE,BLINK,BUTTON,FIXUPDATE,INPUT'
+            # what sample data to save in the EDF data file and to make available
+            # over the link, include the 'HTARGET' flag to save head target sticker
+            # data for supported eye trackers
+            if eyelink_ver > 3:
+                file_sample_flags = 'LEFT,RIGHT,GAZE,HREF,RAW,AREA,HTARGET,GAZERES,BUTTON,STATUS,INPUT'
+                link_sample_flags = 'LEFT,RIGHT,GAZE,GAZERES,AREA,HTARGET,STATUS,INPUT'
+            else:
+                file_sample_flags = 'LEFT,RIGHT,GAZE,HREF,RAW,AREA,GAZERES,BUTTON,STATUS,INPUT'
+                link_sample_flags = 'LEFT,RIGHT,GAZE,GAZERES,AREA,STATUS,INPUT'
+            el_tracker.sendCommand("file_event_filter = %s" % file_event_flags)
+            el_tracker.sendCommand("file_sample_data = %s" % file_sample_flags)
+            el_tracker.sendCommand("link_event_filter = %s" % link_event_flags)
+            el_tracker.sendCommand("link_sample_data = %s" % link_sample_flags)
+
+            # Set EyeLink sample rate
+            if eyelink_ver > 2 and not self.dummy_mode:
+                el_tracker.sendCommand("sample_rate 1000")
+
+            # Choose a calibration type, H3, HV3, HV5, HV13 (HV = horizontal/vertical),
+            el_tracker.sendCommand("calibration_type = HV9")
+            # Set a gamepad button to accept calibration/drift check target
+            # You need a supported gamepad/button box that is connected to the Host PC
+            el_tracker.sendCommand("button_function 5 'accept_target_fixation'")
+
+            # Shrink the spread of the calibration/validation targets
+            # if the default outermost targets are not all visible in the bore.
+            # The default <x, y display proportion> is 0.88, 0.83 (88% of the display
+            # horizontally and 83% vertically)
+            el_tracker.sendCommand('calibration_area_proportion 0.88 0.83')
+            el_tracker.sendCommand('validation_area_proportion 0.88 0.83')
+
+            # Get the native screen resolution used by PsychoPy
+            self.scn_width, self.scn_height = win.size
+
+            # Resolution fix for Mac retina displays
+            if 'Darwin' in platform.system():
+                if use_retina:
+                    self.scn_width = int(self.scn_width/2.0)
+                    self.scn_height = int(self.scn_height/2.0)
+
+            # Optional: online drift correction.
+            # See the EyeLink 1000 / EyeLink 1000 Plus User Manual
+
+            # Online drift correction to mouse-click position:
+            # el_tracker.sendCommand('driftcorrect_cr_disable = OFF')
+            # el_tracker.sendCommand('normal_click_dcorr = ON')
+
+            # Online drift correction to a fixed location, e.g., screen center
+            el_tracker.sendCommand('driftcorrect_cr_disable = OFF')
+            el_tracker.sendCommand('online_dcorr_refposn %d,%d' % (int(self.scn_width/2.0),
+                                                                    int(self.scn_height/2.0)))
+            el_tracker.sendCommand('online_dcorr_button = ON')
+            el_tracker.sendCommand('normal_click_dcorr = OFF')
+
+            # Pass the display pixel coordinates (left, top, right, bottom) to the tracker
+            # see the EyeLink Installation Guide, "Customizing Screen Settings"
+            el_coords = "screen_pixel_coords = 0 0 %d %d" % (self.scn_width - 1, self.scn_height - 1)
+            el_tracker.sendCommand(el_coords)
+
+            # Write a DISPLAY_COORDS message to the EDF file
+            # Data Viewer needs this piece of info for proper visualization, see Data
+            # Viewer User Manual, "Protocol for EyeLink Data to Viewer Integration"
+            dv_coords = "DISPLAY_COORDS  0 0 %d %d" % (self.scn_width - 1, self.scn_height - 1)
+            el_tracker.sendMessage(dv_coords)
+
+            # Record the session random seed
+            el_tracker.sendMessage('Random Seed: ' + str(self.session_seed))
+
+        return el_tracker
+
+    @cached_property
+    def genv(self):
+        '''EyeLink calibration graphics environment'''
+
+        el_tracker = self.el_tracker
+        win = self.win
+
+        with self._timed('calibration graphics'):
+
+            # Configure a graphics environment (genv) for tracker calibration
+            genv = EyeLinkCoreGraphicsPsychoPy(el_tracker, win)
+            print(genv)  # print out the version number of the CoreGraphics library
+
+            # Set background and foreground colors for the calibration target
+            # in PsychoPy, (-1, -1, -1)=black, (1, 1, 1)=white, (0, 0, 0)=mid-gray
+            foreground_color = (-1, -1, -1)
+            background_color = win.color # Use the same background color as the entire study
+            genv.setCalibrationColors(foreground_color, background_color)
+
+            # Set up the calibration target
+
+            # Use a picture as the calibration target
+            genv.setTargetType('circle')
+            genv.setTargetSize(24)
+            #genv.setPictureTarget(os.path.join('images', 'fixTarget.bmp')) #CALIBRATION TARGET IMAGE
+
+            # Configure the size of the calibration target (in pixels)
+            # this option applies only to "circle" and "spiral" targets
+            # genv.setTargetSize(24)
+
+            # Beeps to play during calibration, validation and drift correction
+            # parameters: target, good, error
+            #     target -- sound to play when target moves
+            #     good -- sound to play on successful operation
+            #     error -- sound to play on failure or interruption
+            # Each parameter could be ''--default sound, 'off'--no sound, or a wav file
+            genv.setCalibrationSounds('off', 'off', 'off')
+
+            # Resolution fix for macOS retina display issues
+            if use_retina:
+                genv.fixMacRetinaDisplay()
+
+            # Request Pylink to use the PsychoPy window we opened above for calibration
+            pylink.openGraphicsEx(genv)
+
+        return genv
+
+    @cached_property
+    def stimulus_pool(self) -> 'StimulusPool':
+        '''Task stimuli and text, uploaded before the task starts'''
+
+        win = self.win
+        genv = self.genv
+        scn_width = self.scn_width
+
+        with self._timed('texture load'):
+
+            # Setup stimulus pool
+            stimulus_pool = StimulusPool(win)
+
+            # Change to the task folder
+            os.chdir(_thisDir)
+
+            # Setup fixation cross
+            fixation = stimulus_pool.add(visual.TextStim, win=win, name='fixation', text="+", color = 'black', pos = [0, 0], autoLog = False)
+            fixation.size = 2 # in centimeters
+
+            # Setup stimuli
+
+            # Glare stimulus
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='glare_stimulus',
+                image=glare_filename,
+                ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0)
+
+            # Nonglare stimulus
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='nonglare_stimulus',
+                image=nonglare_filename,
+                ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0)
+
+            # White stimulus
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='white_stimulus',
+                image=white_filename,
+                ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0)
+
+            # Black stimulus
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='black_stimulus',
+                image=black_filename,
+                ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0)
+
+            # Iso stimulus
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='iso_stimulus',
+                image=iso_filename,
+                ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0)
+
+            # Distractor plus stimulus
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='distractor_plus_stimulus',
+                image=distractor_filename,
+                ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0)
+
+            # Distractor cross stimulus
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='distractor_cross_stimulus',
+                image=distractor_filename,
+                ori=45, pos=(0,0), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0)
+
+            # Positioning phase nonglare stimulus - Right side 
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='nonglare_right',
+                image=nonglare_filename,
+                ori=0.0, pos=(start_stim_x_pos,start_stim_y_pos), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0, units='cm')
+
+            # Positioning phase nonglare stimulus - Left side 
+            stimulus_pool.add(visual.ImageStim,
+                win=win,
+                name='nonglare_left',
+                image=nonglare_filename,
+                ori=0.0, pos=(-start_stim_x_pos,start_stim_y_pos), size=(stim_x_size, stim_y_size),
+                color=[1,1,1], colorSpace='rgb', opacity=1,
+                flipHoriz=False, flipVert=False,
+                interpolate=True, depth=0.0, units='cm')
+
+            # Task text
+
+            # Instruction screens
+            # Note: The text is updated for each screen
+            stimulus_pool.add(visual.TextStim, win=win, name='task_instructions', text='Please standby...', color = genv.getForegroundColor(), wrapWidth = scn_width/2)
+
+            # Key check screen
+            stimulus_pool.add(visual.TextStim, win=win, name='key_check', text="Please press '1'", color = 'black', pos = [0, 0])
+
+            # Start trigger screen
+            stimulus_pool.add(visual.TextStim, win=win, name='start_instructions', text='Waiting for start trigger. Please standby...', color = genv.getForegroundColor(), wrapWidth = scn_width/2)
+
+            # Brightness perception question
+            stimulus_pool.add(visual.TextStim, win=win, name='subjective_instructions', text='Which image is brighter at its center?\n\n 1 = Left image\n 2 = Right image\n 3 = Same brightness', color = genv.getForegroundColor(), wrapWidth = scn_width/2)
 
-# Setup fixation cross
-fixation = visual.TextStim(win, text="+", color = 'black', pos = [0, 0], autoLog = False)
-fixation.size = 2 # in centimeters
+            # Block break screen
+            # Note: The text is updated for each block
+            stimulus_pool.add(visual.TextStim, win=win, name='block_break', text="Great job! Take a break.", color='black')
 
-# Define stimulus image directory
-_thisDir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(_thisDir)
+            # Upload all stimuli and text before the task starts
+            stimulus_pool.preload()
 
-# Stimuli directories
-glare_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'glare_square.png';
-nonglare_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'nonglare_square.png';
-iso_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'iso_square.png';
-white_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'white_square.png';
-black_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'black_square.png';
-distractor_filename = _thisDir + os.sep + 'Stimuli' + '/' + 'red_square.png';
+        return stimulus_pool
 
-# Setup stimuli 
+    @cached_property
+    def main_stimulus_table(self) -> dict:
+        '''Main task phase stimulus lookup table (stimulus type: stimulus, log name)'''
 
-# Stimuli size
-stim_x_size = 7 # in centimeters
-stim_y_size = 7 # in centimeters
+        stimulus_pool = self.stimulus_pool
 
-# Glare stimulus
-glare_stimulus = visual.ImageStim(
-    win=win,
-    name='glare_stimulus',
-    image=glare_filename,
-    ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
-    color=[1,1,1], colorSpace='rgb', opacity=1,
-    flipHoriz=False, flipVert=False,
-    interpolate=True, depth=0.0)
-   
-# Nonglare stimulus
-nonglare_stimulus = visual.ImageStim(
-    win=win,
-    name='nonglare_stimulus',
-    image=nonglare_filename,
-    ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
-    color=[1,1,1], colorSpace='rgb', opacity=1,
-    flipHoriz=False, flipVert=False,
-    interpolate=True, depth=0.0)
-
-# White stimulus
-white_stimulus = visual.ImageStim(
-    win=win,
-    name='white_stimulus',
-    image=white_filename,
-    ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
-    color=[1,1,1], colorSpace='rgb', opacity=1,
-    flipHoriz=False, flipVert=False,
-    interpolate=True, depth=0.0)
-
-# Black stimulus
-black_stimulus = visual.ImageStim(
-    win=win,
-    name='black_stimulus',
-    image=black_filename,
-    ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
-    color=[1,1,1], colorSpace='rgb', opacity=1,
-    flipHoriz=False, flipVert=False,
-    interpolate=True, depth=0.0)
-    
-# Iso stimulus
-iso_stimulus = visual.ImageStim(
-    win=win,
-    name='iso_stimulus',
-    image=iso_filename,
-    ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
-    color=[1,1,1], colorSpace='rgb', opacity=1,
-    flipHoriz=False, flipVert=False,
-    interpolate=True, depth=0.0)
-    
-# Distractor plus stimulus
-distractor_plus_stimulus = visual.ImageStim(
-    win=win,
-    name='distractor_plus_stimulus',
-    image=distractor_filename,
-    ori=0.0, pos=(0,0), size=(stim_x_size, stim_y_size),
-    color=[1,1,1], colorSpace='rgb', opacity=1,
-    flipHoriz=False, flipVert=False,
-    interpolate=True, depth=0.0)
-    
-# Distractor cross stimulus
-distractor_cross_stimulus = visual.ImageStim(
-    win=win,
-    name='distractor_cross_stimulus',
-    image=distractor_filename,
-    ori=45, pos=(0,0), size=(stim_x_size, stim_y_size),
-    color=[1,1,1], colorSpace='rgb', opacity=1,
-    flipHoriz=False, flipVert=False,
-    interpolate=True, depth=0.0)
-    
-# *******************
-# *** TASK TIMERS ***
-# *******************
+        return {0: (stimulus_pool.get('glare_stimulus'), 'Glare'),
+                1: (stimulus_pool.get('nonglare_stimulus'), 'Nonglare'),
+                2: (stimulus_pool.get('iso_stimulus'), 'Iso'),
+                3: (stimulus_pool.get('white_stimulus'), 'White'),
+                4: (stimulus_pool.get('distractor_plus_stimulus'), 'Distractor Plus'),
+                5: (stimulus_pool.get('distractor_cross_stimulus'), 'Distractor Cross')}
 
-timer = core.Clock()
+    @cached_property
+    def brightness_stimulus_table(self) -> dict:
+        '''Brightness perception phase stimulus lookup table (stimulus type: first stimulus, second stimulus, log name)'''
 
-# ************************
-# *** INITIATE EYELINK ***
-# ************************
+        stimulus_pool = self.stimulus_pool
 
-# EyeLink Dummy mode? - Set to False if testing with actual system
-if info['EyeLink'] == 'y':
-    dummy_mode = False
-    
-elif info['EyeLink'] == 'n':
-    dummy_mode = True
+        return {0: (stimulus_pool.get('glare_stimulus'), stimulus_pool.get('nonglare_stimulus'), 'Glare vs Nonglare'),
+                1: (stimulus_pool.get('glare_stimulus'), stimulus_pool.get('iso_stimulus'), 'Glare vs Iso'),
+                2: (stimulus_pool.get('iso_stimulus'), stimulus_pool.get('nonglare_stimulus'), 'Nonglare vs Iso')}
 
-# Step 1: Connect to the EyeLink Host PC
+    @cached_property
+    def event_store(self) -> 'EventStore':
+        '''Per-trial and per-response event file'''
 
-# The Host IP address, by default, is "100.1.1.1".
-# the "el_tracker" objected created here can be accessed through the Pylink
-# Set the Host PC address to "None" (without quotes) to run the script
-# in "Dummy Mode"
-if dummy_mode:
-    el_tracker = pylink.EyeLink(None)
-else:
-    try:
-        el_tracker = pylink.EyeLink("100.1.1.1")
-    except RuntimeError as error:
-        print('ERROR:', error)
-        core.quit()
-        sys.exit()
-    
-# Step 2: Open an EDF data file on the Host PC
+        self.behavioral_filename
 
-# Define edf fileanme
-edf_file = edf_fname + ".EDF"
+        return EventStore(self.event_filename)
 
-try:
-    el_tracker.openDataFile(edf_file)
-except RuntimeError as err:
-    print('ERROR:', err)
-    # close the link if we have one open
-    if el_tracker.isConnected():
-        el_tracker.close()
-    core.quit()
-    sys.exit()
+    @cached_property
+    def timing(self) -> 'TimingRecorder':
+        '''Per-frame timing recorder (window flips, EyeLink/log messages, and key polls are timed from here on)'''
+
+        self.behavioral_filename
+        timing = TimingRecorder(self.timing_filename, self.frame_duration)
+
+        # Time every call of the instrumented functions
+        timing.instrument(self.win, 'flip', 'flip')
+        timing.instrument(self.el_tracker, 'sendMessage', 'message')
+        timing.instrument(logging, 'log', 'log')
+        timing.instrument(self.keyboard, 'getKeys', 'key_poll')
+        timing.instrument(event, 'getKeys', 'key_poll')
+        timing.instrument(event, 'waitKeys', 'wait')
 
-# Step 3: Configure the tracker
-
-# Put the tracker in offline mode before we change tracking parameters
-el_tracker.setOfflineMode()
-
-# Get the software version:  1-EyeLink I, 2-EyeLink II, 3/4-EyeLink 1000,
-# 5-EyeLink 1000 Plus, 6-Portable DUO
-if dummy_mode:
-    eyelink_ver = 0  # set version to 0, in case running in Dummy mode
-else:
-    eyelink_ver = 5
-    
-if not dummy_mode:
-    vstr = el_tracker.getTrackerVersionString()
-    eyelink_ver = int(vstr.split()[-1].split('.')[0])
-    # print out some version info in the shell
-    print('Running experiment on %s, version %d' % (vstr, eyelink_ver))
-
-# File and Link data control
-# what eye events to save in the EDF file, include everything by default
-file_event_flags = 'LEFT,RIGHT,FIXATION,SACCADE,BLINK,MESSAGE,BUTTON,INPUT'
-# what eye events to make available over the link, include everything by default
-link_event_flags = 'LEFT,RIGHT,FIXATION,SACCADE,BLINK,BUTTON,FIXUPDATE,INPUT'
-# what sample data to save in the EDF data file and to make available
-# over the link, include the 'HTARGET' flag to save head target sticker
-# data for supported eye trackers
-if eyelink_ver > 3:
-    file_sample_flags = 'LEFT,RIGHT,GAZE,HREF,RAW,AREA,HTARGET,GAZERES,BUTTON,STATUS,INPUT'
-    link_sample_flags = 'LEFT,RIGHT,GAZE,GAZERES,AREA,HTARGET,STATUS,INPUT'
-else:
-    file_sample_flags = 'LEFT,RIGHT,GAZE,HREF,RAW,AREA,GAZERES,BUTTON,STATUS,INPUT'
-    link_sample_flags = 'LEFT,RIGHT,GAZE,GAZERES,AREA,STATUS,INPUT'
-el_tracker.sendCommand("file_event_filter = %s" % file_event_flags)
-el_tracker.sendCommand("file_sample_data = %s" % file_sample_flags)
-el_tracker.sendCommand("link_event_filter = %s" % link_event_flags)
-el_tracker.sendCommand("link_sample_data = %s" % link_sample_flags)
-
-# Set EyeLink sample rate
-if eyelink_ver > 2 and not dummy_mode:
-    el_tracker.sendCommand("sample_rate 1000")
-    
-# Choose a calibration type, H3, HV3, HV5, HV13 (HV = horizontal/vertical),
-el_tracker.sendCommand("calibration_type = HV9")
-# Set a gamepad button to accept calibration/drift check target
-# You need a supported gamepad/button box that is connected to the Host PC
-el_tracker.sendCommand("button_function 5 'accept_target_fixation'")
-
-# Shrink the spread of the calibration/validation targets
-# if the default outermost targets are not all visible in the bore.
-# The default <x, y display proportion> is 0.88, 0.83 (88% of the display
-# horizontally and 83% vertically)
-el_tracker.sendCommand('calibration_area_proportion 0.88 0.83')
-el_tracker.sendCommand('validation_area_proportion 0.88 0.83')
-
-# Get the native screen resolution used by PsychoPy
-scn_width, scn_height = win.size
-
-# Resolution fix for Mac retina displays
-if 'Darwin' in platform.system():
-    if use_retina:
-        scn_width = int(scn_width/2.0)
-        scn_height = int(scn_height/2.0)
-        
-# Optional: online drift correction.
-# See the EyeLink 1000 / EyeLink 1000 Plus User Manual
-
-# Online drift correction to mouse-click position:
-# el_tracker.sendCommand('driftcorrect_cr_disable = OFF')
-# el_tracker.sendCommand('normal_click_dcorr = ON')
-
-# Online drift correction to a fixed location, e.g., screen center
-el_tracker.sendCommand('driftcorrect_cr_disable = OFF')
-el_tracker.sendCommand('online_dcorr_refposn %d,%d' % (int(scn_width/2.0),
-                                                        int(scn_height/2.0)))
-el_tracker.sendCommand('online_dcorr_button = ON')
-el_tracker.sendCommand('normal_click_dcorr = OFF')
-
-# Pass the display pixel coordinates (left, top, right, bottom) to the tracker
-# see the EyeLink Installation Guide, "Customizing Screen Settings"
-el_coords = "screen_pixel_coords = 0 0 %d %d" % (scn_width - 1, scn_height - 1)
-el_tracker.sendCommand(el_coords)
-
-# Write a DISPLAY_COORDS message to the EDF file
-# Data Viewer needs this piece of info for proper visualization, see Data
-# Viewer User Manual, "Protocol for EyeLink Data to Viewer Integration"
-dv_coords = "DISPLAY_COORDS  0 0 %d %d" % (scn_width - 1, scn_height - 1)
-el_tracker.sendMessage(dv_coords)
-
-# Configure a graphics environment (genv) for tracker calibration
-genv = EyeLinkCoreGraphicsPsychoPy(el_tracker, win)
-print(genv)  # print out the version number of the CoreGraphics library
-
-# Set background and foreground colors for the calibration target
-# in PsychoPy, (-1, -1, -1)=black, (1, 1, 1)=white, (0, 0, 0)=mid-gray
-foreground_color = (-1, -1, -1)
-background_color = win.color # Use the same background color as the entire study
-genv.setCalibrationColors(foreground_color, background_color)
-
-# Set up the calibration target
-
-# Use a picture as the calibration target
-genv.setTargetType('circle')
-genv.setTargetSize(24)
-#genv.setPictureTarget(os.path.join('images', 'fixTarget.bmp')) #CALIBRATION TARGET IMAGE
-
-# Configure the size of the calibration target (in pixels)
-# this option applies only to "circle" and "spiral" targets
-# genv.setTargetSize(24)
-
-# Beeps to play during calibration, validation and drift correction
-# parameters: target, good, error
-#     target -- sound to play when target moves
-#     good -- sound to play on successful operation
-#     error -- sound to play on failure or interruption
-# Each parameter could be ''--default sound, 'off'--no sound, or a wav file
-genv.setCalibrationSounds('off', 'off', 'off')
-
-# Resolution fix for macOS retina display issues
-if use_retina:
-    genv.fixMacRetinaDisplay()
-
-# Request Pylink to use the PsychoPy window we opened above for calibration
-pylink.openGraphicsEx(genv)
-
-#calibration task constants
-#set random seed
-rng = np.random.default_rng()
+        return timing
+
+    @cached_property
+    def tracer(self) -> 'SpanTracer':
+        '''Task span tracer (disabled without the --trace option)'''
+
+        self.behavioral_filename
+
+        return SpanTracer(self.trace_filename if self.options.trace else None)
+
+    @cached_property
+    def gaze_monitor(self) -> 'GazeMonitor':
+        '''Online fixation monitor (started once recording starts)'''
+
+        el_tracker = self.el_tracker
+
+        # EyeLink gaze coordinates (pixels) per centimeter on screen
+        px_per_cm = self.scn_width/self.win.monitor.getWidth()
+
+        return GazeMonitor(el_tracker, (self.scn_width, self.scn_height), px_per_cm)
+
+    @cached_property
+    def dispatcher(self) -> 'EventDispatcher':
+        '''Background task event dispatcher'''
+
+        dispatcher = EventDispatcher(self.win, self.el_tracker)
+
+        # Headless simulation: log simulated key presses after the queued events
+        if self.options.simulate:
+            self.simulation.event.before_keypress = dispatcher.drain
+
+        return dispatcher
+
+    def startup(self) -> None:
+        '''Set up every part of the session and log the startup timing breakdown'''
+
+        # Set up in order of use
+        self.schedules
+        self.frame_rate
+        self.keyboard
+        self.stimulus_pool
+        self.dispatcher
+        self.timing
+        self.tracer
+
+        # Time to the first instruction screen
+        self.startup_times['total'] = time.perf_counter() - import_start
+
+        # Log
+        for stage, duration in self.startup_times.items():
+            logging.log(level=logging.EXP,msg='Startup time (%s): %.1f ms' % (stage, duration*1000))
+        print('Startup time: ' + ', '.join('%s %.0f ms' % (stage, duration*1000) for stage, duration in self.startup_times.items()))
+
+class StartupTimer:
+    '''Context manager that adds the duration of a startup stage to startup_times'''
+
+    def __init__(self, startup_times: dict, stage: str):
+
+        self.startup_times = startup_times
+        self.stage = stage
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+
+        self.startup_times[self.stage] = time.perf_counter() - self.start
+
+# Task session
+# Note: Nothing is set up until first use (see main)
+session = TaskSession()
 
 # ************************
 # *** CUSTOM FUNCTIONS ***
@@ -427,9 +1762,66 @@ rng = np.random.default_rng()
 def clear_screen(win):
     """Clear up the PsychoPy window""" 
     
-    win.fillColor = genv.getBackgroundColor()
+    win.fillColor = session.genv.getBackgroundColor()
     win.flip()
 
+def seconds_to_frames(duration: float) -> int:
+    '''Convert an interval duration (in seconds) to a whole number of frames'''
+    
+    return int(round(duration*session.frame_rate))
+
+def present_frames(num_frames: int) -> np.ndarray:
+    '''Flip the window for a fixed number of frames and return the time of each flip'''
+    
+    # Initialize flip times
+    flip_times = np.zeros(num_frames)
+    
+    # Loop over frames
+    # Note: Each flip is synchronized to the screen refresh, so the loop
+    # waits on the display instead of polling a timer
+    for frame in range(num_frames):
+        flip_times[frame] = session.win.flip()
+        
+    return flip_times
+
+def count_dropped_frames(flip_times: np.ndarray) -> int:
+    '''Count the frames missed between consecutive flips'''
+    
+    # Number of frame durations between flips (1 = no dropped frame)
+    frames_per_interval = np.round(np.diff(flip_times)/session.frame_duration)
+    
+    return int(np.sum(np.maximum(frames_per_interval - 1, 0)))
+
+def write_frame_timing_report(trial_reports: list) -> None:
+    '''Append the per-trial planned vs. actual stimulus timing to the frame timing report'''
+    
+    # Report columns
+    report_columns = ['phase', 'block', 'trial', 'stim_type', 'pre_stim_frames', 'stim_frames', 'post_stim_frames',
+                      'planned_onset', 'actual_onset', 'onset_error_ms', 'planned_offset', 'actual_offset', 
+                      'offset_error_ms', 'dropped_frames']
+    
+    # Write header only when creating the report
+    write_header = not os.path.isfile(session.frame_timing_filename)
+    
+    with open(session.frame_timing_filename, 'a', newline='') as report_file:
+        writer = csv.DictWriter(report_file, fieldnames=report_columns, delimiter='\t')
+        if write_header:
+            writer.writeheader()
+        writer.writerows(trial_reports)
+
+def pupil_summary_text(summary: dict) -> str:
+    '''Format the online pupil summary (mean pupil response per stimulus type and side)'''
+    
+    # Mean pupil response (left | right) of each stimulus type
+    responses = []
+    for stim_type, (_, stimulus_name) in session.main_stimulus_table.items():
+        left_response = summary['responses'].get((stim_type, 0), np.nan)
+        right_response = summary['responses'].get((stim_type, 1), np.nan)
+        responses.append('%s %.0f | %.0f' % (stimulus_name, left_response, right_response))
+    
+    return ('Pupil response (left | right): ' + ', '.join(responses) + 
+            '\nBlinks: %.0f%%, rejected pupil trials: %d' % (summary['blink_fraction']*100, summary['rejected_trials']))
+
 def terminate_task():
     """ Terminate the task gracefully and retrieve the EDF data file
     file_to_retrieve: The EDF on the Host that we would like to download
@@ -446,7 +1838,7 @@ def terminate_task():
         el_tracker.closeDataFile()         
         el_tracker.sendMessage('End EyeLink Recording')
         el_tracker.close()
-    win.close()
+    session.win.close()
     core.quit()
     sys.exit()
     
@@ -457,7 +1849,7 @@ def abort_trial():
     if el_tracker.isRecording():
         pylink.pumpDelay(100)
         el_tracker.stopRecording()  
-    clear_screen(win)
+    clear_screen(session.win)
     bgcolor_RGB = (116, 116, 116)
     el_tracker.sendMessage('!V CLEAR %d %d %d' % bgcolor_RGB)
     el_tracker.sendMessage('TRIAL_RESULT %d' % pylink.TRIAL_ERROR)
@@ -466,16 +1858,27 @@ def abort_trial():
 def end_experiment() -> None:
     '''End of Experiment'''
     
+    # Write any queued events
+    session.dispatcher.stop()
+    session.event_store.flush()
+    session.tracer.export()
+    
+    # Stop fixation monitoring
+    session.gaze_monitor.stop()
+    
     # Log
     logging.log(level=logging.EXP,msg='*** END EXPERIMENT ***')
-    el_tracker.sendMessage('*** END EXPERIMENT ***')
+    session.el_tracker.sendMessage('*** END EXPERIMENT ***')
+    
+    # Write the timing records (including the records of an aborted block and the messages above)
+    session.timing.flush()
     
     # Stop recording
     pylink.pumpDelay(100)
-    el_tracker.stopRecording()
+    session.el_tracker.stopRecording()
     terminate_task()
     core.wait(2)
-    win.close()
+    session.win.close()
    
 def quit_task() -> None:
     '''Quit task based off of button press'''
@@ -516,12 +1919,12 @@ def instructions_screens(instruction: str) -> None:
     '''Function presents all the instructions needed for the task'''
     
     # Setup instructions
-    task_instructions = visual.TextStim(win, instruction, color = genv.getForegroundColor(), wrapWidth = scn_width/2)
-    clear_screen(win)
+    task_instructions = session.stimulus_pool.get('task_instructions', text=instruction)
+    clear_screen(session.win)
     
     # Draw instructions
     task_instructions.draw()
-    win.flip()   
+    session.win.flip()   
     
     # Proceed from instructions
     instruction_continue()
@@ -531,12 +1934,12 @@ def start_trigger():
     
     # Log
     logging.log(level=logging.EXP,msg='Waiting for start trigger')
-    el_tracker.sendMessage('Waiting for start trigger')
+    session.el_tracker.sendMessage('Waiting for start trigger')
         
     # On-screen text
-    start_instructions = visual.TextStim(win, text='Waiting for start trigger. Please standby...', color = genv.getForegroundColor(), wrapWidth = scn_width/2) 
+    start_instructions = session.stimulus_pool.get('start_instructions')
     start_instructions.draw()
-    win.flip()
+    session.win.flip()
 
     # Wait for key press
     key = event.waitKeys(keyList=['5','t','escape', 'p'])
@@ -547,7 +1950,7 @@ def start_trigger():
        
     # Log
     logging.log(level=logging.EXP,msg='Start trigger received')
-    el_tracker.sendMessage('Start trigger received')
+    session.el_tracker.sendMessage('Start trigger received')
 
 def check_keypresses():
     '''Check the key/buttons are received'''
@@ -555,12 +1958,12 @@ def check_keypresses():
     # Check '1' key
     
     # Setup instructions
-    task_instructions = visual.TextStim(win, "Please press '1'",color = 'black', pos = [0, 0])
-    clear_screen(win)
+    task_instructions = session.stimulus_pool.get('key_check', text="Please press '1'")
+    clear_screen(session.win)
     
     # Show instructions
     task_instructions.draw()
-    win.flip() 
+    session.win.flip() 
     
     # Only continue if the subject presses 1
     event.waitKeys(keyList = ['1'])
@@ -568,12 +1971,12 @@ def check_keypresses():
     # Check '2' key
     
     # Setup instructions
-    task_instructions = visual.TextStim(win, "Please press '2'",color = 'black', pos = [0, 0])
-    clear_screen(win)
+    task_instructions = session.stimulus_pool.get('key_check', text="Please press '2'")
+    clear_screen(session.win)
     
     # Show instructions
     task_instructions.draw()
-    win.flip() 
+    session.win.flip() 
     
     # Only continue if the subject presses 2
     event.waitKeys(keyList = ['2'])
@@ -581,45 +1984,158 @@ def check_keypresses():
     # Check '3' key
     
     # Setup instructions
-    task_instructions = visual.TextStim(win, "Please press '3'",color = 'black', pos = [0, 0])
-    clear_screen(win)
+    task_instructions = session.stimulus_pool.get('key_check', text="Please press '3'")
+    clear_screen(session.win)
     
     # Show instructions
     task_instructions.draw()
-    win.flip() 
+    session.win.flip() 
     
     # Only continue if the subject presses 3
     event.waitKeys(keyList = ['3'])
     
+def adaptive_positioning(start_stim_x_pos: float, start_stim_y_pos: float) -> tuple:
+    '''Find the stimulus position in the blind field with staircases on brief distractors (see Staircase)
+    Returns the final x and y positions'''
+    
+    # Fixation cross and distractor stimuli
+    fixation = session.stimulus_pool.get('fixation')
+    distractors = [session.stimulus_pool.get(name) for name in ['distractor_plus_stimulus', 'distractor_cross_stimulus']]
+    
+    # Blind field side (x sign of the blind field stimulus)
+    blind_field = session.info['Blind Field']
+    blind_side = -1 if 'left' in blind_field else 1
+    
+    # Staircases: distance from the vertical meridian, and height for quadrant blind fields
+    # Note: The height stays in the half of the screen of the blind quadrant
+    staircases = {'x': Staircase(start_stim_x_pos, 1, positioning_x_limits)}
+    if 'upper' in blind_field:
+        staircases['y'] = Staircase(start_stim_y_pos, 1, (0, positioning_y_limits[1]))
+    elif 'lower' in blind_field:
+        staircases['y'] = Staircase(start_stim_y_pos, -1, (positioning_y_limits[0], 0))
+    
+    # Random distractor types, intervals, and catch trials
+    # Note: Drawn from the session seed (separately from the session schedule)
+    rng = np.random.default_rng([session.session_seed, 1])
+    
+    # Trace span name ids (registered once, see SpanTracer.register)
+    trial_span_id = session.tracer.register('Positioning trial', 'trial')
+    
+    # Log
+    session.timing.set_context('positioning')
+    positioning_span = session.tracer.begin(session.tracer.register('Positioning', 'phase'), cpu=True)
+    logging.log(level=logging.EXP,msg='Adaptive Stimulus Location Positioning Phase (blind field: %s, target detection rate: %.2f)' % (blind_field, positioning_target_rate))
+    session.el_tracker.sendMessage('Adaptive Stimulus Location Positioning Phase (blind field: %s, target detection rate: %.2f)' % (blind_field, positioning_target_rate))
+    
+    # Instructions
+    instructions_screens('Now we will check where you can see images on screen. ' +
+                         '\nPlease keep your gaze at the center of the screen. ' +
+                         '\n\nPress 1 or 2 as soon as you see a red image.')
+    
+    # Show fixation
+    fixation.setAutoDraw(True)
+    
+    # Distractor and response window durations
+    flash_frames = seconds_to_frames(positioning_flash_duration)
+    response_frames = seconds_to_frames(positioning_response_window) - flash_frames
+    
+    # Trial counts (blind field, and sighted field catch trials)
+    trial_counter = blind_trials = blind_detected = catch_trials = catch_detected = 0
+    
+    # Loop until every staircase is done or the trial limit is reached
+    while blind_trials < positioning_max_trials and not all(staircase.done for staircase in staircases.values()):
+        
+        # Trial number
+        trial_counter = trial_counter + 1
+        session.timing.set_context('positioning', 0, trial_counter)
+        trial_span = session.tracer.begin(trial_span_id, trial_counter)
+        
+        # Quit task
+        quit_task()
+        
+        # Sighted field catch trial (mirrored position) or the next blind field staircase trial
+        catch_trial = rng.random() < positioning_catch_rate
+        staircase_name = rng.choice([name for name, staircase in staircases.items() if not staircase.done])
+        
+        # Distractor position
+        stim_x_pos = staircases['x'].value
+        stim_y_pos = staircases['y'].value if 'y' in staircases else start_stim_y_pos
+        distractor = distractors[rng.integers(len(distractors))]
+        distractor.pos = ((-blind_side if catch_trial else blind_side)*stim_x_pos, stim_y_pos)
+        
+        # Wait a random interval
+        present_frames(seconds_to_frames(rng.uniform(*positioning_ISI)))
+        
+        # Clear the key press buffer and time responses from the distractor onset flip
+        session.keyboard.clearEvents()
+        session.win.callOnFlip(session.keyboard.clock.reset)
+        
+        # Show the distractor briefly, then wait for the rest of the response window
+        distractor.setAutoDraw(True)
+        present_frames(flash_frames)
+        distractor.setAutoDraw(False)
+        present_frames(response_frames)
+        
+        # Detected if 1 or 2 was pressed in the response window
+        detected = any(key.rt <= positioning_response_window for key in session.keyboard.getKeys(keyList=['1', '2'], waitRelease=False))
+        
+        # Update the staircase (blind field trials only)
+        if catch_trial:
+            catch_trials = catch_trials + 1
+            catch_detected = catch_detected + detected
+        else:
+            staircases[staircase_name].update(detected)
+            blind_trials = blind_trials + 1
+            blind_detected = blind_detected + detected
+        
+        # Log
+        session.dispatcher.send('Adaptive positioning trial %d: %s field, x = %.2f, y = %.2f, detected = %d' % 
+                                (trial_counter, 'sighted' if catch_trial else 'blind', stim_x_pos, stim_y_pos, detected))
+        session.tracer.end(trial_span)
+    
+    # Remove fixation
+    fixation.setAutoDraw(False)
+    clear_screen(session.win)
+    session.dispatcher.drain()
+    
+    # Final position (mean of the staircase reversals)
+    final_stim_x_pos = round(staircases['x'].estimate(), 2)
+    final_stim_y_pos = round(staircases['y'].estimate(), 2) if 'y' in staircases else start_stim_y_pos
+    
+    # Log
+    # Note: Sighted field detections check that the participant is answering
+    summary = ('Adaptive positioning: %d trials, blind field detection rate %.2f (%d trials), sighted field detection rate %.2f (%d trials), %s' % 
+               (trial_counter, blind_detected/max(blind_trials, 1), blind_trials, catch_detected/max(catch_trials, 1), catch_trials, 
+                'converged' if all(staircase.done for staircase in staircases.values()) else 'stopped at the trial limit'))
+    logging.log(level=logging.EXP,msg=summary)
+    session.el_tracker.sendMessage(summary)
+    session.tracer.end(positioning_span)
+    
+    return final_stim_x_pos, final_stim_y_pos
+
 def stimulus_loc_positioning(start_stim_x_pos, start_stim_y_pos):
     '''Define two mirrored locations on screen to display the stimulus'''
     
+    # Fixation cross
+    fixation = session.stimulus_pool.get('fixation')
+    
+    # Adaptive positioning
+    if 'n' == session.info['(1) Skip Positioning Phase'] and 'adaptive' == session.info['(1) Positioning Mode']:
+        
+        final_stim_x_pos, final_stim_y_pos = adaptive_positioning(start_stim_x_pos, start_stim_y_pos)
+    
     # Run function
-    if 'n' == info['(1) Skip Positioning Phase']:
+    elif 'n' == session.info['(1) Skip Positioning Phase']:
 
         # Log
+        session.timing.set_context('positioning')
+        positioning_span = session.tracer.begin(session.tracer.register('Positioning', 'phase'), cpu=True)
         logging.log(level=logging.EXP,msg='Stimulus Location Positioning Phase')
-        el_tracker.sendMessage('Stimulus Location Positioning Phase')
-    
-        # Nonglare stimuli - Right side 
-        nonglare_right = visual.ImageStim(
-            win=win,
-            name='nonglare_right',
-            image=nonglare_filename,
-            ori=0.0, pos=(start_stim_x_pos,start_stim_y_pos), size=(stim_x_size, stim_y_size),
-            color=[1,1,1], colorSpace='rgb', opacity=1,
-            flipHoriz=False, flipVert=False,
-            interpolate=True, depth=0.0, units='cm')
-    
-        # Nonglare stimuli - Left side 
-        nonglare_left = visual.ImageStim(
-            win=win,
-            name='nonglare_left',
-            image=nonglare_filename,
-            ori=0.0, pos=(-start_stim_x_pos,start_stim_y_pos), size=(stim_x_size, stim_y_size),
-            color=[1,1,1], colorSpace='rgb', opacity=1,
-            flipHoriz=False, flipVert=False,
-            interpolate=True, depth=0.0, units='cm')
+        session.el_tracker.sendMessage('Stimulus Location Positioning Phase')
+    
+        # Nonglare stimuli - Right and left side 
+        nonglare_right = session.stimulus_pool.get('nonglare_right', pos=(start_stim_x_pos,start_stim_y_pos))
+        nonglare_left = session.stimulus_pool.get('nonglare_left', pos=(-start_stim_x_pos,start_stim_y_pos))
         
         # Initial x and y-dimension
         stim_y_pos = start_stim_y_pos
@@ -707,27 +2223,28 @@ def stimulus_loc_positioning(start_stim_x_pos, start_stim_y_pos):
                         nonglare_right.pos = (stim_x_pos, stim_y_pos)
     
             # Show screen
-            win.update()
+            session.win.update()
     
         # Remove stimuli from screen
         nonglare_right.setAutoDraw(False)
         nonglare_left.setAutoDraw(False)
         fixation.setAutoDraw(False)
+        session.tracer.end(positioning_span)
         
     # Skipping positioning    
     else:
 
         # Take the position information from values entered in startup screen
-        #final_stim_x_pos = int(info['Final X position'])
-        #inal_stim_y_pos = int(info['Final Y position']) 
-        final_stim_x_pos = float(info['Final X position'])
-        final_stim_y_pos = float(info['Final Y position']) 
+        #final_stim_x_pos = int(session.info['Final X position'])
+        #inal_stim_y_pos = int(session.info['Final Y position']) 
+        final_stim_x_pos = float(session.info['Final X position'])
+        final_stim_y_pos = float(session.info['Final Y position']) 
         
     # Log
     logging.log(level=logging.EXP,msg='Final x-axis position of stimuli: ' + str(final_stim_x_pos))
     logging.log(level=logging.EXP,msg='Final y-axis position of stimuli: ' + str(final_stim_y_pos))
-    el_tracker.sendMessage('Final x-axis position of stimuli: ' + str(final_stim_x_pos))
-    el_tracker.sendMessage('Final y-axis position of stimuli: ' + str(final_stim_y_pos))
+    session.el_tracker.sendMessage('Final x-axis position of stimuli: ' + str(final_stim_x_pos))
+    session.el_tracker.sendMessage('Final y-axis position of stimuli: ' + str(final_stim_y_pos))
 
     # Return location info
     return final_stim_y_pos, final_stim_x_pos       
@@ -735,25 +2252,35 @@ def stimulus_loc_positioning(start_stim_x_pos, start_stim_y_pos):
 def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
     ''' Main glare illusion task function'''
     
+    # Task stimuli
+    fixation, glare_stimulus, nonglare_stimulus, iso_stimulus, white_stimulus, distractor_plus_stimulus, distractor_cross_stimulus = [
+        session.stimulus_pool.get(name) for name in ['fixation', 'glare_stimulus', 'nonglare_stimulus', 'iso_stimulus', 'white_stimulus', 
+                                                     'distractor_plus_stimulus', 'distractor_cross_stimulus']]
+    
+    # Trace span name ids (registered once, see SpanTracer.register)
+    block_span_id, break_span_id, trial_span_id, pre_isi_span_id, stimulus_span_id, post_isi_span_id = [
+        session.tracer.register(name, category) for name, category in [('Block', 'block'), ('Block break', 'block'), ('Trial', 'trial'),
+                                                                       ('Pre-stimulus ISI', 'interval'), ('Stimulus', 'interval'), ('Post-stimulus ISI', 'interval')]]
+    
     # Run function
-    if 'n' == info['(2) Skip Main Phase']:
+    if 'n' == session.info['(2) Skip Main Phase']:
         
         # Log
         logging.log(level=logging.EXP,msg='Starting Glare Illusion Main Phase')
-        el_tracker.sendMessage('Starting Glare Illusion Main Phase')
+        session.el_tracker.sendMessage('Starting Glare Illusion Main Phase')
         
         # Log Button Condition
-        if button_condition == 1:
+        if session.button_condition == 1:
             
             # Log
             logging.log(level=logging.EXP,msg='Button Condition: 1')
-            el_tracker.sendMessage('Button Condition: 1')
+            session.el_tracker.sendMessage('Button Condition: 1')
             
-        elif button_condition == 2:
+        elif session.button_condition == 2:
 
             # Log
             logging.log(level=logging.EXP,msg='Button Condition: 2')
-            el_tracker.sendMessage('Button Condition: 2')
+            session.el_tracker.sendMessage('Button Condition: 2')
         
         # Instructions
         instructions_screens("Main Task Phase \n\nPlease fixate on the [+] at the center of the screen at all times."+
@@ -775,7 +2302,7 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
         distractor_plus_stimulus.setAutoDraw(True)
         distractor_cross_stimulus.setAutoDraw(True)
         fixation.setAutoDraw(True)
-        win.update()
+        session.win.update()
 
         # Instructions continue 
         instruction_continue()
@@ -788,17 +2315,17 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
         distractor_plus_stimulus.setAutoDraw(False)
         distractor_cross_stimulus.setAutoDraw(False)
         fixation.setAutoDraw(False)
-        win.update()
+        session.win.update()
         
         # Button press instructions
-        if button_condition == 1:
+        if session.button_condition == 1:
         
             # Define instructions
             instruction = "When you see a red plus sign [+] image - Press 1 \nWhen you see a red cross [x] image - Press 2 \n\nPlease select your button/key as soon as you see the red image."
             
             # Setup instructions
-            task_instructions = visual.TextStim(win, instruction, color = genv.getForegroundColor(), wrapWidth = scn_width/2)
-            clear_screen(win)
+            task_instructions = session.stimulus_pool.get('task_instructions', text=instruction)
+            clear_screen(session.win)
             
             # Set image position
             distractor_plus_stimulus.pos = (-8,-9)
@@ -808,23 +2335,23 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
             distractor_plus_stimulus.setAutoDraw(True)
             distractor_cross_stimulus.setAutoDraw(True)
             task_instructions.draw()
-            win.flip()   
+            session.win.flip()   
             
             # Proceed from instructions
             instruction_continue()
             
             distractor_plus_stimulus.setAutoDraw(False)
             distractor_cross_stimulus.setAutoDraw(False)
-            win.update()
+            session.win.update()
 
-        elif button_condition == 2:
+        elif session.button_condition == 2:
 
             # Define instructions
             instruction = "When you see a red cross [x] image - Press 1 /n/nWhen you see a red plus sign [+] image - Press 2 /n/nPlease select your button/key as soon as you see the red image."
 
             # Setup instructions
-            task_instructions = visual.TextStim(win, instruction, color = genv.getForegroundColor(), wrapWidth = scn_width/2)
-            clear_screen(win)
+            task_instructions = session.stimulus_pool.get('task_instructions', text=instruction)
+            clear_screen(session.win)
             
             # Set image position
             distractor_plus_stimulus.pos = (8,-10)
@@ -834,14 +2361,14 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
             distractor_plus_stimulus.setAutoDraw(True)
             distractor_cross_stimulus.setAutoDraw(True)
             task_instructions.draw()
-            win.flip()   
+            session.win.flip()   
             
             # Proceed from instructions
             instruction_continue()
             
             distractor_plus_stimulus.setAutoDraw(False)
             distractor_cross_stimulus.setAutoDraw(False)
-            win.update()
+            session.win.update()
 
         # Define initial right/left stimulus locations
         right_loc = (final_stim_x_pos, final_stim_y_pos)
@@ -853,86 +2380,62 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
         # Loop over blocks
         for block in range(max_num_blocks):
             
-            # Reset trial and stimulus counter
-            trial_counter = 0
-            glare_stim_counter = 0
-            nonglare_stim_counter = 0
-            iso_stim_counter = 0
-            white_stim_counter = 0
-            distractor_plus_stim_counter = 0
-            distractor_cross_stim_counter = 0
+            # Reset distractor perception counter
             right_distractor_perceived_num = 0
             left_distractor_perceived_num = 0
             
+            # Reset distractor reaction times (in seconds from stimulus onset)
+            right_distractor_rts = []
+            left_distractor_rts = []
+            
+            # Reset fixation break counter and repeated trials
+            block_fixation_breaks = 0
+            rerun_trials = set()
+            
+            # Reset the online pupil block counts
+            session.gaze_monitor.pupil.start_block()
+            
             # Initialize variable 
             right_perception_rate = []
             left_perception_rate = []
+            block_trial_reports = []
+            
+            # Tag the timing records with the block
+            session.timing.set_context('main', block_counter)
+            block_span = session.tracer.begin(block_span_id, block_counter, cpu=True)
             
             # Block start screen
             instructions_screens("Are you ready to start Block "+str(block_counter)+"?")
 
-            # Create stimuli type array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor plus stimulus; 5 = distractor cross stimulus)
-            glare_stim_array = np.array(np.zeros(num_glare_stim))
-            nonglare_stim_array = np.array(np.zeros(num_nonglare_stim)+1)
-            iso_stimulus_array = np.array(np.zeros(num_iso_stim)+2)
-            white_stimulus_array = np.array(np.zeros(num_white_stim)+3)
-            distractor_plus_stim_array = np.array(np.zeros(num_distractor_plus_stim)+4)
-            distractor_cross_stim_array = np.array(np.zeros(num_distractor_cross_stim)+5)
-
-            # Combine stimuli arrays
-            all_stim_array = np.concatenate((glare_stim_array,nonglare_stim_array,iso_stimulus_array,white_stimulus_array,distractor_plus_stim_array,distractor_cross_stim_array))
-            
-            # Shuffle stimuli array
-            random.shuffle(all_stim_array)
-                
-            # Create stimuli location arrays (0 = left; 1 = right)
-            glare_left_loc_array = np.array(np.zeros(int(num_glare_stim/2)))
-            glare_right_loc_array = np.array(np.zeros(int(num_glare_stim/2))+1)
-            
-            nonglare_left_loc_array = np.array(np.zeros(int(num_nonglare_stim/2)))
-            nonglare_right_loc_array = np.array(np.zeros(int(num_nonglare_stim/2))+1)
-            
-            iso_left_loc_array = np.array(np.zeros(int(num_iso_stim/2)))
-            iso_right_loc_array = np.array(np.zeros(int(num_iso_stim/2))+1)
+            # Select the block schedule
+            # Note: Stimulus types (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor plus stimulus; 5 = distractor cross stimulus)
+            # and locations (0 = left; 1 = right) were generated at startup from the session seed
+            block_schedule = session.schedules['main'][block]
             
-            white_left_loc_array = np.array(np.zeros(int(num_white_stim/2)))
-            white_right_loc_array = np.array(np.zeros(int(num_white_stim/2))+1)
+            # Stimuli type array
+            all_stim_array = block_schedule['stim_type'].astype(float)
             
-            distractor_plus_left_loc_array = np.array(np.zeros(int(num_distractor_plus_stim/2)))
-            distractor_plus_right_loc_array = np.array(np.zeros(int(num_distractor_plus_stim/2))+1)
-            
-            distractor_cross_left_loc_array = np.array(np.zeros(int(num_distractor_cross_stim/2)))
-            distractor_cross_right_loc_array = np.array(np.zeros(int(num_distractor_cross_stim/2))+1)
-            
-            # Combine stimuli location arrays
-            all_glare_loc_array = np.concatenate((glare_left_loc_array,glare_right_loc_array))
-            all_nonglare_loc_array = np.concatenate((nonglare_left_loc_array,nonglare_right_loc_array))
-            all_iso_loc_array = np.concatenate((iso_left_loc_array,iso_right_loc_array))
-            all_white_loc_array = np.concatenate((white_left_loc_array,white_right_loc_array))
-            all_distractor_plus_loc_array = np.concatenate((distractor_plus_left_loc_array,distractor_plus_right_loc_array))
-            all_distractor_cross_loc_array = np.concatenate((distractor_cross_left_loc_array,distractor_cross_right_loc_array))
-
-            # Shuffle stimuli arrays
-            random.shuffle(all_glare_loc_array)
-            random.shuffle(all_nonglare_loc_array)
-            random.shuffle(all_iso_loc_array)
-            random.shuffle(all_white_loc_array)
-            random.shuffle(all_distractor_plus_loc_array)
-            random.shuffle(all_distractor_cross_loc_array)
+            # Stimuli location arrays (in order of presentation of each stimulus type)
+            all_glare_loc_array = block_schedule['side'][block_schedule['stim_type'] == 0].astype(float)
+            all_nonglare_loc_array = block_schedule['side'][block_schedule['stim_type'] == 1].astype(float)
+            all_iso_loc_array = block_schedule['side'][block_schedule['stim_type'] == 2].astype(float)
+            all_white_loc_array = block_schedule['side'][block_schedule['stim_type'] == 3].astype(float)
+            all_distractor_plus_loc_array = block_schedule['side'][block_schedule['stim_type'] == 4].astype(float)
+            all_distractor_cross_loc_array = block_schedule['side'][block_schedule['stim_type'] == 5].astype(float)
 
             # Task start trigger
             start_trigger()
             
             # Log block
             logging.log(level=logging.EXP,msg='Block #' + str(block_counter))
-            el_tracker.sendMessage("Block #%d" % (block_counter))
+            session.el_tracker.sendMessage("Block #%d" % (block_counter))
             
             # Log stimulus location
             logging.log(level=logging.EXP,msg='Right Stimulus Location: ' + str(right_loc))
             logging.log(level=logging.EXP,msg='Left Stimulus Location: ' + str(left_loc))
 
-            el_tracker.sendMessage('Right Stimulus Location: ' + str(right_loc))
-            el_tracker.sendMessage('Left Stimulus Location: ' + str(left_loc))
+            session.el_tracker.sendMessage('Right Stimulus Location: ' + str(right_loc))
+            session.el_tracker.sendMessage('Left Stimulus Location: ' + str(left_loc))
         
             # Log the stimulus and location arrays
             logging.log(level=logging.EXP,msg='All Stimuli Type Array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor): ' + str(all_stim_array))
@@ -943,35 +2446,44 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
             logging.log(level=logging.EXP,msg='Distractor Plus Stimuli Location Array (0 = left; 1 = right): ' + str(all_distractor_plus_loc_array))
             logging.log(level=logging.EXP,msg='Distractor Cross Stimuli Location Array (0 = left; 1 = right): ' + str(all_distractor_cross_loc_array))
             
-            el_tracker.sendMessage('All Stimuli Type Array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor): ' + str(all_stim_array))
-            el_tracker.sendMessage('Glare Stimuli Location Array (0 = left; 1 = right): ' + str(all_glare_loc_array))
-            el_tracker.sendMessage('Nonglare Stimuli Location Array (0 = left; 1 = right): ' + str(all_nonglare_loc_array))
-            el_tracker.sendMessage('Iso Stimuli Location Array (0 = left; 1 = right): ' + str(all_iso_loc_array))
-            el_tracker.sendMessage('White Stimuli Location Array (0 = left; 1 = right): ' + str(all_white_loc_array))
-            el_tracker.sendMessage('Distractor Plus Stimuli Location Array (0 = left; 1 = right): ' + str(all_distractor_plus_loc_array))
-            el_tracker.sendMessage('Distractor Cross Stimuli Location Array (0 = left; 1 = right): ' + str(all_distractor_cross_loc_array))
+            session.el_tracker.sendMessage('All Stimuli Type Array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor): ' + str(all_stim_array))
+            session.el_tracker.sendMessage('Glare Stimuli Location Array (0 = left; 1 = right): ' + str(all_glare_loc_array))
+            session.el_tracker.sendMessage('Nonglare Stimuli Location Array (0 = left; 1 = right): ' + str(all_nonglare_loc_array))
+            session.el_tracker.sendMessage('Iso Stimuli Location Array (0 = left; 1 = right): ' + str(all_iso_loc_array))
+            session.el_tracker.sendMessage('White Stimuli Location Array (0 = left; 1 = right): ' + str(all_white_loc_array))
+            session.el_tracker.sendMessage('Distractor Plus Stimuli Location Array (0 = left; 1 = right): ' + str(all_distractor_plus_loc_array))
+            session.el_tracker.sendMessage('Distractor Cross Stimuli Location Array (0 = left; 1 = right): ' + str(all_distractor_cross_loc_array))
 
             # Track time taken to complete block
-            block_start = time.time()
+            block_start = core.getTime()
+    
+            # Block trials
+            # Note: Trials with a fixation break can be added to the end (see rerun_fixation_break_trials)
+            block_trials = list(block_schedule)
     
             # Loop over trials/stimuli
-            for current_stim in all_stim_array:
+            for trial in block_trials:
                 
-                # Count the number of trials
-                trial_counter = trial_counter+1
+                # Trial number, stimulus type, and location
+                trial_counter = int(trial['trial'])
+                current_stim = int(trial['stim_type'])
+                current_side = int(trial['side'])
+                session.timing.set_context('main', block_counter, trial_counter)
+                trial_span = session.tracer.begin(trial_span_id, trial_counter)
                 
-                # Select the pre and post stimulus durations
-                trial_pre_stim_time = random.randint(ISI_min_duration_sec,ISI_max_duration_sec)
-                trial_post_stim_time = random.randint(ISI_min_duration_sec,ISI_max_duration_sec)
+                # Pre and post stimulus durations
+                trial_pre_stim_time = int(trial['pre_isi'])
+                trial_post_stim_time = int(trial['post_isi'])
                 
-                # Log
-                logging.log(level=logging.EXP,msg='Starting Trial #'+str(trial_counter))
-                logging.log(level=logging.EXP,msg='Trial Pre-Stimulus Time: '+str(trial_pre_stim_time))
-                logging.log(level=logging.EXP,msg='Trial Post-Stimulus Time: '+str(trial_post_stim_time))
+                # Plan the trial intervals as frame counts
+                pre_stim_frames = seconds_to_frames(trial_pre_stim_time)
+                stim_frames = seconds_to_frames(stimulus_duration)
+                post_stim_frames = seconds_to_frames(trial_post_stim_time)
                 
-                el_tracker.sendMessage("Starting Trial " + str(trial_counter))
-                el_tracker.sendMessage("Trial Pre-Stimulus Time: " + str(trial_pre_stim_time))
-                el_tracker.sendMessage("Trial Post-Stimulus Time: " + str(trial_post_stim_time))
+                # Log
+                session.dispatcher.send('Starting Trial #'+str(trial_counter), eyelink_msg="Starting Trial " + str(trial_counter))
+                session.dispatcher.send('Trial Pre-Stimulus Time: '+str(trial_pre_stim_time))
+                session.dispatcher.send('Trial Post-Stimulus Time: '+str(trial_post_stim_time))
                 
                 # Quit task
                 quit_task()
@@ -981,290 +2493,249 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
                 # Setup fixation
                 fixation.setAutoDraw(True)
                 
-                # Log
-                logging.log(level=logging.EXP,msg='Pre-stimulus interval')
-                el_tracker.sendMessage('Pre-stimulus interval')
-                
-                # Reset timer
-                timer.reset()
+                # Log on the first pre-stimulus frame
+                session.dispatcher.send_on_flip('Pre-stimulus interval')
                 
                 # Wait pre-stimulus ISI
-                while timer.getTime() < trial_pre_stim_time:
-                    win.update()
+                # Note: The first flip is the start of the trial
+                interval_span = session.tracer.begin(pre_isi_span_id)
+                pre_stim_flips = present_frames(pre_stim_frames)
+                session.tracer.end(interval_span)
                 
-                # If glare stimulus
-                if current_stim == 0:
-                    
-                    # Set right position
-                    if all_glare_loc_array[glare_stim_counter] == 1:
-                        glare_stimulus.pos = right_loc
-                          
-                    # Set left position
-                    elif all_glare_loc_array[glare_stim_counter] == 0:
-                        glare_stimulus.pos = left_loc
-                    
-                    # Add to stimulus counter
-                    glare_stim_counter = glare_stim_counter+1
-                
-                    # Show stimulus
-                    glare_stimulus.setAutoDraw(True)
-                    
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Glare Stimulus')
-                    el_tracker.sendMessage('Draw Glare Stimulus')
-        
-                # If nonglare stimulus
-                elif current_stim == 1:
-                    
-                    # Set right position
-                    if all_nonglare_loc_array[nonglare_stim_counter] == 1:
-                        nonglare_stimulus.pos = right_loc
-                        
-                    # Set left position
-                    elif all_nonglare_loc_array[nonglare_stim_counter] == 0:
-                        nonglare_stimulus.pos = left_loc
-                        
-                    # Add to stimulus counter
-                    nonglare_stim_counter = nonglare_stim_counter+1
+                # Look up the trial stimulus
+                current_stimulus, current_stimulus_name = session.main_stimulus_table[current_stim]
                 
-                    # Show stimulus
-                    nonglare_stimulus.setAutoDraw(True)
-                
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Nonglare Stimulus')
-                    el_tracker.sendMessage('Draw Nonglare Stimulus')
-                    
-                # If iso stimulus
-                elif current_stim == 2:
+                # Set right position
+                if current_side == 1:
+                    current_stimulus.pos = right_loc
                     
-                    # Set right position
-                    if all_iso_loc_array[iso_stim_counter] == 1:
-                        iso_stimulus.pos = right_loc
-                          
-                    # Set left position
-                    elif all_iso_loc_array[iso_stim_counter] == 0:
-                        iso_stimulus.pos = left_loc
-                        
-                    # Add to stimulus counter
-                    iso_stim_counter = iso_stim_counter+1
+                # Set left position
+                elif current_side == 0:
+                    current_stimulus.pos = left_loc
                 
-                    # Show stimulus
-                    iso_stimulus.setAutoDraw(True)
-                    
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Iso Stimulus')
-                    el_tracker.sendMessage('Draw Iso Stimulus')
-        
-                # If white stimulus
-                elif current_stim == 3:
-                    
-                    # Set right position
-                    if all_white_loc_array[white_stim_counter] == 1:
-                        white_stimulus.pos = right_loc
-                        
-                    # Set left position
-                    elif all_white_loc_array[white_stim_counter] == 0:
-                        white_stimulus.pos = left_loc
-                        
-                    # Add to stimulus counter
-                    white_stim_counter = white_stim_counter+1
+                # Set distractor perception variable
+                not_perceived = 1
                 
-                    # Show stimulus
-                    white_stimulus.setAutoDraw(True)
+                # Trial responses (key, reaction time)
+                trial_responses = []
                 
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw White Stimulus')
-                    el_tracker.sendMessage('Draw White Stimulus')
-        
-                # If distractor plus stimulus
-                elif current_stim == 4:
-                    
-                    # Set distractor perception variable
-                    not_perceived = 1
-                    
-                    # Set right position
-                    if all_distractor_plus_loc_array[distractor_plus_stim_counter] == 1:
-                        distractor_plus_stimulus.pos = right_loc
-                        
-                    # Set left position
-                    elif all_distractor_plus_loc_array[distractor_plus_stim_counter] == 0:
-                        distractor_plus_stimulus.pos = left_loc
-                        
-                    # Add to stimulus counter
-                    distractor_plus_stim_counter = distractor_plus_stim_counter+1
+                # Show stimulus
+                current_stimulus.setAutoDraw(True)
                 
-                    # Show stimulus
-                    distractor_plus_stimulus.setAutoDraw(True)
-                        
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Distractor Plus Stimulus')
-                    el_tracker.sendMessage('Draw Distractor Plus Stimulus')
+                # Log on the stimulus onset flip
+                session.dispatcher.send_on_flip('Draw ' + current_stimulus_name + ' Stimulus')
                 
-                # If distractor cross stimulus
-                elif current_stim == 5:
-                    
-                    # Set distractor perception variable
-                    not_perceived = 1
-                    
-                    # Set right position
-                    if all_distractor_cross_loc_array[distractor_cross_stim_counter] == 1:
-                        distractor_cross_stimulus.pos = right_loc
-                        
-                    # Set left position
-                    elif all_distractor_cross_loc_array[distractor_cross_stim_counter] == 0:
-                        distractor_cross_stimulus.pos = left_loc
-                        
-                    # Add to stimulus counter
-                    distractor_cross_stim_counter = distractor_cross_stim_counter+1
+                # Clear the key press buffer
+                session.keyboard.clearEvents()
                 
-                    # Show stimulus
-                    distractor_cross_stimulus.setAutoDraw(True)
-                        
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Distractor Cross Stimulus')
-                    el_tracker.sendMessage('Draw Distractor Cross Stimulus')
+                # Time responses from the stimulus onset flip
+                session.win.callOnFlip(session.keyboard.clock.reset)
                 
-                # Clear the key press buffer
-                event.clearEvents()
+                # Monitor fixation and the pupil response from the stimulus onset flip
+                session.win.callOnFlip(session.gaze_monitor.begin_trial, current_stim, current_side)
                
-                # Reset timer
-                timer.reset()
+                # Initialize stimulus flip times
+                stim_flips = np.zeros(stim_frames)
                 
                 # Display for stimulus for stimulus duration
-                while timer.getTime() < stimulus_duration:
+                # Note: The first flip is the stimulus onset
+                interval_span = session.tracer.begin(stimulus_span_id)
+                for frame in range(stim_frames):
                     
                     # Receive specified keys
-                    allKeys = event.getKeys(['1', '2', 'p','escape']) 
+                    # Note: The reaction time (rt) is relative to the stimulus onset flip
+                    allKeys = session.keyboard.getKeys(keyList=['1', '2', 'p','escape'], waitRelease=False)
                         
                     # Loop over key presses 
                     for thisKey in allKeys:
                             
                         # Distractor stimulus keys
-                        if thisKey == '1' or thisKey == '2':
+                        if thisKey.name == '1' or thisKey.name == '2':
                                                       
                            # If a distractor stimulus was shown this trial                     
-                           if current_stim == 4 and not_perceived:
+                           if current_stim in distractor_stim_types and not_perceived:
                                 
                                # Log 
-                               logging.log(level=logging.EXP,msg='Perceived Distractor')
-                               el_tracker.sendMessage('Perceived Distractor')   
+                               session.dispatcher.send('Perceived Distractor')
                            
                                # Distractor was shown on the right side 
-                               if all_distractor_plus_loc_array[distractor_plus_stim_counter-1] == 1:
+                               if current_side == 1:
                             
                                    # Add 1 to distractor response array
                                    right_distractor_perceived_num = right_distractor_perceived_num+1
-                            
-                               # Distractor was shown on the left side
-                               elif all_distractor_plus_loc_array[distractor_plus_stim_counter-1] == 0:
-                                    
-                                   # Add 1 to distractor response array
-                                   left_distractor_perceived_num = left_distractor_perceived_num+1
                                    
-                               # Flip not_perceived
-                               not_perceived = 0
-                               
-                           elif current_stim == 5 and not_perceived:
-
-                               # Log 
-                               logging.log(level=logging.EXP,msg='Perceived Distractor')
-                               el_tracker.sendMessage('Perceived Distractor')   
-                           
-                               # Distractor was shown on the right side 
-                               if all_distractor_cross_loc_array[distractor_cross_stim_counter-1] == 1:
-                            
-                                   # Add 1 to distractor response array
-                                   right_distractor_perceived_num = right_distractor_perceived_num+1
+                                   # Store reaction time
+                                   right_distractor_rts.append(thisKey.rt)
                             
                                # Distractor was shown on the left side
-                               elif all_distractor_cross_loc_array[distractor_cross_stim_counter-1] == 0:
+                               elif current_side == 0:
                                     
                                    # Add 1 to distractor response array
                                    left_distractor_perceived_num = left_distractor_perceived_num+1
                                    
+                                   # Store reaction time
+                                   left_distractor_rts.append(thisKey.rt)
+                                   
                                # Flip not_perceived
                                not_perceived = 0
+                               
+                           # Log reaction time of every key press
+                           # Note: Sent after "Perceived Distractor" so the message order of distractor trials is unchanged
+                           session.dispatcher.send('Response RT: %s %.4f' % (thisKey.name, thisKey.rt))
+                           trial_responses.append((int(thisKey.name), thisKey.rt))
                         
                         # Exit task button press
-                        elif np.in1d(thisKey,['escape','p']):
-                            core.quit() 
+                        # Note: Ends the experiment, so the queued events and block records are written
+                        elif np.in1d(thisKey.name,['escape','p']):
+                            end_experiment()
                     
                     # Update window
-                    win.update()
+                    stim_flips[frame] = session.win.flip()
+                session.tracer.end(interval_span)
                 
-                # Turn off glare stimulus
-                if current_stim == 0:
-                    glare_stimulus.setAutoDraw(False)
+                # Stop monitoring fixation
+                fixation_break, max_gaze_deviation = session.gaze_monitor.end_trial()
                 
-                # Turn off nonglare stimulus
-                elif current_stim == 1:
-                    nonglare_stimulus.setAutoDraw(False)
+                # Turn off stimulus
+                current_stimulus.setAutoDraw(False)
                 
-                # Turn off iso circle stimulus
-                elif current_stim == 2:
-                    iso_stimulus.setAutoDraw(False)
-
-                # Turn off white circle stimulus
-                elif current_stim == 3:
-                    white_stimulus.setAutoDraw(False)
-
-                # Turn off distractor plus stimulus
-                elif current_stim == 4:
-                    distractor_plus_stimulus.setAutoDraw(False)
+                # Log on the stimulus offset flip
+                session.dispatcher.send_on_flip('Post-stimulus interval')
                 
-                # Turn off distractor cross stimulus
-                elif current_stim == 5:
-                    distractor_cross_stimulus.setAutoDraw(False)
+                # Wait post-stimulus time
+                # Note: The first flip removes the stimulus from screen (stimulus offset)
+                interval_span = session.tracer.begin(post_isi_span_id)
+                post_stim_flips = present_frames(post_stim_frames)
+                session.tracer.end(interval_span)
                 
-                # Remove stimulus from screen
-                win.update()
+                # Log reaction time of key presses after the stimulus offset
+                for thisKey in session.keyboard.getKeys(keyList=['1', '2'], waitRelease=False):
+                    session.dispatcher.send('Response RT: %s %.4f' % (thisKey.name, thisKey.rt))
+                    trial_responses.append((int(thisKey.name), thisKey.rt))
                 
-                # Log
-                logging.log(level=logging.EXP,msg='Post-stimulus interval')
-                el_tracker.sendMessage('Post-stimulus interval')
+                # Planned onset/offset times relative to the start of the trial
+                planned_onset = pre_stim_flips[0] + pre_stim_frames*session.frame_duration
+                planned_offset = planned_onset + stim_frames*session.frame_duration
                 
-                # Reset timers
-                timer.reset()
+                # Count dropped frames across the trial
+                trial_dropped_frames = count_dropped_frames(np.concatenate((pre_stim_flips, stim_flips, post_stim_flips)))
                 
-                # Wait post-stimulus time
-                while timer.getTime() < trial_post_stim_time:
+                # Log dropped frames
+                if trial_dropped_frames > 0:
+                    session.dispatcher.send('Dropped frames: ' + str(trial_dropped_frames))
+                
+                # Log fixation break
+                # Note: Sent at the end of the trial so the message order of the trial is unchanged
+                if fixation_break:
+                    session.dispatcher.send('Fixation break: %.2f cm' % max_gaze_deviation)
+                    block_fixation_breaks = block_fixation_breaks + 1
                     
-                    # Update window
-                    win.update()
+                    # Repeat the trial at the end of the block
+                    # Note: A repeated trial does not count toward the distractor perception rate
+                    if rerun_fixation_break_trials and trial_counter not in rerun_trials:
+                        rerun_trials.add(trial_counter)
+                        block_trials.append(trial)
+                        session.dispatcher.send('Repeat Trial #' + str(trial_counter))
+                        
+                        # Remove the distractor response
+                        if current_stim in distractor_stim_types and not not_perceived:
+                            if current_side == 1:
+                                right_distractor_perceived_num = right_distractor_perceived_num-1
+                                right_distractor_rts.pop()
+                            elif current_side == 0:
+                                left_distractor_perceived_num = left_distractor_perceived_num-1
+                                left_distractor_rts.pop()
+                
+                # Store trial timing
+                block_trial_reports.append({'phase': 'main', 'block': block_counter, 'trial': trial_counter, 'stim_type': int(current_stim),
+                                            'pre_stim_frames': pre_stim_frames, 'stim_frames': stim_frames, 'post_stim_frames': post_stim_frames,
+                                            'planned_onset': '%.4f' % planned_onset, 'actual_onset': '%.4f' % stim_flips[0],
+                                            'onset_error_ms': '%.2f' % ((stim_flips[0] - planned_onset)*1000),
+                                            'planned_offset': '%.4f' % planned_offset, 'actual_offset': '%.4f' % post_stim_flips[0],
+                                            'offset_error_ms': '%.2f' % ((post_stim_flips[0] - planned_offset)*1000),
+                                            'dropped_frames': trial_dropped_frames})
+                
+                # Store trial and response events
+                # Note: The trial row holds the first response of the trial
+                first_response, first_rt = trial_responses[0] if trial_responses else (0, np.nan)
+                session.event_store.add('main', 'trial', block_counter, trial_counter, current_stim, current_side,
+                                        onset=stim_flips[0], offset=post_stim_flips[0], response=first_response, rt=first_rt, fixation_break=fixation_break)
+                for response, rt in trial_responses:
+                    session.event_store.add('main', 'response', block_counter, trial_counter, current_stim, current_side,
+                                            onset=stim_flips[0] + rt, response=response, rt=rt, fixation_break=fixation_break)
+                session.tracer.end(trial_span)
             
             # End of block        
             
             # Update screen
             fixation.setAutoDraw(False)
-            clear_screen(win)
+            clear_screen(session.win)
                         
             # End block time
-            block_end = time.time()
+            block_end = core.getTime()
+            session.timing.set_context('main', block_counter)
+            
+            # Write the queued trial events before the block summary
+            session.dispatcher.drain()
+            
+            # Save block frame timing report
+            write_frame_timing_report(block_trial_reports)
+            
+            # Write block events
+            session.event_store.flush()
     
             # Calculate distractor stimulus perception rate
             left_perception_rate = left_distractor_perceived_num/(num_distractor_plus_stim/2+num_distractor_cross_stim/2)
             right_perception_rate = right_distractor_perceived_num/(num_distractor_plus_stim/2+num_distractor_cross_stim/2)
+            
+            # Calculate distractor median reaction time (NaN if no distractor was perceived)
+            right_median_rt = np.median(right_distractor_rts) if right_distractor_rts else np.nan
+            left_median_rt = np.median(left_distractor_rts) if left_distractor_rts else np.nan
+    
+            # Online pupil summary
+            pupil_text = pupil_summary_text(session.gaze_monitor.pupil_summary())
+            
+            # Block frame timing summary (dropped frames and latency percentiles), then write the timing records
+            timing_text = session.timing.summary()
+            session.timing.flush()
+    
+            # Log reaction times, fixation breaks, the pupil summary, and the frame timing summary
+            # Note: Logged before the block duration, so the rows after "Block duration" are unchanged
+            logging.log(level=logging.EXP,msg='Right distractor median RT: %.4f' % right_median_rt)
+            logging.log(level=logging.EXP,msg='Left distractor median RT: %.4f' % left_median_rt)
+            logging.log(level=logging.EXP,msg='Block fixation breaks: ' + str(block_fixation_breaks))
+            logging.log(level=logging.EXP,msg='Online pupil summary: ' + pupil_text.replace('\n', '; '))
+            logging.log(level=logging.EXP,msg='Frame timing: ' + timing_text)
+            
+            session.el_tracker.sendMessage('Right distractor median RT: %.4f' % right_median_rt)
+            session.el_tracker.sendMessage('Left distractor median RT: %.4f' % left_median_rt)
+            session.el_tracker.sendMessage('Block fixation breaks: ' + str(block_fixation_breaks))
+            session.el_tracker.sendMessage('Online pupil summary: ' + pupil_text.replace('\n', '; '))
+            session.el_tracker.sendMessage('Frame timing: ' + timing_text)
     
             # Log
             logging.log(level=logging.EXP,msg='Block duration: ' + str(block_end-block_start))
             logging.log(level=logging.EXP,msg='Right distractor perception rate: '+str(right_perception_rate))
             logging.log(level=logging.EXP,msg='Left distractor perception rate: '+str(left_perception_rate))
             
-            el_tracker.sendMessage("Block duration: " +str(block_end-block_start))
-            el_tracker.sendMessage("Right distractor perception rate: " +str(right_perception_rate))
-            el_tracker.sendMessage("Left distractor perception rate: " +str(left_perception_rate))
+            session.el_tracker.sendMessage("Block duration: " +str(block_end-block_start))
+            session.el_tracker.sendMessage("Right distractor perception rate: " +str(right_perception_rate))
+            session.el_tracker.sendMessage("Left distractor perception rate: " +str(left_perception_rate))
+            session.tracer.end(block_span)
 
             # Block break screen
-            block_break = visual.TextStim(win, text="Great job! Take a break.\n\nYou completed Block "+str(block_counter)+
-                                          ".\n[<<- "+str(left_perception_rate)+" ->> "+str(right_perception_rate)+
-                                          "]\n\nExperimenter:\nspace = continue to next block \nb = break to new task phase \nl = stim positioning", color='black')
+            block_break = session.stimulus_pool.get('block_break', text="Great job! Take a break.\n\nYou completed Block "+str(block_counter)+
+                                            ".\n[<<- "+str(left_perception_rate)+" ->> "+str(right_perception_rate)+
+                                            "]\n\n"+pupil_text+"\n\nExperimenter:\nspace = continue to next block \nb = break to new task phase \nl = stim positioning")
             
             # Show break screen
+            break_span = session.tracer.begin(break_span_id, block_counter)
             block_break.draw()
-            win.flip()
+            session.win.flip()
             
             # Continue or quit
             key = block_continue()
+            session.tracer.end(break_span)
             
             # Break from current block
             if np.in1d(key, ['b']):
@@ -1291,12 +2762,20 @@ def glare_main_phase(final_stim_x_pos, final_stim_y_pos):
 def brightness_perception():
     '''Test the subjective brightness of each stimulus'''
     
+    # Task stimuli
+    glare_stimulus, nonglare_stimulus, iso_stimulus = [session.stimulus_pool.get(name) for name in ['glare_stimulus', 'nonglare_stimulus', 'iso_stimulus']]
+    
+    # Trace span name ids (registered once, see SpanTracer.register)
+    block_span_id, break_span_id, trial_span_id, pre_isi_span_id, stimulus_span_id = [
+        session.tracer.register(name, category) for name, category in [('Block', 'block'), ('Block break', 'block'), ('Trial', 'trial'),
+                                                                       ('Pre-stimulus ISI', 'interval'), ('Stimulus', 'interval')]]
+    
     # Run function
-    if 'n' == info['(3) Skip Brightness Phase']: 
+    if 'n' == session.info['(3) Skip Brightness Phase']: 
     
         # Log
         logging.log(level=logging.EXP,msg='Starting Glare Illusion Perception Phase')
-        el_tracker.sendMessage('Starting Glare Illusion Perception Phase')
+        session.el_tracker.sendMessage('Starting Glare Illusion Perception Phase')
         
         # Instructions
         instructions_screens("Brightness Perception Phase \n\nInstructions: You will see two images at a time. \nPlease judge if the center " + 
@@ -1312,7 +2791,7 @@ def brightness_perception():
         glare_stimulus.setAutoDraw(True)
         nonglare_stimulus.setAutoDraw(True)
         iso_stimulus.setAutoDraw(True)
-        win.update()
+        session.win.update()
 
         # Instructions continue 
         instruction_continue()
@@ -1321,72 +2800,47 @@ def brightness_perception():
         glare_stimulus.setAutoDraw(False)
         nonglare_stimulus.setAutoDraw(False)
         iso_stimulus.setAutoDraw(False)
-        win.update()
+        session.win.update()
 
         # Define right/left locations
         right_loc = (12, 0)
         left_loc = (-12, 0)
     
-        # Number of contrast types
-        num_glare_vs_nonglare = 10
-        num_glare_vs_iso = 10
-        num_nonglare_vs_iso = 10
-    
         # Block counter reset
         block_counter = 1
             
         # Loop over blocks
         for block in range(max_num_blocks):
                 
-            # Reset trial and stimulus counter
-            trial_counter = 0
-            glare_vs_nonglare_counter = 0
-            glare_vs_iso_counter = 0
-            nonglare_vs_iso_counter = 0
-            
             # Initialize variables 
             brightness_answers = []
             
+            # Tag the timing records with the block
+            session.timing.set_context('brightness', block_counter)
+            block_span = session.tracer.begin(block_span_id, block_counter, cpu=True)
+            
             # Block start screen
             instructions_screens("Are you ready to start Block "+str(block_counter)+"?")
 
-            # Create stimuli type array (0 = glare vs nonglare; 1 = glare vs iso; 2 = nonglare vs iso)
-            glare_vs_nonglare_array = np.array(np.zeros(num_glare_vs_nonglare))
-            glare_vs_iso_array = np.array(np.zeros(num_glare_vs_iso)+1)
-            nonglare_vs_iso_array = np.array(np.zeros(num_nonglare_vs_iso)+2)
-             
-            # Combine stimuli arrays
-            all_stim_array = np.concatenate((glare_vs_nonglare_array,glare_vs_iso_array,nonglare_vs_iso_array))
+            # Select the block schedule
+            # Note: Stimulus types (0 = glare vs nonglare; 1 = glare vs iso; 2 = nonglare vs iso) 
+            # and locations (0 = left; 1 = right) were generated at startup from the session seed
+            block_schedule = session.schedules['brightness'][block]
             
-            # Shuffle stimuli array
-            random.shuffle(all_stim_array)
-                
-            # Create stimuli location arrays (0 = left; 1 = right)
-            glare_vs_nonglare_left_loc_array = np.array(np.zeros(int(num_glare_vs_nonglare/2)))
-            glare_vs_nonglare_right_loc_array = np.array(np.zeros(int(num_glare_vs_nonglare/2))+1)
-            
-            glare_vs_iso_left_loc_array = np.array(np.zeros(int(num_glare_vs_iso/2)))
-            glare_vs_iso_right_loc_array = np.array(np.zeros(int(num_glare_vs_iso/2))+1)
+            # Stimuli type array
+            all_stim_array = block_schedule['stim_type'].astype(float)
             
-            nonglare_vs_iso_left_loc_array = np.array(np.zeros(int(num_nonglare_vs_iso/2)))
-            nonglare_vs_iso_right_loc_array = np.array(np.zeros(int(num_nonglare_vs_iso/2))+1)
-            
-            # Combine stimuli location arrays
-            all_glare_vs_nonglare_loc_array = np.concatenate((glare_vs_nonglare_left_loc_array,glare_vs_nonglare_right_loc_array))
-            all_glare_vs_iso_loc_array = np.concatenate((glare_vs_iso_left_loc_array,glare_vs_iso_right_loc_array))
-            all_nonglare_vs_iso_loc_array = np.concatenate((nonglare_vs_iso_left_loc_array,nonglare_vs_iso_right_loc_array))
-
-            # Shuffle stimuli arrays
-            random.shuffle(all_glare_vs_nonglare_loc_array)
-            random.shuffle(all_glare_vs_iso_loc_array)
-            random.shuffle(all_nonglare_vs_iso_loc_array)
+            # Stimuli location arrays (in order of presentation of each stimulus type)
+            all_glare_vs_nonglare_loc_array = block_schedule['side'][block_schedule['stim_type'] == 0].astype(float)
+            all_glare_vs_iso_loc_array = block_schedule['side'][block_schedule['stim_type'] == 1].astype(float)
+            all_nonglare_vs_iso_loc_array = block_schedule['side'][block_schedule['stim_type'] == 2].astype(float)
 
             # Task start trigger
             start_trigger()
             
             # Log
             logging.log(level=logging.EXP,msg='Block #' + str(block_counter))
-            el_tracker.sendMessage("Block #%d" % (block_counter))
+            session.el_tracker.sendMessage("Block #%d" % (block_counter))
         
             # Log the stimulus and location arrays
             logging.log(level=logging.EXP,msg='All Stimuli Type Array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor): ' + str(all_stim_array))
@@ -1394,119 +2848,72 @@ def brightness_perception():
             logging.log(level=logging.EXP,msg='Nonglare Stimuli Location Array (0 = left; 1 = right): ' + str(all_glare_vs_iso_loc_array))
             logging.log(level=logging.EXP,msg='Iso Stimuli Location Array (0 = left; 1 = right): ' + str(all_nonglare_vs_iso_loc_array))
 
-            el_tracker.sendMessage('All Stimuli Type Array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor): ' + str(all_stim_array))
-            el_tracker.sendMessage('Glare Stimuli Location Array (0 = left; 1 = right): ' + str(all_glare_vs_nonglare_loc_array))
-            el_tracker.sendMessage('Nonglare Stimuli Location Array (0 = left; 1 = right): ' + str(all_glare_vs_iso_loc_array))
-            el_tracker.sendMessage('Iso Stimuli Location Array (0 = left; 1 = right): ' + str(all_nonglare_vs_iso_loc_array))
+            session.el_tracker.sendMessage('All Stimuli Type Array (0 = glare; 1 = nonglare; 2 = iso; 3 = white; 4 = distractor): ' + str(all_stim_array))
+            session.el_tracker.sendMessage('Glare Stimuli Location Array (0 = left; 1 = right): ' + str(all_glare_vs_nonglare_loc_array))
+            session.el_tracker.sendMessage('Nonglare Stimuli Location Array (0 = left; 1 = right): ' + str(all_glare_vs_iso_loc_array))
+            session.el_tracker.sendMessage('Iso Stimuli Location Array (0 = left; 1 = right): ' + str(all_nonglare_vs_iso_loc_array))
        
             # Track time taken to complete block
-            block_start = time.time()
+            block_start = core.getTime()
     
             # Loop over trials/stimuli
-            for current_stim in all_stim_array:
+            for trial in block_schedule:
                 
-                # Count the number of trials
-                trial_counter = trial_counter+1
+                # Trial number, stimulus type, and location
+                trial_counter = int(trial['trial'])
+                current_stim = int(trial['stim_type'])
+                current_side = int(trial['side'])
+                session.timing.set_context('brightness', block_counter, trial_counter)
+                trial_span = session.tracer.begin(trial_span_id, trial_counter)
                 
                 # Log
-                logging.log(level=logging.EXP,msg='Starting Trial #'+str(trial_counter))
-                el_tracker.sendMessage("Starting Trial " + str(trial_counter))
+                session.dispatcher.send('Starting Trial #'+str(trial_counter), eyelink_msg="Starting Trial " + str(trial_counter))
                 
                 # Quit task
                 quit_task()
                 
                 # Start task trial
                 
-                # Reset timer
-                timer.reset()
-                
                 # Wait pre-stimulus ISI
-                while timer.getTime() < 2:
-                    win.update()
-                
-                # If glare vs nonglare
-                if current_stim == 0:
-                    
-                    # Set right position
-                    if all_glare_vs_nonglare_loc_array[glare_vs_nonglare_counter] == 1:
-                        glare_stimulus.pos = right_loc
-                        nonglare_stimulus.pos = left_loc
-                          
-                    # Set left position
-                    elif all_glare_vs_nonglare_loc_array[glare_vs_nonglare_counter] == 0:
-                        glare_stimulus.pos = left_loc
-                        nonglare_stimulus.pos = right_loc
-                    
-                    # Add to stimulus counter
-                    glare_vs_nonglare_counter = glare_vs_nonglare_counter+1
+                interval_span = session.tracer.begin(pre_isi_span_id)
+                present_frames(seconds_to_frames(int(trial['pre_isi'])))
+                session.tracer.end(interval_span)
                 
-                    # Show stimulus
-                    glare_stimulus.setAutoDraw(True)
-                    nonglare_stimulus.setAutoDraw(True)
-                    
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Glare vs Nonglare Stimulus')
-                    el_tracker.sendMessage('Draw Glare vs Nonglare Stimulus')
+                # Look up the trial stimulus pair
+                # Note: The first stimulus is shown on the right if the location is 1
+                first_stimulus, second_stimulus, current_stimulus_name = session.brightness_stimulus_table[current_stim]
                 
-                # If glare vs iso
-                elif current_stim == 1:
-                    
-                    # Set right position
-                    if all_glare_vs_iso_loc_array[glare_vs_iso_counter] == 1:
-                        glare_stimulus.pos = right_loc
-                        iso_stimulus.pos = left_loc
-                          
-                    # Set left position
-                    elif all_glare_vs_iso_loc_array[glare_vs_iso_counter] == 0:
-                        glare_stimulus.pos = left_loc
-                        iso_stimulus.pos = right_loc
-                    
-                    # Add to stimulus counter
-                    glare_vs_iso_counter = glare_vs_iso_counter+1
+                # Set right position
+                if current_side == 1:
+                    first_stimulus.pos = right_loc
+                    second_stimulus.pos = left_loc
+                      
+                # Set left position
+                elif current_side == 0:
+                    first_stimulus.pos = left_loc
+                    second_stimulus.pos = right_loc
                 
-                    # Show stimulus
-                    glare_stimulus.setAutoDraw(True)
-                    iso_stimulus.setAutoDraw(True)
-                    
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Glare vs Iso Stimulus')
-                    el_tracker.sendMessage('Draw Glare vs Iso Stimulus')
-                    
-                # If nonglare vs iso    
-                elif current_stim == 2:
-                    
-                    # Set right position
-                    if all_nonglare_vs_iso_loc_array[nonglare_vs_iso_counter] == 1:
-                        iso_stimulus.pos = right_loc
-                        nonglare_stimulus.pos = left_loc
-                          
-                    # Set left position
-                    elif all_nonglare_vs_iso_loc_array[nonglare_vs_iso_counter] == 0:
-                        iso_stimulus.pos = left_loc
-                        nonglare_stimulus.pos = right_loc
-                    
-                    # Add to stimulus counter
-                    nonglare_vs_iso_counter = nonglare_vs_iso_counter+1
+                # Show stimulus
+                first_stimulus.setAutoDraw(True)
+                second_stimulus.setAutoDraw(True)
                 
-                    # Show stimulus
-                    iso_stimulus.setAutoDraw(True)
-                    nonglare_stimulus.setAutoDraw(True)
-                    
-                    # Log
-                    logging.log(level=logging.EXP,msg='Draw Nonglare vs Iso Stimulus')
-                    el_tracker.sendMessage('Draw Nonglare vs Iso Stimulus')
+                # Log on the stimulus onset flip
+                session.dispatcher.send_on_flip('Draw ' + current_stimulus_name + ' Stimulus')
                         
                 # On-screen text
-                subjective_instructions = visual.TextStim(win, text='Which image is brighter at its center?\n\n 1 = Left image\n 2 = Right image\n 3 = Same brightness', color = genv.getForegroundColor(), wrapWidth = scn_width/2) 
+                subjective_instructions = session.stimulus_pool.get('subjective_instructions')
                 subjective_instructions.draw()
-                win.flip()
+                interval_span = session.tracer.begin(stimulus_span_id)
+                onset_time = session.win.flip()
     
                 # Wait for key press
                 brightness_key = event.waitKeys(keyList=['1','2','3','escape', 'p'])
+                response_time = logging.defaultClock.getTime()
                 
                 # Quit task
+                # Note: Ends the experiment, so the queued events and block records are written
                 if np.in1d(brightness_key,['escape','p']):
-                    core.quit() 
+                    end_experiment()
     
                 # Store answers
                 else: 
@@ -1514,46 +2921,61 @@ def brightness_perception():
                     brightness_answers = np.append(brightness_answers, brightness_key)
         
                 # Update window
-                win.update()
+                session.win.update()
             
                 # Turn off stimuli
-                if current_stim == 0:
-                    glare_stimulus.setAutoDraw(False)
-                    nonglare_stimulus.setAutoDraw(False)
-    
-                elif current_stim == 1:
-                    iso_stimulus.setAutoDraw(False)
-                    glare_stimulus.setAutoDraw(False)
-                
-                elif current_stim == 2:
-                    iso_stimulus.setAutoDraw(False)
-                    nonglare_stimulus.setAutoDraw(False)
+                first_stimulus.setAutoDraw(False)
+                second_stimulus.setAutoDraw(False)
                 
                 # Update window
-                win.update()
+                # Note: flip (same as update) returns the stimulus offset time
+                offset_time = session.win.flip()
+                session.tracer.end(interval_span)
+                
+                # Store trial event
+                session.event_store.add('brightness', 'trial', block_counter, trial_counter, current_stim, current_side,
+                                        onset=onset_time, offset=offset_time, response=int(brightness_key[0]), rt=response_time - onset_time)
+                session.tracer.end(trial_span)
                 
             # End of Block
             
             # End block time
-            block_end = time.time()
+            block_end = core.getTime()
+            session.timing.set_context('brightness', block_counter)
+            
+            # Write the queued trial events before the block summary
+            session.dispatcher.drain()
+            
+            # Write block events
+            session.event_store.flush()
+            
+            # Block frame timing summary, then write the timing records
+            timing_text = session.timing.summary()
+            session.timing.flush()
     
             # Log
+            # Note: The frame timing summary is logged before the block duration, so the rows after it are unchanged
             logging.log(level=logging.EXP,msg='Block Perception Answers: ' + str(brightness_answers))
+            logging.log(level=logging.EXP,msg='Frame timing: ' + timing_text)
             logging.log(level=logging.EXP,msg='Block '+str(block_counter)+' Duration: ' + str(block_end-block_start))
             
-            el_tracker.sendMessage('Block Perception Answers: ' + str(brightness_answers))
-            el_tracker.sendMessage('Block '+str(block_counter)+' Duration: ' + str(block_end-block_start))
+            session.el_tracker.sendMessage('Block Perception Answers: ' + str(brightness_answers))
+            session.el_tracker.sendMessage('Frame timing: ' + timing_text)
+            session.el_tracker.sendMessage('Block '+str(block_counter)+' Duration: ' + str(block_end-block_start))
+            session.tracer.end(block_span)
 
             # Block Break Screen
-            block_break = visual.TextStim(win, text="Great job! Take a break.\n\nYou completed Block "+str(block_counter)+
-                                          ". \n\nExperimenter: \nspace = continue to next block \nb = break to next task phase", color='black')
+            block_break = session.stimulus_pool.get('block_break', text="Great job! Take a break.\n\nYou completed Block "+str(block_counter)+
+                                            ". \n\nExperimenter: \nspace = continue to next block \nb = break to next task phase")
     
             # Show break screen
+            break_span = session.tracer.begin(break_span_id, block_counter)
             block_break.draw()
-            win.flip()
+            session.win.flip()
             
             # Continue or quit
             key = block_continue()
+            session.tracer.end(break_span)
             
             # Break from current block
             if np.in1d(key, ['b']):
@@ -1569,6 +2991,16 @@ def brightness_perception():
     
 def main():
 
+    # *********************
+    # *** Setup Session ***
+    # *********************
+    
+    # Command line options
+    session.options, _ = parser.parse_known_args()
+    
+    # Set up the session and log the startup timing breakdown
+    session.startup()
+    
     # *********************
     # *** Setup EyeLink ***
     # *********************
@@ -1576,36 +3008,40 @@ def main():
     #rel = RealEyeLink() #sets up real eyelink object
 
     # If running EyeLink
-    if not dummy_mode:
+    if not session.dummy_mode:
         task_msg = 'Press O to calibrate tracker'
         instructions_screens(task_msg)
     
-    if not dummy_mode:
+    if not session.dummy_mode:
         try:
-            el_tracker.doTrackerSetup()
+            session.el_tracker.doTrackerSetup()
         except RuntimeError as err:
             print('ERROR:', err)
-            el_tracker.exitCalibration()
+            session.el_tracker.exitCalibration()
             
-    el_tracker.setOfflineMode()
+    session.el_tracker.setOfflineMode()
     
     try:
-        el_tracker.startRecording(1, 1, 1, 1)
+        session.el_tracker.startRecording(1, 1, 1, 1)
     except RuntimeError as error:
         print("ERROR:", error)
         terminate_task()
 
-    eye_used = el_tracker.eyeAvailable()
+    eye_used = session.el_tracker.eyeAvailable()
     
     if eye_used == 1:
-        el_tracker.sendMessage("EYE_USED 1 RIGHT")
+        session.el_tracker.sendMessage("EYE_USED 1 RIGHT")
     elif eye_used == 0 or eye_used == 2:
-        el_tracker.sendMessage("EYE_USED 0 LEFT")
+        session.el_tracker.sendMessage("EYE_USED 0 LEFT")
         eye_used = 0
     else:
         print("Error in getting the eye information!")
     pylink.pumpDelay(100)
     
+    # Start online fixation monitoring
+    # Note: The headless simulation reads samples on the task thread, so runs are reproducible
+    session.gaze_monitor.start(eye_used, threaded=not session.options.simulate)
+    
     # *******************************
     # *** Beginning of Experiment ***
     # *******************************
@@ -1627,7 +3063,9 @@ def main():
     instructions_screens("Let's check if the keypresses are working...")
     
     # Check keys
+    phase_span = session.tracer.begin(session.tracer.register('Check keypresses', 'phase'), cpu=True)
     check_keypresses()
+    session.tracer.end(phase_span)
     
     # Instruction screen 
     instructions_screens("The keys are working! Please keep your hand in approximately its current position.")
@@ -1643,13 +3081,17 @@ def main():
     # *** Glare Main Task Phase ***
     # *****************************
    
+    phase_span = session.tracer.begin(session.tracer.register('Main phase', 'phase'), cpu=True)
     glare_main_phase(final_stim_x_pos, final_stim_y_pos)
+    session.tracer.end(phase_span)
 
     # ******************************
     # *** Glare Brightness Phase ***
     # ******************************
     
+    phase_span = session.tracer.begin(session.tracer.register('Brightness phase', 'phase'), cpu=True)
     brightness_perception()
+    session.tracer.end(phase_span)
     
     # *******************************
     # ***** End of Experiment *******
@@ -0,0 +1,778 @@
+# ********************************
+# *** HEADLESS SIMULATION MODE ***
+# ********************************
+
+# Simulated stand-ins for the PsychoPy window, keyboard, clock and the
+# EyeLink tracker, plus a scripted virtual participant. Used by
+# Glare_Illusion_Paradigm_v8.py when run with "--simulate":
+#
+#   python Glare_Illusion_Paradigm_v8.py --simulate --seed 1
+#
+# Nothing is drawn and no hardware is opened. Time is a simulated clock
+# that advances one frame per window flip (and by the wait/response time
+# for waits and key presses), so a full session runs in seconds. Task
+# events are still written by PsychoPy logging on the simulated clock.
+
+# ***************************
+# *** IMPORTANT LIBRARIES ***
+# ***************************
+
+import atexit
+import heapq
+import math
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+from psychopy import logging
+
+# ***********************
+# *** SIMULATED CLOCK ***
+# ***********************
+
+class SimulatedClock:
+    '''Task clock that only advances when the task waits or flips
+    time_scale: if > 0, also sleep so the session runs time_scale times faster than real time'''
+
+    def __init__(self, time_scale: float = 0):
+
+        # Simulated time (in seconds)
+        self.t = 0.0
+        self.time_scale = time_scale
+
+    def getTime(self) -> float:
+        '''Current simulated time (in seconds)'''
+
+        return self.t
+
+    def advance(self, duration: float) -> None:
+        '''Move the simulated time forward'''
+
+        self.t += duration
+
+        # Slow down to the requested time scale
+        if self.time_scale > 0:
+            time.sleep(duration/self.time_scale)
+
+# ***************************
+# *** VIRTUAL PARTICIPANT ***
+# ***************************
+
+class VirtualParticipant:
+    '''Scripted participant that watches the simulated screen and answers
+
+    Distractors are detected with a per-visual-field hit rate (to model a blind
+    hemifield; in the left field, the rate rises to the right field rate near
+    the vertical meridian) and answered after a random reaction time. Brightness comparisons
+    are answered by a fixed brightness ranking with some "same" answers. Gaze
+    stays on the fixation cross except for occasional saccades to task stimuli,
+    the pupil constricts after task stimuli (less in the left visual field), 
+    and the eyes blink every few seconds.'''
+
+    def __init__(self, seed: int = None, hit_rates: dict = None, false_alarm_rate: float = 0.02,
+                 num_blocks: int = None, button_condition: int = 1, fixation_break_rate: float = 0.05):
+
+        # Random number generator
+        self.rng = random.Random(seed)
+
+        # Distractor detection rate per visual field
+        self.hit_rates = hit_rates or {'left': 0.1, 'right': 0.95}
+
+        # Blind (left) field border: distance from the vertical meridian and width of the transition (in cm)
+        self.blind_field_border = 6.0
+        self.blind_field_width = 1.5
+
+        # Rate of key presses on non-distractor stimuli
+        self.false_alarm_rate = false_alarm_rate
+
+        # Number of blocks to complete per task phase (None = all blocks)
+        self.num_blocks = num_blocks
+        self.blocks_completed = 0
+
+        # Button condition (1: plus = 1, cross = 2; 2: plus = 2, cross = 1)
+        self.button_condition = button_condition
+
+        # Brightness ranking of the comparison stimuli
+        self.brightness_rank = {'glare_stimulus': 3, 'iso_stimulus': 2, 'nonglare_stimulus': 1}
+
+        # Gaze random number generator (separate, so key presses do not depend on the gaze samples read)
+        self.gaze_rng = random.Random(None if seed is None else 'gaze %d' % seed)
+
+        # Rate of saccades to task stimuli and the planned (start, end, x, y) gaze shifts (in seconds and cm)
+        self.fixation_break_rate = fixation_break_rate
+        self.gaze_shifts = []
+
+        # Pupil constriction per stimulus (EyeLink pupil units, right visual field) and the last task stimulus (onset, amplitude)
+        self.pupil_responses = {'glare_stimulus': -250, 'nonglare_stimulus': -80, 'iso_stimulus': -150, 'white_stimulus': -300,
+                                'distractor_plus_stimulus': -100, 'distractor_cross_stimulus': -100}
+        self.last_onset = (-1e9, 0)
+
+        # Current/next blink (start, end) (in seconds)
+        self.blink = (0.0, 0.0)
+
+    def reaction_time(self) -> float:
+        '''Random distractor reaction time (in seconds)'''
+
+        return 0.25 + self.rng.lognormvariate(-1.5, 0.4)
+
+    def hit_rate(self, pos) -> float:
+        '''Distractor detection rate at a stimulus position (in cm)'''
+
+        # Right (sighted) visual field
+        if pos[0] > 0:
+            return self.hit_rates['right']
+
+        # Left visual field: sighted rate near the vertical meridian, blind field rate past the border
+        depth = (-pos[0] - self.blind_field_border)/self.blind_field_width
+        return self.hit_rates['left'] + (self.hit_rates['right'] - self.hit_rates['left'])/(1 + math.exp(min(depth, 50)))
+
+    def on_screen_change(self, t: float, visible: dict, new_stimuli: list) -> list:
+        '''Return the (time, key) presses caused by stimuli appearing on screen'''
+
+        presses = []
+
+        for stimulus in new_stimuli:
+
+            # Positioning phase: accept the start position after a short look
+            if stimulus.name == 'nonglare_right':
+                presses.append((t + 2.0, 'space'))
+
+            # Only respond to stimuli shown during fixation (task trials)
+            if 'fixation' not in visible:
+                continue
+
+            # Pupil response (weaker in the left visual field)
+            if stimulus.name in self.pupil_responses:
+                scale = 1.0 if stimulus.pos[0] > 0 else 0.4
+                self.last_onset = (t, scale*self.pupil_responses[stimulus.name])
+
+            # Occasional saccade to the stimulus (fixation break)
+            if self.gaze_rng.random() < self.fixation_break_rate:
+                start = t + 0.2 + 0.3*self.gaze_rng.random()
+                self.gaze_shifts.append((start, start + 0.3, stimulus.pos[0], stimulus.pos[1]))
+
+            # Distractor stimuli
+            if stimulus.name.startswith('distractor'):
+
+                # Detect and answer with the button of the distractor type
+                if self.rng.random() < self.hit_rate(stimulus.pos):
+                    plus_key, cross_key = ('1', '2') if self.button_condition == 1 else ('2', '1')
+                    key = plus_key if stimulus.name == 'distractor_plus_stimulus' else cross_key
+                    presses.append((t + self.reaction_time(), key))
+
+            # Occasional false alarm on other stimuli
+            elif self.rng.random() < self.false_alarm_rate:
+                presses.append((t + self.reaction_time(), self.rng.choice(['1', '2'])))
+
+        return presses
+
+    def gaze(self, t: float) -> tuple:
+        '''Gaze position at time t (in cm from the fixation cross)'''
+
+        # Drop finished gaze shifts
+        while self.gaze_shifts and self.gaze_shifts[0][1] < t:
+            self.gaze_shifts.pop(0)
+
+        # Fixation cross or the gaze shift target
+        x = y = 0.0
+        if self.gaze_shifts and self.gaze_shifts[0][0] <= t:
+            x, y = self.gaze_shifts[0][2:]
+
+        # Fixational eye movements and tracker noise
+        return x + self.gaze_rng.gauss(0, 0.3), y + self.gaze_rng.gauss(0, 0.3)
+
+    def pupil(self, t: float) -> float:
+        '''Pupil size at time t (0 during blinks)'''
+
+        # Next blink (every 4 s on average, 100-200 ms long)
+        if t >= self.blink[1]:
+            start = t + self.gaze_rng.expovariate(0.25)
+            self.blink = (start, start + 0.1 + 0.1*self.gaze_rng.random())
+        if t >= self.blink[0]:
+            return 0.0
+
+        # Constriction after the last task stimulus (peaks 1.2 s after onset)
+        onset, amplitude = self.last_onset
+        x = (t - onset)/1.2
+        response = amplitude*x*math.exp(1 - x) if 0 <= x < 5 else 0.0
+
+        return 1000.0 + response + self.gaze_rng.gauss(0, 5)
+
+    def respond(self, key_list: list, visible: dict) -> tuple:
+        '''Return the (response time, key) for a screen waiting on a key press'''
+
+        # Start trigger
+        if '5' in key_list:
+            return 1.0, '5'
+
+        # Block break: continue or break to the next task phase
+        if 'b' in key_list:
+            self.blocks_completed += 1
+            if self.num_blocks is not None and self.blocks_completed >= self.num_blocks:
+                self.blocks_completed = 0
+                return 5.0, 'b'
+            return 5.0, 'space'
+
+        # Brightness comparison
+        if '3' in key_list:
+
+            # Rank the left and right images
+            shown = [stimulus for name, stimulus in visible.items() if name in self.brightness_rank]
+            left = [self.brightness_rank[s.name] for s in shown if s.pos[0] < 0]
+            right = [self.brightness_rank[s.name] for s in shown if s.pos[0] > 0]
+
+            # Answer (1 = left image; 2 = right image; 3 = same brightness)
+            if not left or not right or self.rng.random() < 0.1:
+                key = '3'
+            else:
+                key = '1' if max(left) > max(right) else '2'
+            return 1.0 + self.rng.random(), key
+
+        # Instructions and key checks: press the requested key
+        return 1.0, [key for key in key_list if key not in ['escape', 'p']][0]
+
+# ************************
+# *** SIMULATED SCREEN ***
+# ************************
+
+class SimulatedStimulus:
+    '''Stand-in for visual.ImageStim and visual.TextStim'''
+
+    def __init__(self, win, text: str = '', pos=(0, 0), name: str = None, **kwargs):
+
+        self.win = win
+        self.text = text
+        self.pos = pos
+        self.name = name or 'unnamed %s' % type(self).__name__
+        self.autoDraw = False
+
+        # Keep all other stimulus parameters
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def setAutoDraw(self, value: bool) -> None:
+        '''Add/remove the stimulus from the stimuli drawn on every flip'''
+
+        self.autoDraw = value
+        if value:
+            self.win.visible[self.name] = self
+        else:
+            self.win.visible.pop(self.name, None)
+        self.win.screen_changed = True
+
+    def draw(self) -> None:
+        '''Draw the stimulus once (no-op)'''
+
+class SimulatedWindow:
+    '''Stand-in for visual.Window that advances the simulated clock on each flip'''
+
+    def __init__(self, simulation, size=(2560, 1440), color=(0, 0, 0), units='cm', **kwargs):
+
+        self.simulation = simulation
+        self.size = size
+        self.color = color
+        self.fillColor = color
+        self.units = units
+
+        # Stimuli drawn on every flip (by name)
+        self.visible = {}
+        self.screen_changed = False
+        self.shown = {}
+
+        # Functions to call on the next flip
+        self.flip_callbacks = []
+
+        # Monitor (PsychoPy "testMonitor" width in cm)
+        self.monitor = SimpleNamespace(getWidth=lambda: 30.0)
+
+        # Number of flips
+        self.num_flips = 0
+
+    def getActualFrameRate(self, **kwargs) -> float:
+        '''Simulated refresh rate (in Hz)'''
+
+        return self.simulation.refresh_rate
+
+    def callOnFlip(self, function, *args, **kwargs) -> None:
+        '''Call a function right after the next flip'''
+
+        self.flip_callbacks.append((function, args, kwargs))
+
+    def flip(self, clearBuffer: bool = True) -> float:
+        '''Advance one frame and return the flip time'''
+
+        simulation = self.simulation
+
+        # Next frame
+        simulation.clock.advance(simulation.frame_duration)
+        flip_time = simulation.clock.t
+        self.num_flips += 1
+
+        # Flip callbacks
+        if self.flip_callbacks:
+            callbacks, self.flip_callbacks = self.flip_callbacks, []
+            for function, args, kwargs in callbacks:
+                function(*args, **kwargs)
+
+        # Let the participant see what appeared on screen
+        if self.screen_changed:
+            new_stimuli = [stimulus for name, stimulus in self.visible.items() if name not in self.shown]
+            self.shown = dict(self.visible)
+            self.screen_changed = False
+            for press in simulation.participant.on_screen_change(flip_time, self.visible, new_stimuli):
+                simulation.event.schedule(*press)
+
+        return flip_time
+
+    def update(self) -> float:
+        '''Flip (PsychoPy alias; calls flip, so a replaced flip also applies)'''
+
+        return self.flip()
+
+    def clearBuffer(self, **kwargs) -> None:
+        '''Clear the back buffer (no-op)'''
+
+    def close(self) -> None:
+        '''Close the window (no-op)'''
+
+# **************************
+# *** SIMULATED KEYBOARD ***
+# **************************
+
+class SimulatedEvent:
+    '''Stand-in for the psychopy.event keyboard functions
+
+    Scheduled key presses enter the key buffer once the simulated clock passes
+    their press time and are logged like PsychoPy logs real key presses.'''
+
+    def __init__(self, simulation):
+
+        self.simulation = simulation
+
+        # Future (time, key) presses and pressed keys not yet read
+        self.scheduled = []
+        self.key_buffer = []
+
+        # Hardware keyboards that also receive every key press
+        self.keyboards = []
+
+        # Called before a key press is logged
+        # Note: The task sets this to wait for its queued log events, so key presses
+        # are logged after the events that came before them in simulated time
+        self.before_keypress = None
+
+    def schedule(self, t: float, key: str) -> None:
+        '''Press a key at a future simulated time'''
+
+        heapq.heappush(self.scheduled, (t, key))
+
+    def _press_due_keys(self) -> None:
+        '''Move scheduled key presses that are due into the key buffer'''
+
+        now = self.simulation.clock.t
+        while self.scheduled and self.scheduled[0][0] <= now:
+            t, key = heapq.heappop(self.scheduled)
+            self.key_buffer.append((key, t))
+            for task_keyboard in self.keyboards:
+                task_keyboard.key_buffer.append((key, t))
+            if self.before_keypress is not None:
+                self.before_keypress()
+            logging.log(level=logging.DATA, msg='Keypress: %s' % key, t=t)
+
+    def getKeys(self, keyList: list = None, timeStamped: bool = False) -> list:
+        '''Return (and remove) the buffered keys in keyList'''
+
+        if self.scheduled:
+            self._press_due_keys()
+        if not self.key_buffer:
+            return []
+
+        # Keys not in keyList stay in the buffer
+        keys = [press for press in self.key_buffer if keyList is None or press[0] in keyList]
+        self.key_buffer = [press for press in self.key_buffer if not (keyList is None or press[0] in keyList)]
+
+        if timeStamped:
+            return [[key, t] for key, t in keys]
+        return [key for key, t in keys]
+
+    def waitKeys(self, keyList: list = None, timeStamped: bool = False, clearEvents: bool = True, **kwargs) -> list:
+        '''Wait for the participant to answer the current screen'''
+
+        # Clear the key buffer
+        if clearEvents:
+            self.clearEvents()
+
+        # Participant response
+        response_time, key = self.simulation.participant.respond(keyList, self.simulation.win.visible)
+        self.simulation.clock.advance(response_time)
+        self.schedule(self.simulation.clock.t, key)
+
+        return self.getKeys(keyList, timeStamped)
+
+    def clearEvents(self, eventType: str = None) -> None:
+        '''Discard the pressed keys not yet read'''
+
+        self._press_due_keys()
+        self.key_buffer = []
+
+class SimulatedKeyboardClock:
+    '''Stand-in for the psychopy.hardware.keyboard reaction time clock'''
+
+    def __init__(self, clock: SimulatedClock):
+
+        self.clock = clock
+        self.start = clock.t
+
+    def reset(self) -> None:
+
+        self.start = self.clock.t
+
+    def getTime(self) -> float:
+
+        return self.clock.t - self.start
+
+class SimulatedKeyboard:
+    '''Stand-in for psychopy.hardware.keyboard.Keyboard
+
+    Key presses carry the simulated press time (tDown) and the reaction time
+    (rt) relative to the last clock reset.'''
+
+    def __init__(self, simulation):
+
+        self.simulation = simulation
+        self.clock = SimulatedKeyboardClock(simulation.clock)
+        self.key_buffer = []
+
+        # Receive every simulated key press
+        simulation.event.keyboards.append(self)
+
+    def getKeys(self, keyList: list = None, waitRelease: bool = True, clear: bool = True) -> list:
+        '''Return the buffered key presses in keyList'''
+
+        self.simulation.event._press_due_keys()
+        if not self.key_buffer:
+            return []
+
+        # Key presses
+        keys = [SimpleNamespace(name=key, tDown=t, rt=t - self.clock.start, duration=None)
+                for key, t in self.key_buffer if keyList is None or key in keyList]
+
+        # Keys not in keyList stay in the buffer
+        if clear:
+            self.key_buffer = [press for press in self.key_buffer if not (keyList is None or press[0] in keyList)]
+
+        return keys
+
+    def clearEvents(self, eventType: str = None) -> None:
+        '''Discard the key presses not yet read'''
+
+        self.simulation.event._press_due_keys()
+        self.key_buffer = []
+
+# ************************
+# *** SIMULATED PYLINK ***
+# ************************
+
+# pylink link data codes
+SAMPLE_TYPE = 200
+MISSING_DATA = -32768
+
+class SimulatedSample:
+    '''Stand-in for a pylink link sample (both eyes have the same data)'''
+
+    def __init__(self, t: int, gaze: tuple, pupil_size: float):
+
+        self.t = t
+        self.gaze = gaze
+        self.pupil_size = pupil_size
+
+    def getTime(self) -> int:
+
+        return self.t
+
+    def getLeftEye(self) -> 'SimulatedSample':
+
+        return self
+
+    def getRightEye(self) -> 'SimulatedSample':
+
+        return self
+
+    def getGaze(self) -> tuple:
+
+        return self.gaze
+
+    def getPupilSize(self) -> float:
+
+        return self.pupil_size
+
+class SimulatedEyeLink:
+    '''Stand-in for the pylink.EyeLink tracker connection
+
+    Messages are kept with their (simulated) tracker time and written to a
+    text file in output_folder when the data file is closed. While recording,
+    1000 Hz link samples of the participant's gaze are made on demand, up to 
+    the current simulated time.'''
+
+    def __init__(self, simulation, output_folder: str = 'EyeLink_Data'):
+
+        self.simulation = simulation
+        self.data_file = None
+        self.recording = False
+
+        # Absolute path, because the task changes the working directory
+        self.output_folder = os.path.abspath(output_folder)
+
+        # (tracker time in ms, message) pairs
+        self.messages = []
+
+        # Screen size (in pixels, set by the "screen_pixel_coords" command)
+        self.screen_size = (2560, 1440)
+
+        # Time of the next link sample (in ms) and the last sample read
+        self.next_sample_time = 0
+        self.sample = None
+
+    def trackerTime(self) -> float:
+        '''Simulated tracker time (in ms)'''
+
+        return self.simulation.clock.t*1000
+
+    def sendMessage(self, message: str) -> None:
+
+        self.messages.append((self.trackerTime(), message))
+
+    def sendCommand(self, command: str) -> None:
+        '''Tracker command (only the screen size is used)'''
+
+        if command.startswith('screen_pixel_coords'):
+            left, top, right, bottom = [int(value) for value in command.split('=')[1].split()]
+            self.screen_size = (right - left + 1, bottom - top + 1)
+
+    def getNextData(self) -> int:
+        '''Make the next link sample if it is due (SAMPLE_TYPE, otherwise 0)'''
+
+        if not self.recording:
+            return 0
+
+        # The link queue holds at most the last 10 seconds of samples
+        now = int(self.trackerTime())
+        self.next_sample_time = max(self.next_sample_time, now - 10000)
+        if self.next_sample_time > now:
+            return 0
+
+        t = self.next_sample_time
+        self.next_sample_time += 1
+
+        # Pupil size and gaze position on screen (in pixels, y down; missing during blinks)
+        pupil_size = self.simulation.participant.pupil(t/1000)
+        x, y = self.simulation.participant.gaze(t/1000)
+        if pupil_size > 0:
+            px_per_cm = self.screen_size[0]/self.simulation.win.monitor.getWidth()
+            gaze = (self.screen_size[0]/2 + x*px_per_cm, self.screen_size[1]/2 - y*px_per_cm)
+        else:
+            gaze = (MISSING_DATA, MISSING_DATA)
+
+        self.sample = SimulatedSample(t, gaze, pupil_size)
+
+        return SAMPLE_TYPE
+
+    def getFloatData(self) -> SimulatedSample:
+        '''Last sample made by getNextData'''
+
+        return self.sample
+
+    def openDataFile(self, filename: str) -> None:
+
+        self.data_file = filename
+
+    def closeDataFile(self) -> None:
+        '''Write the recorded messages'''
+
+        if self.data_file is None:
+            return
+
+        # Check for the output folder, otherwise make it
+        if not os.path.isdir(self.output_folder):
+            os.makedirs(self.output_folder)
+
+        # One "MSG <time> <message>" line per message, as in an ASC file
+        messages_filename = os.path.join(self.output_folder, os.path.splitext(self.data_file)[0] + '_Simulated_Messages.asc')
+        with open(messages_filename, 'w') as messages_file:
+            for t, message in self.messages:
+                messages_file.write('MSG\t%d %s\n' % (t, message))
+        self.data_file = None
+
+    def isConnected(self) -> bool:
+
+        return True
+
+    def isRecording(self) -> int:
+        '''TRIAL_OK (0) while recording'''
+
+        return 0 if self.recording else 1
+
+    def startRecording(self, *args) -> None:
+
+        self.recording = True
+        self.next_sample_time = int(self.trackerTime())
+
+    def stopRecording(self) -> None:
+
+        self.recording = False
+
+    def eyeAvailable(self) -> int:
+        '''Binocular (2)'''
+
+        return 2
+
+    def getTrackerVersionString(self) -> str:
+
+        return 'EYELINK SIMULATED 0.0'
+
+    def setOfflineMode(self) -> None:
+        '''Offline mode (ignored)'''
+
+    def doTrackerSetup(self) -> None:
+        '''Calibration (skipped)'''
+
+    def exitCalibration(self) -> None:
+        '''Calibration (skipped)'''
+
+    def close(self) -> None:
+        '''Close the link (ignored)'''
+
+class SimulatedCoreGraphics:
+    '''Stand-in for EyeLinkCoreGraphicsPsychoPy (calibration graphics)'''
+
+    def __init__(self, tracker, win):
+
+        self.foreground_color = (-1, -1, -1)
+        self.background_color = win.color
+
+    def __str__(self) -> str:
+
+        return 'Simulated EyeLink CoreGraphics'
+
+    def setCalibrationColors(self, foreground_color, background_color) -> None:
+
+        self.foreground_color = foreground_color
+        self.background_color = background_color
+
+    def getForegroundColor(self):
+
+        return self.foreground_color
+
+    def getBackgroundColor(self):
+
+        return self.background_color
+
+    def setTargetType(self, target_type) -> None:
+        '''Calibration target (ignored)'''
+
+    def setTargetSize(self, size) -> None:
+        '''Calibration target (ignored)'''
+
+    def setCalibrationSounds(self, *sounds) -> None:
+        '''Calibration sounds (ignored)'''
+
+    def fixMacRetinaDisplay(self) -> None:
+        '''Retina display fix (ignored)'''
+
+# ***************************
+# *** HEADLESS SIMULATION ***
+# ***************************
+
+class HeadlessSimulation:
+    '''Simulated replacements for the psychopy visual, event, keyboard, core, gui and pylink modules
+
+    seed: random seed of the session schedule and the virtual participant
+    time_scale: 0 = as fast as possible, otherwise the speed-up over real time
+    num_blocks: number of blocks per task phase (None = all blocks)'''
+
+    def __init__(self, seed: int = None, time_scale: float = 0, num_blocks: int = None, refresh_rate: float = 60):
+
+        # Simulated clock and refresh rate
+        self.clock = SimulatedClock(time_scale)
+        self.refresh_rate = refresh_rate
+        self.frame_duration = 1.0/refresh_rate
+        self.seed = seed
+
+        # Use the simulated clock for all log time stamps
+        logging.setDefaultClock(self.clock)
+
+        # Virtual participant
+        self.participant = VirtualParticipant(seed=seed, num_blocks=num_blocks)
+
+        # Simulated window, keyboard and tracker
+        self.win = None
+        self.event = SimulatedEvent(self)
+        self.tracker = SimulatedEyeLink(self)
+
+        # Module stand-ins
+        self.visual = SimpleNamespace(Window=self._open_window, ImageStim=SimulatedStimulus, TextStim=SimulatedStimulus)
+        self.core = SimpleNamespace(getTime=self.clock.getTime, wait=self._wait, quit=self._quit)
+        self.gui = SimpleNamespace(DlgFromDict=self._dialog)
+        self.keyboard = SimpleNamespace(Keyboard=lambda **kwargs: SimulatedKeyboard(self))
+        self.pylink = SimpleNamespace(EyeLink=self._connect, getEYELINK=lambda: self.tracker,
+                                      msecDelay=self._delay, pumpDelay=self._delay,
+                                      openGraphicsEx=lambda genv: None, TRIAL_OK=0, TRIAL_ERROR=1,
+                                      SAMPLE_TYPE=SAMPLE_TYPE, MISSING_DATA=MISSING_DATA)
+        self.EyeLinkCoreGraphicsPsychoPy = SimulatedCoreGraphics
+
+        # Report the run time at exit
+        self.start_time = time.perf_counter()
+        atexit.register(self.report)
+
+    def _open_window(self, **kwargs) -> SimulatedWindow:
+
+        self.win = SimulatedWindow(self, **kwargs)
+        return self.win
+
+    def _connect(self, address=None) -> SimulatedEyeLink:
+
+        return self.tracker
+
+    def _dialog(self, info: dict, title: str = None, **kwargs) -> SimpleNamespace:
+        '''Accept the dialog defaults (first option of each list)'''
+
+        for key, value in info.items():
+            if isinstance(value, list):
+                info[key] = value[0]
+
+        # Session seed
+        if self.seed is not None:
+            info['Random Seed'] = str(self.seed)
+
+        # Participant button condition
+        self.participant.button_condition = int(info['Button Condition'])
+
+        return SimpleNamespace(OK=True)
+
+    def _wait(self, duration: float, **kwargs) -> None:
+
+        self.clock.advance(duration)
+
+    def _delay(self, duration_ms: float) -> None:
+
+        self.clock.advance(duration_ms/1000)
+
+    def _quit(self) -> None:
+
+        sys.exit(0)
+
+    def report(self) -> None:
+        '''Print the simulated vs. real run time and the per-trial overhead'''
+
+        # Run time
+        real_time = time.perf_counter() - self.start_time
+        num_flips = self.win.num_flips if self.win is not None else 0
+        num_trials = sum(1 for t, message in self.tracker.messages if message.startswith('Starting Trial'))
+
+        print('Simulated %.1f s of task time in %.2f s (%.0fx real time)' % (self.clock.t, real_time, self.clock.t/max(real_time, 1e-9)))
+        if num_flips:
+            print('Flips: %d (%.1f us per flip)' % (num_flips, real_time/num_flips*1e6))
+        if num_trials:
+            print('Trials: %d (%.2f ms per trial)' % (num_trials, real_time/num_trials*1000))